@@ -4,6 +4,7 @@ import os
 from pathlib import Path
 from datetime import timedelta
 from dotenv import load_dotenv
+from django.core.exceptions import ImproperlyConfigured
 FRONTEND_URL = os.getenv('FRONTEND_URL', 'http://localhost:5173')
 # Base directory
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -31,8 +32,8 @@ LOGGING = {
 SECRET_KEY = os.getenv("DJANGO_SECRET_KEY")  # Fetching secret key
 ESEWA_SECRET_KEY = os.getenv("ESEWA_SECRET_KEY")  # Fetching eSewa key
 
-# Debug mode (Set to False in production)
-DEBUG = True
+# Debug mode (Set DJANGO_DEBUG=False in production)
+DEBUG = os.getenv('DJANGO_DEBUG', 'True') == 'True'
 
 ALLOWED_HOSTS = ["*"]  # Change to specific hosts in production
 
@@ -65,6 +66,7 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'myapp.db.ReplicaPinningMiddleware',
 ]
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': (
@@ -128,12 +130,138 @@ WSGI_APPLICATION = 'epharm.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/5.0/ref/settings/#databases
 
-DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+# SQLite file by default. For production set DB_ENGINE=postgresql plus DB_NAME, DB_USER,
+# DB_PASSWORD, DB_HOST and DB_PORT (needs the psycopg package).
+DB_ENGINE = os.getenv('DB_ENGINE', 'sqlite')
+
+if DB_ENGINE == 'postgresql':
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.postgresql',
+            'NAME': os.getenv('DB_NAME', 'epharm'),
+            'USER': os.getenv('DB_USER', 'epharm'),
+            'PASSWORD': os.getenv('DB_PASSWORD', ''),
+            'HOST': os.getenv('DB_HOST', 'localhost'),
+            'PORT': os.getenv('DB_PORT', '5432'),
+            # Reuse connections across requests instead of reconnecting every time,
+            # and check them before reuse so a restarted server does not fail requests
+            'CONN_MAX_AGE': int(os.getenv('DB_CONN_MAX_AGE', 60)),
+            'CONN_HEALTH_CHECKS': True,
+            # Behind a transaction pooling PgBouncer (DB_POOLER=pgbouncer) server side cursors do not work
+            'DISABLE_SERVER_SIDE_CURSORS': os.getenv('DB_POOLER') == 'pgbouncer',
+            'OPTIONS': {
+                'connect_timeout': int(os.getenv('DB_CONNECT_TIMEOUT', 5)),
+            },
+        }
     }
+else:
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': os.getenv('DB_NAME', BASE_DIR / 'db.sqlite3'),
+            'OPTIONS': {
+                # Seconds a writer waits for the lock before "database is locked"
+                'timeout': int(os.getenv('SQLITE_TIMEOUT', 20)),
+            },
+        }
+    }
+
+# Optional read replica for catalog, search, service and booking status reads (see myapp/db.py).
+# DB_REPLICA_HOST for PostgreSQL, DB_REPLICA_NAME for another database name or SQLite file.
+DB_REPLICA_NAME = os.getenv('DB_REPLICA_NAME')
+DB_REPLICA_HOST = os.getenv('DB_REPLICA_HOST')
+if DB_REPLICA_NAME or DB_REPLICA_HOST:
+    DATABASES['replica'] = dict(DATABASES['default'], TEST={'MIRROR': 'default'})
+    if DB_REPLICA_NAME:
+        DATABASES['replica']['NAME'] = DB_REPLICA_NAME
+    if DB_REPLICA_HOST:
+        DATABASES['replica']['HOST'] = DB_REPLICA_HOST
+
+READ_REPLICA_ALIAS = 'replica' if 'replica' in DATABASES else None
+# How long a client reads from the primary after writing; also the replica lag we tolerate
+READ_REPLICA_PIN_SECONDS = int(os.getenv('READ_REPLICA_PIN_SECONDS', 10))
+DATABASE_ROUTERS = ['myapp.db.ReadReplicaRouter']
+
+# PRAGMAs applied to new SQLite connections (see myapp/db.py; journal_mode is kept in the
+# database file, so it is set once per database). WAL lets readers
+# run while a write is in progress, and synchronous=NORMAL is safe in WAL mode while
+# skipping an fsync per commit. Set SQLITE_JOURNAL_MODE=delete and
+# SQLITE_SYNCHRONOUS=full for SQLite's own defaults.
+SQLITE_PRAGMAS = {
+    'journal_mode': os.getenv('SQLITE_JOURNAL_MODE', 'wal'),
+    'synchronous': os.getenv('SQLITE_SYNCHRONOUS', 'normal'),
+    'busy_timeout': int(os.getenv('SQLITE_BUSY_TIMEOUT_MS', 20000)),
+    'mmap_size': int(os.getenv('SQLITE_MMAP_SIZE', 128 * 1024 * 1024)),
+    'cache_size': int(os.getenv('SQLITE_CACHE_SIZE', -16000)),  # negative: KiB
+}
+
+
+# Cache
+# The catalog cache version and the suggestion index version live in the cache, so every
+# worker process must share it: set CACHE_URL (e.g. redis://localhost:6379/0). Process local
+# memory is only allowed with DEBUG, for the single process runserver.
+CACHE_URL = os.getenv('CACHE_URL')
+
+if CACHE_URL:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': CACHE_URL,
+        }
+    }
+elif not DEBUG:
+    raise ImproperlyConfigured("Set CACHE_URL to a cache shared by all worker processes (e.g. Redis)")
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            'LOCATION': 'epharm',
+        }
+    }
+
+# Catalog responses (product list/detail/search) are cached per catalog version
+CATALOG_CACHE_TIMEOUT = int(os.getenv('CATALOG_CACHE_TIMEOUT', 60 * 60))
+
+# Free-slot bitmaps per service-day are dropped when a booking changes; this bounds any staleness
+AVAILABILITY_CACHE_TIMEOUT = int(os.getenv('AVAILABILITY_CACHE_TIMEOUT', 10 * 60))
+
+# How long (seconds) stock stays held for an order waiting for payment
+STOCK_RESERVATION_TTL = int(os.getenv('STOCK_RESERVATION_TTL', 15 * 60))
+
+# How long (seconds) a response is replayed for retries with the same Idempotency-Key
+IDEMPOTENCY_KEY_TTL = int(os.getenv('IDEMPOTENCY_KEY_TTL', 24 * 60 * 60))
+
+# Threads per web process verifying payment callbacks after they are acknowledged (0 = inline)
+PAYMENT_VERIFICATION_WORKERS = int(os.getenv('PAYMENT_VERIFICATION_WORKERS', 4))
+# Seconds during which repeated unsigned callbacks for a payment do not ask eSewa again
+PAYMENT_VERIFICATION_WINDOW = int(os.getenv('PAYMENT_VERIFICATION_WINDOW', 60))
+# Checks a callback's outcome before the order or booking is settled (see myapp.payments)
+PAYMENT_VERIFIER = os.getenv('PAYMENT_VERIFIER', 'myapp.payments.verify_with_gateway')
+
+# eSewa ePay v2; the defaults are eSewa's public test merchant and sandbox
+ESEWA_SECRET_KEY = os.getenv('ESEWA_SECRET_KEY', '8gBm/:&EnhH.1/q')
+ESEWA_PRODUCT_CODE = os.getenv('ESEWA_PRODUCT_CODE', 'EPAYTEST')
+ESEWA_STATUS_URL = os.getenv('ESEWA_STATUS_URL', 'https://rc.esewa.com.np/api/epay/transaction/status/')
+ESEWA_SUCCESS_URL = os.getenv('ESEWA_SUCCESS_URL', 'https://developer.esewa.com.np/success/')
+ESEWA_FAILURE_URL = os.getenv('ESEWA_FAILURE_URL', 'https://developer.esewa.com.np/failure/')
+ESEWA_TIMEOUT = float(os.getenv('ESEWA_TIMEOUT', 5))  # seconds, per attempt
+ESEWA_RETRIES = int(os.getenv('ESEWA_RETRIES', 2))
+ESEWA_POOL_SIZE = int(os.getenv('ESEWA_POOL_SIZE', 10))  # idle keep-alive connections kept
+
+# Follow-up work for status changes, run by the dispatch_outbox command (see myapp.outbox):
+# event topic -> dotted paths of handlers called with the event; '*' handlers see every event
+OUTBOX_HANDLERS = {
+    '*': ['myapp.outbox.log_event'],
+    'booking.status_changed': ['myapp.outbox.email_booking_update'],
+    'payment.refund_needed': ['myapp.outbox.email_refund_request'],
 }
+OUTBOX_MAX_ATTEMPTS = int(os.getenv('OUTBOX_MAX_ATTEMPTS', 8))
+OUTBOX_RETRY_DELAY = int(os.getenv('OUTBOX_RETRY_DELAY', 30))  # seconds, doubled after every failed attempt
+OUTBOX_LEASE = int(os.getenv('OUTBOX_LEASE', 5 * 60))  # seconds a dispatcher may take before an event is handed out again
+
+# Customer emails are printed unless a real backend is configured
+EMAIL_BACKEND = os.getenv('EMAIL_BACKEND', 'django.core.mail.backends.console.EmailBackend')
+DEFAULT_FROM_EMAIL = os.getenv('DEFAULT_FROM_EMAIL', 'no-reply@easyhealth.local')
 
 
 # Password validation
@@ -1,10 +1,19 @@
+from django import forms
 from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin
-from django.utils.html import format_html
+from django.db.models import Prefetch
+from django.utils import timezone
+from django.utils.html import format_html, format_html_join
+from django.utils.safestring import mark_safe
 from django.contrib import messages
 from .models import (
-    Product, CustomUser, Cart, CartItem, Order, Service, Booking, BookingReport, userPayment
+    Product, CustomUser, Cart, CartItem, Order, Service, ServiceSchedule, Booking, BookingReport, OutboxEvent,
+    userPayment
 )
+from .availability import SlotUnavailable, check_slot
+from .outbox import booking_status_changed, order_status_changed, publish
+from .pagination import EstimatedCountPaginator
+from .payments import settle_payment
 
 
 class ProductAdmin(admin.ModelAdmin):
@@ -51,21 +60,29 @@ class CartItemAdmin(admin.ModelAdmin):
     list_display = ('product', 'quantity', 'cart_user')
     search_fields = ('product__name',)
     list_filter = ('product__category',)
+    list_select_related = ('product', 'cart__user')
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
 
     def cart_user(self, obj):
-        return obj.cart.user.username
+        # Lines that were ordered no longer belong to a cart
+        return obj.cart.user.username if obj.cart else '-'
     cart_user.short_description = 'Cart User'
 
 admin.site.register(CartItem, CartItemAdmin)
 
 class CartItemInline(admin.TabularInline):
     model = CartItem
-    readonly_fields = ('product', 'quantity', 'prescription_file')
+    fields = ('product', 'product_name', 'quantity', 'unit_price', 'total_price', 'prescription_file')
+    readonly_fields = fields
     can_delete = False
     extra = 0
 
     def has_add_permission(self, request, obj=None):
         return False
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).select_related('product')
 # Order Admin
 @admin.register(Order)
 class OrderAdmin(admin.ModelAdmin):
@@ -78,18 +95,85 @@ class OrderAdmin(admin.ModelAdmin):
     # Make the status editable
     list_editable = ('status',)
 
+    # One query for the page of orders with their users, one for all of their lines
+    list_select_related = ('user',)
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).prefetch_related(
+            Prefetch('cartitem_set', queryset=CartItem.objects.only('id', 'order_id', 'quantity', 'product_name').order_by('id'))
+        )
+
     def view_items(self, obj):
-        items = CartItem.objects.filter(order=obj)
-        return format_html("<br>".join([f"{item.quantity}x {item.product.name}" for item in items]))
+        # Uses the prefetched lines and their name snapshot, no query per row
+        return format_html_join(mark_safe("<br>"), "{}x {}",
+                                ((item.quantity, item.product_name) for item in obj.cartitem_set.all()))
     view_items.short_description = "Order Items"
 
+    def save_model(self, request, obj, form, change):
+        super().save_model(request, obj, form, change)
+        if change and 'status' in form.changed_data:
+            publish(order_status_changed(obj))
+
+class ServiceScheduleInline(admin.TabularInline):
+    model = ServiceSchedule
+    fields = ('weekday', 'opens_at', 'closes_at', 'slot_minutes', 'capacity')
+    extra = 0
+
+@admin.register(Service)
+class ServiceAdmin(admin.ModelAdmin):
+    list_display = ('name', 'price')
+    search_fields = ('name',)
+    inlines = [ServiceScheduleInline]
+
+class BookingAdminForm(forms.ModelForm):
+    class Meta:
+        model = Booking
+        fields = '__all__'
+
+    def clean(self):
+        """Refuse a booking added, moved or reopened into a slot that is full, as BookingCreateView does."""
+        cleaned_data = super().clean()
+        moved = not self.instance.pk or {'service', 'booking_date', 'appointment_time'} & set(self.changed_data)
+        reopened = 'status' in self.changed_data and self.initial.get('status') == 'cancelled'
+        if not (moved or reopened) or cleaned_data.get('status') == 'cancelled' or not all(
+                cleaned_data.get(field) for field in ('service', 'booking_date', 'appointment_time')):
+            return cleaned_data
+        # The admin saves in the transaction the form is validated in, so the service stays locked until then
+        service = Service.objects.select_for_update().get(pk=cleaned_data['service'].pk)
+        try:
+            self.instance.seat = check_slot(service, cleaned_data['booking_date'], cleaned_data['appointment_time'])
+        except SlotUnavailable as e:
+            raise forms.ValidationError(str(e))
+        return cleaned_data
+
 @admin.register(Booking)
 class BookingAdmin(admin.ModelAdmin):
+    form = BookingAdminForm
     list_display = ('name', 'mobile_number', 'email', 'service', 'booking_date', 'appointment_time', 'status', 'created_at')
     search_fields = ('name', 'email', 'mobile_number', 'service__name')
     list_filter = ('status', 'booking_date', 'service')
     date_hierarchy = 'booking_date'
 
+    def save_model(self, request, obj, form, change):
+        super().save_model(request, obj, form, change)
+        if change and 'status' in form.changed_data:
+            publish(booking_status_changed(obj.pk, obj.status))
+
+@admin.register(OutboxEvent)
+class OutboxEventAdmin(admin.ModelAdmin):
+    list_display = ('id', 'topic', 'status', 'attempts', 'created_at', 'available_at', 'dispatched_at')
+    list_filter = ('status', 'topic')
+    readonly_fields = ('topic', 'payload', 'attempts', 'last_error', 'created_at', 'dispatched_at')
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+    actions = ['retry_events']
+
+    @admin.action(description='Retry selected events')
+    def retry_events(self, request, queryset):
+        count = queryset.exclude(status=OutboxEvent.DISPATCHED).update(
+            status=OutboxEvent.PENDING, attempts=0, available_at=timezone.now())
+        messages.add_message(request, messages.INFO, f'{count} events will be dispatched again.')
+
 @admin.register(BookingReport)
 class BookingReportAdmin(admin.ModelAdmin):
     list_display = ('booking', 'report_file', 'uploaded_at', 'notes')
@@ -101,7 +185,7 @@ class BookingReportAdmin(admin.ModelAdmin):
 
 from django.contrib import admin
 from django.utils.html import format_html
-from .models import userPayment, Order
+from .models import userPayment
 
 # User Payment Admin
 @admin.register(userPayment)
@@ -111,6 +195,9 @@ class UserPaymentAdmin(admin.ModelAdmin):
     list_filter = ('status', 'created_at')
     readonly_fields = ('created_at', 'updated_at')
     list_editable = ('status',)  # Allows editing the 'status' directly in the admin interface
+    list_select_related = ('user', 'order')
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
 
     def get_user_info(self, obj):
         if obj.user:
@@ -123,13 +210,15 @@ class UserPaymentAdmin(admin.ModelAdmin):
     get_order_details.short_description = 'Order Details'
 
     def save_model(self, request, obj, form, change):
-        """Override save_model to add custom actions after payment status change."""
-        if obj.status == 'SUCCESS':
-            try:
-                order = Order.objects.get(transaction_uuid=obj.transaction_uuid)
-                order.payment_status = 'paid'
-                order.save()
-                messages.add_message(request, messages.INFO, f'Payment for Order {order.id} marked as paid.')
-            except Order.DoesNotExist:
-                messages.add_message(request, messages.ERROR, f'Order not found for transaction {obj.transaction_uuid}')
-        super().save_model(request, obj, form, change)
\ No newline at end of file
+        """Settle status changes made here like gateway callbacks (settle_payment): only allowed
+        transitions, with the order's stock holds and the booking updated and the change published."""
+        if not (change and 'status' in form.changed_data):
+            return super().save_model(request, obj, form, change)
+        new_status, obj.status = obj.status, form.initial['status']
+        super().save_model(request, obj, form, change)
+        if settle_payment(obj, new_status) is None:
+            messages.add_message(request, messages.ERROR,
+                                 f'Payment {obj.transaction_uuid} can not go from {obj.status} to {new_status}.')
+        else:
+            obj.status = new_status
+            messages.add_message(request, messages.INFO, f'Payment {obj.transaction_uuid} marked as {obj.status}.')
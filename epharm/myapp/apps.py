@@ -4,3 +4,12 @@ from django.apps import AppConfig
 class MyappConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'myapp'
+
+    def ready(self):
+        from django.db.backends.signals import connection_created
+
+        from . import signals  # noqa: F401  (connects the model signal handlers)
+        from .db import configure_sqlite, track_writes
+
+        connection_created.connect(configure_sqlite, dispatch_uid='myapp.configure_sqlite')
+        connection_created.connect(track_writes, dispatch_uid='myapp.track_writes')
@@ -0,0 +1,192 @@
+"""Async variants of the read-heavy catalog endpoints, for ASGI deployments.
+
+The DRF views in views.py are synchronous, so under ASGI each request is handed
+to a worker thread. These plain Django async views use the async ORM instead and
+return the same JSON, so one ASGI worker can serve many slow clients at once.
+They are mounted under async/ (see urls.py) and take the same parameters as the
+sync endpoints, except that the product list pages with ?after=<last id>.
+
+Only anonymous catalog data is served here: DRF token authentication does not
+run, so replica pinning relies on the pin cookie alone.
+"""
+import asyncio
+import json
+import time
+
+from asgiref.sync import sync_to_async
+from django.core.cache import cache
+from django.http import JsonResponse
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_GET, require_POST
+from rest_framework.utils.encoders import JSONEncoder
+from rest_framework.utils.urls import replace_query_param
+
+from .cache import cached_catalog_response
+from .db import get_read_alias, read_from_replica
+from .models import Booking, Product, Service, userPayment
+from .payments import payment_status_key
+from .search import get_search_backend, search_terms
+from .serializers import BookingReportSerializer, BookingSerializer, ProductSerializer, ServiceSerializer
+from .views import get_requested_product_fields, search_result
+
+PRODUCT_PAGE_SIZE = 50
+MAX_PRODUCT_PAGE_SIZE = 200
+SEARCH_PAGE_SIZE = 20
+MAX_SEARCH_PAGE_SIZE = 100
+MAX_PAYMENT_WAIT = 25  # seconds; below common proxy idle timeouts
+PAYMENT_POLL_INTERVAL = 0.5
+
+
+def json_response(data, status=200):
+    # DRF's encoder, so decimals and dates render exactly like the sync endpoints
+    return JsonResponse(data, status=status, encoder=JSONEncoder, safe=False)
+
+
+def page_size_param(request, default, maximum):
+    return min(max(int(request.GET.get('page_size', default)), 1), maximum)
+
+
+@cached_catalog_response('async-products')
+@require_GET
+@read_from_replica
+async def product_list(request):
+    try:
+        fields = get_requested_product_fields(request)
+    except ValueError as e:
+        return json_response({'error': str(e)}, status=400)
+    try:
+        after = int(request.GET.get('after', 0))
+        page_size = page_size_param(request, PRODUCT_PAGE_SIZE, MAX_PRODUCT_PAGE_SIZE)
+    except ValueError:
+        return json_response({'error': 'after and page_size must be integers'}, status=400)
+
+    # Keyset page on the primary key; one extra row tells whether there is a next page
+    products = Product.objects.only(*(fields or ProductSerializer.Meta.fields)).filter(id__gt=after).order_by('id')
+    page = [product async for product in products[:page_size + 1]]
+    has_next = len(page) > page_size
+    page = page[:page_size]
+
+    next_url = None
+    if has_next:
+        next_url = replace_query_param(request.build_absolute_uri(), 'after', page[-1].id)
+    return json_response({
+        'results': ProductSerializer(page, many=True, fields=fields).data,
+        'next': next_url,
+    })
+
+
+@cached_catalog_response('async-product')
+@require_GET
+@read_from_replica
+async def product_detail(request, pk):
+    product = await Product.objects.filter(pk=pk).afirst()
+    if product is None:
+        return json_response({'error': 'Product not found'}, status=404)
+    return json_response(ProductSerializer(product).data)
+
+
+@cached_catalog_response('async-search')
+@require_GET
+@read_from_replica
+async def product_search(request):
+    search_query = request.GET.get('search', '').strip()
+    category = request.GET.get('category', '').strip()
+
+    try:
+        page = max(int(request.GET.get('page', 1)), 1)
+        page_size = page_size_param(request, SEARCH_PAGE_SIZE, MAX_SEARCH_PAGE_SIZE)
+    except ValueError:
+        return json_response({'error': 'page and page_size must be integers'}, status=400)
+    offset = (page - 1) * page_size
+
+    if search_terms(search_query):
+        # The search backends run raw SQL, which has no async API
+        backend = get_search_backend(get_read_alias())
+        product_ids = await sync_to_async(backend.search)(
+            search_query, category=category or None, limit=page_size + 1, offset=offset
+        )
+    else:
+        products = Product.objects.all()
+        if category:
+            products = products.filter(category=category)
+        ids = products.order_by('id').values_list('id', flat=True)[offset:offset + page_size + 1]
+        product_ids = [pk async for pk in ids]
+
+    has_next = len(product_ids) > page_size
+    product_ids = product_ids[:page_size]
+
+    # Load the page and keep the ranking order from the index
+    products_by_id = await Product.objects.ain_bulk(product_ids)
+    products = [products_by_id[pk] for pk in product_ids if pk in products_by_id]
+
+    url = request.build_absolute_uri()
+    return json_response({
+        'results': [search_result(product) for product in products],
+        'page': page,
+        'next': replace_query_param(url, 'page', page + 1) if has_next else None,
+        'previous': replace_query_param(url, 'page', page - 1) if page > 1 else None,
+    })
+
+
+@require_GET
+@read_from_replica
+async def service_list(request):
+    services = [service async for service in Service.objects.order_by('id')]
+    return json_response(ServiceSerializer(services, many=True).data)
+
+
+@csrf_exempt
+@require_POST
+@read_from_replica  # a lookup, despite the POST
+async def booking_status(request):
+    if request.content_type == 'application/json':
+        try:
+            data = json.loads(request.body or b'{}')
+        except ValueError:
+            return json_response({'error': 'Invalid JSON body'}, status=400)
+    else:
+        data = request.POST
+    email = data.get('email')
+    mobile_number = data.get('mobile_number')
+
+    if not email or not mobile_number:
+        return json_response({'error': 'Both email and mobile number are required'}, status=400)
+
+    # Service and reports are loaded with the bookings: three queries however many bookings match
+    bookings = Booking.objects.filter(email=email, mobile_number=mobile_number).select_related(
+        'service').prefetch_related('reports').order_by('-created_at')
+    bookings = [booking async for booking in bookings]
+    if not bookings:
+        return json_response({'error': 'No bookings found with these details'}, status=404)
+
+    return json_response([{
+        'booking': BookingSerializer(booking).data,
+        'reports': BookingReportSerializer(booking.reports.all(), many=True).data,
+    } for booking in bookings])
+
+
+@require_GET
+async def payment_status(request, transaction_uuid):
+    """Status of a payment; with ?wait=<seconds> a PENDING payment is held open until it settles.
+
+    Waiting costs no thread under ASGI: the loop sleeps between cache reads and
+    reads the database again only once the payment has settled or the wait is over.
+    No login is needed, so only the status is returned, not what was paid for.
+    """
+    try:
+        wait = min(max(float(request.GET.get('wait', 0)), 0), MAX_PAYMENT_WAIT)
+    except ValueError:
+        return json_response({'error': 'wait must be a number of seconds'}, status=400)
+
+    payments = userPayment.objects.filter(transaction_uuid=transaction_uuid).values('status')
+    payment = await payments.afirst()
+    if payment is None:
+        return json_response({'error': 'Payment not found'}, status=404)
+
+    deadline = time.monotonic() + wait
+    while payment['status'] == 'PENDING' and time.monotonic() < deadline:
+        await asyncio.sleep(min(PAYMENT_POLL_INTERVAL, max(deadline - time.monotonic(), 0)))
+        if await cache.aget(payment_status_key(transaction_uuid)) or time.monotonic() >= deadline:
+            payment = await payments.afirst()
+
+    return json_response({'transaction_uuid': transaction_uuid, **payment})
@@ -0,0 +1,120 @@
+"""Free appointment slots of a service, from its weekly schedule and the bookings already made.
+
+A ServiceSchedule row gives a service's working hours on one weekday, cut into
+slots of slot_minutes that each take up to `capacity` bookings. A service
+without any schedule keeps the old rule: any time, one booking per time (and
+no slots to list).
+
+Which slots of a day still have room is cached per service-day as a bitmap
+(bit i set: slot i of that day is free), stored with the day's slot layout so a
+changed schedule never reads an old bitmap. Days not in the cache are computed
+together with one grouped range query over their bookings. Saving or deleting
+a booking drops its day, and the day it was moved from, once committed (see
+signals.py); the timeout bounds how long a bitmap computed while a booking was
+being made can stay stale. The bitmaps only feed the availability endpoint:
+BookingCreateView and the booking admin check the slot again with the service
+locked and give the booking a seat below the slot's capacity; a unique
+constraint on the seat keeps a slot from being overbooked even where the lock
+does nothing.
+"""
+from datetime import date, datetime, timedelta
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Count
+
+from .models import Booking
+
+
+class SlotUnavailable(Exception):
+    pass
+
+
+def get_cache_timeout():
+    return getattr(settings, 'AVAILABILITY_CACHE_TIMEOUT', 10 * 60)
+
+
+def day_key(service_id, day):
+    # str() rather than isoformat(): a booking created with a date string still has the string
+    return f"availability:{service_id}:{day}"
+
+
+def invalidate_day(service_id, day):
+    cache.delete(day_key(service_id, day))
+
+
+def weekly_slots(schedules):
+    """{weekday: [(start time, capacity), ...]} from a service's ServiceSchedule rows, in time order."""
+    slots = {}
+    for schedule in schedules:
+        start = datetime.combine(date.min, schedule.opens_at)
+        end = datetime.combine(date.min, schedule.closes_at)
+        step = timedelta(minutes=schedule.slot_minutes)
+        day = slots.setdefault(schedule.weekday, {})
+        while start + step <= end:
+            day[start.time()] = schedule.capacity
+            start += step
+    return {weekday: sorted(day.items()) for weekday, day in slots.items()}
+
+
+def layout(slots):
+    return ','.join(f"{start:%H:%M}x{capacity}" for start, capacity in slots)
+
+
+def booked_counts(service, days):
+    """{(date, time): bookings holding that slot} for the days from the first to the last of `days`."""
+    counts = Booking.objects.filter(
+        service=service, booking_date__range=(min(days), max(days))
+    ).exclude(status='cancelled').values_list('booking_date', 'appointment_time').annotate(taken=Count('id')).order_by()
+    return {(booking_date, appointment_time): taken for booking_date, appointment_time, taken in counts}
+
+
+def free_slots(service, start, end):
+    """{date: [free slot start times]} for every day from `start` to `end`, both included."""
+    weekly = weekly_slots(service.schedules.all())
+    days = [start + timedelta(days=offset) for offset in range((end - start).days + 1)]
+    keys = {day: day_key(service.pk, day) for day in days if weekly.get(day.weekday())}
+
+    bitmaps = {}
+    cached = cache.get_many(keys.values())
+    for day, key in keys.items():
+        entry = cached.get(key)
+        if entry and entry[0] == layout(weekly[day.weekday()]):
+            bitmaps[day] = entry[1]
+
+    missing = [day for day in keys if day not in bitmaps]
+    if missing:
+        taken = booked_counts(service, missing)
+        fresh = {}
+        for day in missing:
+            slots = weekly[day.weekday()]
+            bitmaps[day] = sum(1 << i for i, (slot, capacity) in enumerate(slots)
+                               if taken.get((day, slot), 0) < capacity)
+            fresh[keys[day]] = (layout(slots), bitmaps[day])
+        cache.set_many(fresh, get_cache_timeout())
+
+    return {day: [slot for i, (slot, _) in enumerate(weekly.get(day.weekday(), [])) if bitmaps[day] >> i & 1]
+            for day in days}
+
+
+def check_slot(service, day, appointment_time):
+    """The free seat a new booking of `service` at that time takes; raises SlotUnavailable when it is full.
+
+    Run it inside transaction.atomic() with the service row locked, so two
+    bookings do not both take the last place in a slot. Where the lock does
+    nothing (SQLite), the unique_booking_seat constraint still refuses a second
+    booking of the same seat with IntegrityError.
+    """
+    schedules = list(service.schedules.all())
+    capacity = 1
+    if schedules:
+        capacity = dict(weekly_slots(schedules).get(day.weekday(), [])).get(appointment_time)
+        if capacity is None:
+            raise SlotUnavailable(f"{service.name} has no appointment at {appointment_time:%H:%M} on {day:%A}s")
+
+    taken = set(Booking.objects.filter(service=service, booking_date=day, appointment_time=appointment_time).exclude(
+        status='cancelled').values_list('seat', flat=True))
+    free = [seat for seat in range(capacity) if seat not in taken]
+    if not free:
+        raise SlotUnavailable('This time slot is already booked')
+    return free[0]
@@ -0,0 +1,164 @@
+"""Read-through cache for catalog responses (product list, detail and search).
+
+Cached entries are keyed by a catalog version number. Any Product save or delete
+bumps the version (see signals.py), so stale entries are never read again and
+simply expire. Entries hold the already rendered response body, and an ETag
+derived from it lets clients revalidate with If-None-Match and get a 304.
+"""
+import hashlib
+import time
+from functools import wraps
+
+from asgiref.sync import iscoroutinefunction, sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+from django.http import HttpResponse, HttpResponseNotModified
+
+CATALOG_VERSION_KEY = 'catalog:version'
+CATALOG_BUMPED_AT_KEY = 'catalog:bumped_at'
+STATS_KEYS = {
+    'hits': 'catalog:stats:hits',
+    'misses': 'catalog:stats:misses',
+    'not_modified': 'catalog:stats:not_modified',
+}
+
+
+def get_cache():
+    return caches[getattr(settings, 'CATALOG_CACHE_ALIAS', 'default')]
+
+
+def get_cache_timeout():
+    return getattr(settings, 'CATALOG_CACHE_TIMEOUT', 60 * 60)
+
+
+def get_version(key):
+    """A version counter shared by all processes through the cache."""
+    cache = get_cache()
+    version = cache.get(key)
+    if version is None:
+        # Seed from the clock so a flushed cache never reuses an old version number
+        cache.add(key, int(time.time() * 1000), None)
+        version = cache.get(key)
+    return version
+
+
+def bump_version(key):
+    cache = get_cache()
+    try:
+        return cache.incr(key)
+    except ValueError:
+        get_version(key)
+        return cache.incr(key)
+
+
+def get_catalog_version():
+    return get_version(CATALOG_VERSION_KEY)
+
+
+def bump_catalog_version():
+    get_cache().set(CATALOG_BUMPED_AT_KEY, time.time(), None)
+    return bump_version(CATALOG_VERSION_KEY)
+
+
+def replica_may_lag():
+    """True right after a catalog change while a read replica may not have it yet.
+
+    Responses rendered then are served but not cached, so a lagging replica can
+    not put stale data in the cache under the new version.
+    """
+    if getattr(settings, 'READ_REPLICA_ALIAS', None) is None:
+        return False
+    bumped_at = get_cache().get(CATALOG_BUMPED_AT_KEY)
+    return bumped_at is not None and time.time() - bumped_at < getattr(settings, 'READ_REPLICA_PIN_SECONDS', 10)
+
+
+def record(stat):
+    cache = get_cache()
+    try:
+        cache.incr(STATS_KEYS[stat])
+    except ValueError:
+        cache.add(STATS_KEYS[stat], 0, None)
+        cache.incr(STATS_KEYS[stat])
+
+
+def get_cache_stats():
+    cache = get_cache()
+    values = cache.get_many(STATS_KEYS.values())
+    stats = {stat: values.get(key, 0) for stat, key in STATS_KEYS.items()}
+    lookups = stats['hits'] + stats['misses'] + stats['not_modified']
+    stats['hit_ratio'] = round((stats['hits'] + stats['not_modified']) / lookups, 4) if lookups else None
+    stats['catalog_version'] = get_catalog_version()
+    return stats
+
+
+def etag_matches(request, etag):
+    if_none_match = request.headers.get('If-None-Match', '')
+    return etag in [tag.strip() for tag in if_none_match.split(',')] or if_none_match.strip() == '*'
+
+
+def lookup_cached_response(request, prefix):
+    """Return (cache key, cached response or None) for a catalog GET request."""
+    cache = get_cache()
+    # Scheme and host too: the cached bodies hold absolute next/previous URLs
+    path_key = hashlib.md5(request.build_absolute_uri().encode()).hexdigest()
+    key = f"catalog:{get_catalog_version()}:{prefix}:{path_key}"
+
+    entry = cache.get(key)
+    if entry is None:
+        record('misses')
+        return key, None
+
+    body, content_type, etag = entry
+    if etag_matches(request, etag):
+        record('not_modified')
+        return key, HttpResponseNotModified(headers={'ETag': etag})
+    record('hits')
+    return key, HttpResponse(body, content_type=content_type, headers={'ETag': etag})
+
+
+def store_response(request, key, response):
+    """Cache a freshly rendered catalog response and tag it with its ETag."""
+    if response.status_code != 200 or replica_may_lag():
+        return response
+    if hasattr(response, 'render'):
+        response.render()
+
+    etag = f'"{hashlib.md5(response.content).hexdigest()}"'
+    get_cache().set(key, (response.content, response['Content-Type'], etag), get_cache_timeout())
+    response['ETag'] = etag
+    if etag_matches(request, etag):
+        return HttpResponseNotModified(headers={'ETag': etag})
+    return response
+
+
+def cached_catalog_response(prefix):
+    """Cache successful GET responses of a catalog view under the current catalog version.
+
+    Wrap the outermost view callable (above @api_view, or on dispatch for class
+    based views) so the DRF response is already finalized and can be rendered.
+    Works for async views too.
+    """
+    def decorator(view_func):
+        if iscoroutinefunction(view_func):
+            @wraps(view_func)
+            async def async_wrapper(request, *args, **kwargs):
+                if request.method != 'GET':
+                    return await view_func(request, *args, **kwargs)
+                key, cached = await sync_to_async(lookup_cached_response)(request, prefix)
+                if cached is not None:
+                    return cached
+                response = await view_func(request, *args, **kwargs)
+                return await sync_to_async(store_response)(request, key, response)
+            return async_wrapper
+
+        @wraps(view_func)
+        def wrapper(request, *args, **kwargs):
+            if request.method != 'GET':
+                return view_func(request, *args, **kwargs)
+            key, cached = lookup_cached_response(request, prefix)
+            if cached is not None:
+                return cached
+            return store_response(request, key, view_func(request, *args, **kwargs))
+
+        return wrapper
+    return decorator
@@ -0,0 +1,191 @@
+"""Database connection setup and read replica routing."""
+from contextvars import ContextVar
+from functools import wraps
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS
+
+# PRAGMA names we accept from settings; values are interpolated, so keep both strict
+SQLITE_PRAGMA_NAMES = {'journal_mode', 'synchronous', 'busy_timeout', 'mmap_size', 'cache_size', 'temp_store'}
+
+
+# Stored in the database file rather than per connection, so set once per database
+PERSISTENT_SQLITE_PRAGMAS = {'journal_mode'}
+_persistent_pragmas = {}  # (database name, pragma) -> value already set
+
+
+def configure_sqlite(sender, connection, **kwargs):
+    """connection_created handler applying settings.SQLITE_PRAGMAS to new SQLite connections.
+
+    journal_mode only runs on the first connection to each database, or when its value changes.
+    """
+    if connection.vendor != 'sqlite':
+        return
+    with connection.cursor() as cursor:
+        for name, value in getattr(settings, 'SQLITE_PRAGMAS', {}).items():
+            if name not in SQLITE_PRAGMA_NAMES or not str(value).lstrip('-').isalnum():
+                raise ValueError(f"Unsupported SQLite pragma {name}={value}")
+            key = (connection.settings_dict['NAME'], name)
+            if name in PERSISTENT_SQLITE_PRAGMAS and _persistent_pragmas.get(key) == str(value):
+                continue
+            cursor.execute(f"PRAGMA {name} = {value}")
+            if name in PERSISTENT_SQLITE_PRAGMAS:
+                _persistent_pragmas[key] = str(value)
+
+
+# Read replica ------------------------------------------------------------------
+#
+# Read-only endpoints decorated with @read_from_replica run their queries on
+# settings.READ_REPLICA_ALIAS; everything else, and every write, uses 'default'.
+# A replica lags behind the primary, so a client that just wrote something is
+# pinned to the primary for READ_REPLICA_PIN_SECONDS (by cookie, and by user id
+# for token authenticated clients) and sees its own writes.
+#
+# To try it locally with two SQLite files, copy db.sqlite3 to replica.sqlite3 and
+# start the server with DB_REPLICA_NAME=replica.sqlite3. Writes will not reach the
+# copy, which makes the replica lag easy to observe.
+
+PIN_COOKIE = 'pin_primary'
+
+_read_alias = ContextVar('read_alias', default=None)
+
+
+def get_replica_alias():
+    return getattr(settings, 'READ_REPLICA_ALIAS', None)
+
+
+def get_read_alias():
+    """The database the current request reads from."""
+    return _read_alias.get() or DEFAULT_DB_ALIAS
+
+
+def pin_key(user_id):
+    return f'replica:pin:{user_id}'
+
+
+def get_pin_seconds():
+    return getattr(settings, 'READ_REPLICA_PIN_SECONDS', 10)
+
+
+def is_pinned_to_primary(request):
+    if PIN_COOKIE in request.COOKIES:
+        return True
+    user = getattr(request, 'user', None)
+    return bool(user and user.is_authenticated and cache.get(pin_key(user.pk)))
+
+
+def read_from_replica(view_func):
+    """Run a read-only view against the read replica, unless the client is pinned to the primary.
+
+    Put it below @api_view (or use method_decorator on the handler) so request.user
+    is the token authenticated user. Works for async views too.
+    """
+    if iscoroutinefunction(view_func):
+        @wraps(view_func)
+        async def async_wrapper(request, *args, **kwargs):
+            alias = get_replica_alias()
+            if alias is None or await sync_to_async(is_pinned_to_primary)(request):
+                return await view_func(request, *args, **kwargs)
+            token = _read_alias.set(alias)
+            try:
+                return await view_func(request, *args, **kwargs)
+            finally:
+                _read_alias.reset(token)
+        return async_wrapper
+
+    @wraps(view_func)
+    def wrapper(request, *args, **kwargs):
+        alias = get_replica_alias()
+        if alias is None or is_pinned_to_primary(request):
+            return view_func(request, *args, **kwargs)
+        token = _read_alias.set(alias)
+        try:
+            return view_func(request, *args, **kwargs)
+        finally:
+            _read_alias.reset(token)
+    return wrapper
+
+
+class ReadReplicaRouter:
+    def db_for_read(self, model, **hints):
+        return _read_alias.get()
+
+    def db_for_write(self, model, **hints):
+        # Also for instances that were read from the replica
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        databases = {DEFAULT_DB_ALIAS, get_replica_alias()}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+
+# Writes to the primary made while serving the current request; None outside of
+# ReplicaPinningMiddleware. A list, so queries run by sync_to_async threads append to it too.
+_request_writes = ContextVar('request_writes', default=None)
+
+
+def record_write(execute, sql, params, many, context):
+    writes = _request_writes.get()
+    if writes is not None and sql.lstrip()[:6].upper() in ('INSERT', 'UPDATE', 'DELETE'):
+        writes.append(sql)
+    return execute(sql, params, many, context)
+
+
+def track_writes(sender, connection, **kwargs):
+    """connection_created handler installing record_write on connections to the primary."""
+    if connection.alias == DEFAULT_DB_ALIAS:
+        connection.execute_wrappers.append(record_write)
+
+
+def pin_to_primary(request, response):
+    seconds = get_pin_seconds()
+    response.set_cookie(PIN_COOKIE, '1', max_age=seconds, httponly=True, samesite='Lax')
+    # DRF sets the token authenticated user on the underlying request
+    user = getattr(request, 'user', None)
+    if user and user.is_authenticated:
+        cache.set(pin_key(user.pk), True, seconds)
+
+
+class ReplicaPinningMiddleware:
+    """Pin a client to the primary database for a while after a request of theirs wrote to it."""
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        if get_replica_alias() is None:
+            return self.get_response(request)
+
+        writes = []
+        token = _request_writes.set(writes)
+        try:
+            response = self.get_response(request)
+        finally:
+            _request_writes.reset(token)
+        if writes:
+            pin_to_primary(request, response)
+        return response
+
+    async def __acall__(self, request):
+        if get_replica_alias() is None:
+            return await self.get_response(request)
+
+        writes = []
+        token = _request_writes.set(writes)
+        try:
+            response = await self.get_response(request)
+        finally:
+            _request_writes.reset(token)
+        if writes:
+            await sync_to_async(pin_to_primary)(request, response)
+        return response
@@ -0,0 +1,163 @@
+"""A local stand-in for the eSewa ePay v2 API, for tests and load benchmarks.
+
+    with FakeEsewa() as esewa, override_settings(ESEWA_STATUS_URL=esewa.status_url):
+        esewa.complete('txn-1', '110.00')
+        get_gateway().check_status('txn-1', '110.00')  # 'COMPLETE'
+
+It serves the payment form endpoint (checks the signature and records the
+transaction as PENDING) and the transaction status endpoint, and builds the
+signed `data` eSewa sends back with the user (callback_data()). Signatures are
+checked with its own HMAC, not EsewaGateway's, so a signing bug shows up.
+`latency` delays every answer and `fail_next` answers the next requests with
+a 503, to exercise timeouts and retries.
+"""
+import base64
+import hashlib
+import hmac
+import json
+import threading
+import time
+from decimal import Decimal, InvalidOperation
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+FORM_PATH = '/api/epay/main/v2/form'
+STATUS_PATH = '/api/epay/transaction/status/'
+
+
+class FakeEsewa:
+    def __init__(self, secret_key='8gBm/:&EnhH.1/q', product_code='EPAYTEST', latency=0):
+        self.secret_key = secret_key
+        self.product_code = product_code
+        self.latency = latency
+        self.fail_next = 0
+        self.requests = 0
+        self.transactions = {}  # transaction_uuid -> {'total_amount': Decimal, 'status': str}
+        self.lock = threading.Lock()
+        self.server = None
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server.server_port}"
+
+    @property
+    def form_url(self):
+        return self.url + FORM_PATH
+
+    @property
+    def status_url(self):
+        return self.url + STATUS_PATH
+
+    def start(self):
+        esewa = self
+
+        class Handler(EsewaRequestHandler):
+            fake = esewa
+
+        self.server = FakeEsewaServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def complete(self, transaction_uuid, total_amount, status='COMPLETE'):
+        """Record the outcome the user reached on eSewa for a transaction."""
+        with self.lock:
+            self.transactions[transaction_uuid] = {'total_amount': Decimal(str(total_amount)), 'status': status}
+
+    def callback_data(self, transaction_uuid, total_amount, status='COMPLETE', transaction_code='000TEST'):
+        """The signed base64 `data` eSewa appends to the success URL after a payment."""
+        fields = {
+            'transaction_code': transaction_code,
+            'status': status,
+            'total_amount': str(total_amount),
+            'transaction_uuid': transaction_uuid,
+            'product_code': self.product_code,
+            'signed_field_names': 'transaction_code,status,total_amount,transaction_uuid,product_code,signed_field_names',
+        }
+        fields['signature'] = self.signature(fields, fields['signed_field_names'])
+        return base64.b64encode(json.dumps(fields).encode()).decode()
+
+    def signature(self, fields, field_names):
+        message = ','.join(f"{name}={fields.get(name, '')}" for name in field_names.split(','))
+        return base64.b64encode(hmac.new(self.secret_key.encode(), message.encode(), hashlib.sha256).digest()).decode()
+
+    def submit_form(self, fields):
+        """Handle a posted payment form; returns (HTTP status, JSON body)."""
+        if not hmac.compare_digest(self.signature(fields, fields.get('signed_field_names', '')),
+                                   fields.get('signature', '')):
+            return 400, {'error': 'Invalid signature'}
+        if fields.get('product_code') != self.product_code:
+            return 400, {'error': 'Unknown product code'}
+        self.complete(fields['transaction_uuid'], fields['total_amount'], status='PENDING')
+        return 200, {'transaction_uuid': fields['transaction_uuid'], 'status': 'PENDING'}
+
+    def transaction_status(self, params):
+        with self.lock:
+            transaction = self.transactions.get(params.get('transaction_uuid'))
+        try:
+            amount_matches = transaction and transaction['total_amount'] == Decimal(params.get('total_amount', ''))
+        except InvalidOperation:
+            amount_matches = False
+        return 200, {
+            'product_code': params.get('product_code'),
+            'transaction_uuid': params.get('transaction_uuid'),
+            'total_amount': params.get('total_amount'),
+            'status': transaction['status'] if amount_matches else 'NOT_FOUND',
+            'ref_id': None,
+        }
+
+
+class FakeEsewaServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128  # load benchmarks open many connections at once
+
+
+class EsewaRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive, like the real API
+    # Headers and body are separate writes; with Nagle on, keep-alive clients wait for a delayed ACK
+    disable_nagle_algorithm = True
+    fake = None
+
+    def do_GET(self):
+        parts = urlsplit(self.path)
+        if parts.path != STATUS_PATH:
+            return self.respond(404, {'error': 'Not found'})
+        self.respond(*self.answer(self.fake.transaction_status, dict(parse_qsl(parts.query))))
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0))).decode()
+        if urlsplit(self.path).path != FORM_PATH:
+            return self.respond(404, {'error': 'Not found'})
+        self.respond(*self.answer(self.fake.submit_form, dict(parse_qsl(body))))
+
+    def answer(self, handler, params):
+        fake = self.fake
+        with fake.lock:
+            fake.requests += 1
+            failing = fake.fail_next > 0
+            fake.fail_next -= failing
+        if fake.latency:
+            time.sleep(fake.latency)
+        if failing:
+            return 503, {'error': 'Service unavailable'}
+        return handler(params)
+
+    def respond(self, status, data):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
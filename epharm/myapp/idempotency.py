@@ -0,0 +1,69 @@
+from datetime import timedelta
+from functools import wraps
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from rest_framework import status
+from rest_framework.response import Response
+
+from .models import IdempotencyKey
+
+
+def get_key_ttl():
+    return timedelta(seconds=getattr(settings, 'IDEMPOTENCY_KEY_TTL', 24 * 60 * 60))
+
+
+def purge_expired_keys(now=None):
+    """Delete keys older than IDEMPOTENCY_KEY_TTL; returns how many were deleted."""
+    deleted, _ = IdempotencyKey.objects.filter(created_at__lt=(now or timezone.now()) - get_key_ttl()).delete()
+    return deleted
+
+
+def idempotent(endpoint):
+    """Make a DRF view safe to retry with an Idempotency-Key header.
+
+    The first request with a given key runs the view inside a transaction that
+    also claims the key; its successful response is stored and replayed for any
+    later request with the same key, without running the view again. Failed
+    responses roll the transaction back, which frees the key for another try.
+    A key is remembered for IDEMPOTENCY_KEY_TTL; after that it counts as new.
+    Requests without the header run as before. Put it below @api_view.
+    """
+    def decorator(view_func):
+        @wraps(view_func)
+        def wrapper(request, *args, **kwargs):
+            key = request.headers.get('Idempotency-Key')
+            if not key or not request.user.is_authenticated:
+                return view_func(request, *args, **kwargs)
+            if len(key) > 255:
+                return Response({'error': 'Idempotency-Key is too long'}, status=status.HTTP_400_BAD_REQUEST)
+
+            with transaction.atomic():
+                try:
+                    with transaction.atomic():
+                        record = IdempotencyKey.objects.create(user=request.user, endpoint=endpoint, key=key)
+                except IntegrityError:
+                    record = IdempotencyKey.objects.get(user=request.user, endpoint=endpoint, key=key)
+                    if record.created_at >= timezone.now() - get_key_ttl():
+                        if record.response_code is None:
+                            return Response({'error': 'A request with this Idempotency-Key is still in progress'},
+                                            status=status.HTTP_409_CONFLICT)
+                        return Response(record.response_body, status=record.response_code,
+                                        headers={'Idempotent-Replayed': 'true'})
+                    # Expired but not purged yet: the key starts over with this request
+                    record.created_at = timezone.now()
+                    record.response_code = record.response_body = None
+                    record.save(update_fields=['created_at', 'response_code', 'response_body'])
+
+                response = view_func(request, *args, **kwargs)
+                if status.is_success(response.status_code):
+                    record.response_code = response.status_code
+                    record.response_body = response.data
+                    record.save(update_fields=['response_code', 'response_body'])
+                else:
+                    transaction.set_rollback(True)
+                return response
+
+        return wrapper
+    return decorator
@@ -0,0 +1,166 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, F, IntegerField, Q, Sum, When
+from django.utils import timezone
+
+from .cache import bump_catalog_version
+from .models import Order, Product, StockReservation
+
+
+class InsufficientStock(Exception):
+    def __init__(self, product, requested):
+        self.product = product
+        self.requested = requested
+        super().__init__(f"Not enough stock for {product.name}.")
+
+
+class ProductNotFound(Exception):
+    def __init__(self, product_ids):
+        self.product_ids = product_ids
+        super().__init__(f"Products not found: {', '.join(str(pk) for pk in product_ids)}")
+
+
+def merge_quantities(lines):
+    """Turn [{'id': 1, 'quantity': 2}, {'id': 1, 'quantity': 1}] into {1: 3}."""
+    quantities = {}
+    for line in lines:
+        quantity = int(line['quantity'])
+        if quantity <= 0:
+            raise ValueError("Quantities must be positive.")
+        quantities[int(line['id'])] = quantities.get(int(line['id']), 0) + quantity
+    return quantities
+
+
+def get_reservation_ttl():
+    return timedelta(seconds=getattr(settings, 'STOCK_RESERVATION_TTL', 15 * 60))
+
+
+def held_quantities(product_ids, exclude_order=None):
+    """{product_id: quantity} held by active, unexpired reservations, in one query."""
+    holds = StockReservation.objects.filter(
+        product_id__in=product_ids, status=StockReservation.ACTIVE, expires_at__gt=timezone.now()
+    )
+    if exclude_order is not None:
+        holds = holds.exclude(order=exclude_order)
+    return dict(holds.values('product_id').annotate(held=Sum('quantity')).values_list('product_id', 'held'))
+
+
+def lock_products(quantities, exclude_order=None):
+    """Lock the products of {product_id: quantity} and check they are available.
+
+    Must run inside transaction.atomic(). Available means stock minus what other
+    orders currently hold (`exclude_order`'s own holds do not count against it).
+    Returns {product_id: Product} as read under the lock.
+    Raises ProductNotFound or InsufficientStock.
+    """
+    products = Product.objects.select_for_update().only('id', 'name', 'price', 'stock').in_bulk(quantities.keys())
+
+    missing = [pk for pk in quantities if pk not in products]
+    if missing:
+        raise ProductNotFound(missing)
+
+    held = held_quantities(quantities.keys(), exclude_order)
+    for pk, quantity in quantities.items():
+        if products[pk].stock - held.get(pk, 0) < quantity:
+            raise InsufficientStock(products[pk], quantity)
+    return products
+
+
+def take_stock(quantities, order=None):
+    """Decrement stock for {product_id: quantity} as one locked, set-based operation.
+
+    Must run inside transaction.atomic(). The rows are locked with a single
+    SELECT ... FOR UPDATE, then decremented by one UPDATE whose WHERE clause
+    re-checks stock >= quantity for every row, so concurrent checkouts can never
+    drive stock below zero (also on SQLite, where FOR UPDATE is a no-op).
+    Stock held for other orders is not taken; pass `order` when taking the
+    stock that order itself holds.
+    Returns {product_id: Product} as read under the lock.
+    Raises ProductNotFound or InsufficientStock; the caller's transaction should
+    then be rolled back.
+    """
+    products = lock_products(quantities, exclude_order=order)
+
+    # Group products by quantity so the statement stays small for large carts:
+    # UPDATE ... SET stock = CASE WHEN id IN (..) THEN stock - 1 WHEN id IN (..) THEN stock - 2 ... END
+    # WHERE (id IN (..) AND stock >= 1) OR (id IN (..) AND stock >= 2) ...
+    by_quantity = {}
+    for pk, quantity in quantities.items():
+        by_quantity.setdefault(quantity, []).append(pk)
+
+    guard = Q()
+    for quantity, pks in by_quantity.items():
+        guard |= Q(id__in=pks, stock__gte=quantity)
+
+    updated = Product.objects.filter(guard).update(stock=Case(
+        *[When(id__in=pks, then=F('stock') - quantity) for quantity, pks in by_quantity.items()],
+        output_field=IntegerField(),
+    ))
+    if updated != len(quantities):
+        # Someone else took the stock between our read and our write
+        stock = dict(Product.objects.filter(id__in=quantities.keys()).values_list('id', 'stock'))
+        for pk, quantity in quantities.items():
+            if stock.get(pk, 0) < quantity:
+                raise InsufficientStock(products[pk], quantity)
+
+    # Bulk updates skip model signals, so invalidate cached catalog responses ourselves
+    transaction.on_commit(bump_catalog_version)
+    return products
+
+
+def hold_stock(order, quantities, ttl=None):
+    """Reserve {product_id: quantity} for `order` until it is paid, without taking the stock.
+
+    Call it after lock_products() in the same transaction. Returns the expiry time.
+    """
+    expires_at = timezone.now() + (ttl or get_reservation_ttl())
+    StockReservation.objects.bulk_create([
+        StockReservation(order=order, product_id=pk, quantity=quantity, expires_at=expires_at)
+        for pk, quantity in quantities.items()
+    ])
+    return expires_at
+
+
+def commit_reservations(order):
+    """Take the stock held for `order` (its payment succeeded).
+
+    Must run inside transaction.atomic(). Holds that were already released or
+    expired are taken too if the stock is still available, otherwise
+    InsufficientStock is raised. Committing twice does nothing.
+    """
+    holds = StockReservation.objects.filter(order=order).exclude(status=StockReservation.COMMITTED)
+    quantities = {}
+    for pk, quantity in holds.values_list('product_id', 'quantity'):
+        quantities[pk] = quantities.get(pk, 0) + quantity
+    if not quantities:
+        return {}
+
+    products = take_stock(quantities, order=order)
+    holds.update(status=StockReservation.COMMITTED)
+    return products
+
+
+def order_awaiting_payment(user):
+    """`user`'s latest order whose stock holds were not taken yet: the online order a new payment is for."""
+    return Order.objects.filter(user=user, status='pending').exclude(reservations=None).exclude(
+        reservations__status=StockReservation.COMMITTED).order_by('-id').first()
+
+
+def release_reservations(order):
+    """Give back the stock held for `order` (its payment failed or was abandoned)."""
+    return StockReservation.objects.filter(order=order, status=StockReservation.ACTIVE).update(
+        status=StockReservation.RELEASED
+    )
+
+
+def release_expired_reservations(now=None):
+    """Mark every expired hold as released; returns how many were released.
+
+    Expired holds already stop counting against available stock, this only
+    keeps the active set (and its partial indexes) small.
+    """
+    return StockReservation.objects.filter(
+        status=StockReservation.ACTIVE, expires_at__lte=now or timezone.now()
+    ).update(status=StockReservation.RELEASED)
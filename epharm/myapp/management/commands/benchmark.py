@@ -0,0 +1,400 @@
+import base64
+import hashlib
+import hmac
+import json
+import os
+import statistics
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.contrib import admin
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import OperationalError, connection, connections, reset_queries, transaction
+from django.test import RequestFactory, override_settings
+from django.test.utils import CaptureQueriesContext
+from rest_framework.pagination import Cursor
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from myapp.cache import bump_catalog_version
+from myapp.fake_esewa import FakeEsewa
+from myapp.models import Cart, CartItem, Order, Product, userPayment
+from myapp import views
+from myapp.pagination import ProductCursorPagination
+from myapp.payments import EsewaGateway
+from myapp.serializers import OrderSerializer, with_order_items
+from myapp.search import IcontainsSearchBackend, get_search_backend
+from myapp.suggest import SuggestionIndex
+
+
+STEMS = ['paracet', 'amoxi', 'azithro', 'pantopra', 'ibupro', 'cetiri', 'metfor', 'losar', 'atorva',
+         'omepra', 'cipro', 'doxy', 'levocet', 'montelu', 'raniti', 'diclo', 'aceclo', 'rosuva',
+         'telmi', 'amlodi', 'clopido', 'glimepi', 'sitaglip', 'vitamin', 'zinco', 'calci', 'ferro']
+SUFFIXES = ['mol', 'cillin', 'mycin', 'zole', 'fen', 'zine', 'min', 'tan', 'statin', 'floxacin',
+            'cycline', 'kast', 'dine', 'nac', 'pril', 'pine', 'grel', 'ride', 'tin', 'plex']
+STRENGTHS = [5, 10, 20, 25, 40, 50, 100, 250, 500, 650, 1000]
+
+
+def seed_products(count, start=0):
+    """Insert `count` products with varied, drug-like names so searches are selective."""
+    products = []
+    for i in range(start, start + count):
+        stem = STEMS[i % len(STEMS)]
+        suffix = SUFFIXES[(i // len(STEMS)) % len(SUFFIXES)]
+        strength = STRENGTHS[(i // 7) % len(STRENGTHS)]
+        products.append(Product(
+            name=f"{stem.title()}{suffix} {strength}mg SKU{i}",
+            generic_name=f"{stem}{suffix}",
+            category=Product.CATEGORIES[i % len(Product.CATEGORIES)][0],
+            description=f"{stem}{suffix} tablets {strength} mg, pack {i % 30 + 1}",
+            price=10 + (i % 500),
+            stock=100,
+        ))
+    Product.objects.bulk_create(products, batch_size=1000)
+
+
+def time_requests(view, path, repeat, cold=False, **kwargs):
+    """Call a view `repeat` times and return the per-request latencies in ms.
+
+    With cold=True the catalog cache version is bumped before every request so
+    each one goes to the database.
+    """
+    factory = APIRequestFactory()
+    timings = []
+    for _ in range(repeat):
+        if cold:
+            bump_catalog_version()
+        request = factory.get(path)
+        started = time.perf_counter()
+        response = view(request, **kwargs)
+        if hasattr(response, 'render'):
+            response.render()
+        timings.append((time.perf_counter() - started) * 1000)
+    return timings
+
+
+def summarize(timings):
+    timings = sorted(timings)
+    p95 = timings[min(len(timings) - 1, int(len(timings) * 0.95))]
+    return f"median {statistics.median(timings):8.2f} ms   p95 {p95:8.2f} ms"
+
+
+def product_cursor_url(after_id):
+    paginator = ProductCursorPagination()
+    paginator.base_url = '/api/products/'
+    return paginator.encode_cursor(Cursor(offset=0, reverse=False, position=str(after_id)))
+
+
+def benchmark_catalog(command, sizes, repeat):
+    """Latency of the first and a deep catalog page as the product table grows."""
+    seeded = 0
+    for size in sizes:
+        seed_products(size - seeded, start=seeded)
+        seeded = size
+
+        first_page = time_requests(views.getProducts, '/api/products/', repeat, cold=True)
+
+        # Jump straight to a page near the end of the catalog (or its start, for a small one)
+        deep_id = Product.objects.order_by('-id').values_list('id', flat=True)[min(100, size - 1)]
+        deep_page = time_requests(views.getProducts, product_cursor_url(deep_id), repeat, cold=True)
+        cached_page = time_requests(views.getProducts, product_cursor_url(deep_id), repeat)
+
+        command.stdout.write(f"{size:>8} products  first page:  {summarize(first_page)}")
+        command.stdout.write(f"{'':>8}           deep page:   {summarize(deep_page)}")
+        command.stdout.write(f"{'':>8}           cached page: {summarize(cached_page)}")
+
+
+def time_calls(func, repeat, *args, **kwargs):
+    """Call a function `repeat` times and return the per-call latencies in ms."""
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func(*args, **kwargs)
+        timings.append((time.perf_counter() - started) * 1000)
+    return timings
+
+
+def benchmark_search(command, sizes, repeat):
+    """Full-text index versus the old icontains scan as the product table grows."""
+    queries = ['paracetmol', 'amoxicillin 500', 'SKU4242', 'vitaminplex 1000mg']
+    engines = [IcontainsSearchBackend(), get_search_backend()]
+
+    seeded = 0
+    for size in sizes:
+        seed_products(size - seeded, start=seeded)
+        seeded = size
+        engines[1].rebuild()
+
+        command.stdout.write(f"{size:>8} products")
+        for engine in engines:
+            timings = []
+            for query in queries:
+                timings += time_calls(engine.search, repeat, query, limit=20)
+            command.stdout.write(f"{'':>8}  {type(engine).__name__:<24} {summarize(timings)}")
+
+
+def benchmark_suggest(command, sizes, repeat):
+    """Typo tolerant autocomplete from the in-memory index."""
+    queries = ['paracetmol', 'amoxicilin', 'azithromycn', 'vitam', 'zzzzzz']
+    index = SuggestionIndex()
+
+    seeded = 0
+    for size in sizes:
+        seed_products(size - seeded, start=seeded)
+        seeded = size
+
+        index.clear()
+        started = time.perf_counter()
+        index.load()
+        load_ms = (time.perf_counter() - started) * 1000
+
+        timings = []
+        for query in queries:
+            timings += time_calls(index.suggest, repeat, query)
+        command.stdout.write(f"{size:>8} products  {len(index.terms):>7} terms  "
+                             f"load {load_ms:8.1f} ms  suggest: {summarize(timings)}")
+
+
+def benchmark_orders(command, sizes, repeat):
+    """PlaceOrderView throughput (orders/sec) as the number of lines per order grows."""
+    user = get_user_model().objects.create_user(username='benchmark', email='benchmark@example.com', password='x')
+    seed_products(max(sizes))
+    product_ids = list(Product.objects.order_by('id').values_list('id', flat=True))
+    Product.objects.update(stock=10 ** 9)
+
+    factory = APIRequestFactory()
+    view = views.PlaceOrderView.as_view()
+    for cart_size in sizes:
+        cart_items = json.dumps([{'id': pk, 'quantity': 1} for pk in product_ids[:cart_size]])
+        timings = []
+        for _ in range(repeat):
+            request = factory.post('/api/order/place/', {'cart_items': cart_items, 'address': 'Benchmark'})
+            force_authenticate(request, user=user)
+            started = time.perf_counter()
+            response = view(request)
+            timings.append((time.perf_counter() - started) * 1000)
+            if response.status_code != 201:
+                raise CommandError(f"Order failed: {response.data}")
+
+        orders_per_second = 1000 / statistics.mean(timings)
+        command.stdout.write(f"{cart_size:>6} lines  {orders_per_second:8.1f} orders/s  {summarize(timings)}")
+
+
+def benchmark_order_list(command, sizes, repeat):
+    """Serializing a page of 100 orders x 5 lines with and without the line prefetch, and /api/orders/."""
+    user = get_user_model().objects.create_user(username='benchmark', email='benchmark@example.com', password='x')
+    seed_products(5)
+    product_ids = list(Product.objects.values_list('id', flat=True))
+
+    factory = APIRequestFactory()
+    view = views.OrderListView.as_view()
+    seeded = 0
+    for size in sizes:
+        orders = Order.objects.bulk_create([
+            Order(user=user, total_price=50, address='Benchmark') for _ in range(size - seeded)
+        ], batch_size=1000)
+        CartItem.objects.bulk_create([
+            CartItem(order=order, product_id=pk, quantity=1) for order in orders for pk in product_ids
+        ], batch_size=1000)
+        seeded = size
+
+        variants = [
+            ('per-object queries', lambda: OrderSerializer(Order.objects.order_by('-id')[:100], many=True).data),
+            ('prefetched', lambda: OrderSerializer(with_order_items(Order.objects.order_by('-id'))[:100], many=True).data),
+        ]
+        command.stdout.write(f"{size:>8} orders")
+        for label, serialize in variants:
+            reset_queries()
+            with CaptureQueriesContext(connection) as queries:
+                serialize()
+            command.stdout.write(f"{'':>8}  {label:<20} {len(queries):>4} queries  {summarize(time_calls(serialize, repeat))}")
+
+        def list_page():
+            request = factory.get('/api/orders/', {'page_size': 100})
+            force_authenticate(request, user=user)
+            view(request).render()
+        command.stdout.write(f"{'':>8}  {'GET /api/orders/':<20} {'':>12}  {summarize(time_calls(list_page, repeat))}")
+
+
+def benchmark_admin(command, sizes, repeat):
+    """Render time of the first page of the payment and cart item admin changelists."""
+    User = get_user_model()
+    admin_user = User.objects.create_superuser(username='benchmark', email='benchmark@example.com', password='x')
+    seed_products(50)
+    product_ids = list(Product.objects.values_list('id', flat=True))
+    factory = RequestFactory()
+
+    seeded = 0
+    for size in sizes:
+        users = User.objects.bulk_create([
+            User(username=f'buyer{i}', email=f'buyer{i}@example.com') for i in range(seeded, size)
+        ], batch_size=1000)
+        carts = Cart.objects.bulk_create([Cart(user=user) for user in users], batch_size=1000)
+        orders = Order.objects.bulk_create([
+            Order(user=user, total_price=100, address='Benchmark') for user in users
+        ], batch_size=1000)
+        userPayment.objects.bulk_create([
+            userPayment(user=user, order=order, amount=100, total_amount=100, transaction_uuid=f'bench-{user.username}',
+                        status='COMPLETE' if i % 3 else 'PENDING')
+            for i, (user, order) in enumerate(zip(users, orders))
+        ], batch_size=1000)
+        CartItem.objects.bulk_create([
+            CartItem(cart=cart, product_id=product_ids[i % len(product_ids)], quantity=1) for i, cart in enumerate(carts)
+        ], batch_size=1000)
+        seeded = size
+
+        command.stdout.write(f"{size:>8} payments / cart items")
+        for model, params in ((userPayment, {}), (userPayment, {'status__exact': 'PENDING'}), (CartItem, {})):
+            model_admin = admin.site._registry[model]
+
+            def render_page():
+                request = factory.get('/admin/', params)
+                request.user = admin_user
+                model_admin.changelist_view(request).render()
+
+            reset_queries()
+            with CaptureQueriesContext(connection) as queries:
+                render_page()
+            label = f"{model.__name__} {params or ''}"
+            command.stdout.write(f"{'':>8}  {label:<42} {len(queries):>4} queries  {summarize(time_calls(render_page, repeat))}")
+
+
+# SQLite PRAGMA profiles compared by the 'writes' benchmark
+SQLITE_PROFILES = {
+    'sqlite default (delete, full)': {'journal_mode': 'delete', 'synchronous': 'full', 'busy_timeout': 20000},
+    'sqlite tuned (wal, normal)': {'journal_mode': 'wal', 'synchronous': 'normal', 'busy_timeout': 20000,
+                                   'mmap_size': 128 * 1024 * 1024, 'cache_size': -16000},
+}
+
+
+def write_orders(user, product_ids, count, errors):
+    """Place `count` small orders, one transaction each, like PlaceOrderView does."""
+    try:
+        for _ in range(count):
+            try:
+                with transaction.atomic():
+                    order = Order.objects.create(user=user, total_price=30, address='Benchmark')
+                    CartItem.objects.bulk_create([
+                        CartItem(order=order, product_id=pk, quantity=1, unit_price=10, total_price=10)
+                        for pk in product_ids
+                    ])
+            except OperationalError:
+                errors.append(1)  # "database is locked"
+    finally:
+        connection.close()
+
+
+def benchmark_writes(command, sizes, repeat):
+    """Order write throughput with 1..n concurrent writers, per database profile."""
+    user = get_user_model().objects.create_user(username='benchmark', email='benchmark@example.com', password='x')
+    seed_products(3)
+    product_ids = list(Product.objects.values_list('id', flat=True))
+
+    profiles = SQLITE_PROFILES if connection.vendor == 'sqlite' else {connection.vendor: None}
+    for label, pragmas in profiles.items():
+        with override_settings(**({'SQLITE_PRAGMAS': pragmas} if pragmas else {})):
+            connections.close_all()  # reconnect with this profile
+            command.stdout.write(label)
+            for writers in sizes:
+                errors = []
+                threads = [threading.Thread(target=write_orders, args=(user, product_ids, repeat, errors))
+                           for _ in range(writers)]
+                started = time.perf_counter()
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+                elapsed = time.perf_counter() - started
+                written = writers * repeat - len(errors)
+                command.stdout.write(f"{writers:>8} writers  {written / elapsed:8.1f} orders/s  {len(errors)} lock errors")
+        connections.close_all()
+
+
+def benchmark_payments(command, sizes, repeat):
+    """eSewa form signing, and status checks/sec against the local fake eSewa with and without pooling."""
+    secret_key = '8gBm/:&EnhH.1/q'
+    values = {'total_amount': '110.0', 'transaction_uuid': 'benchmark-1', 'product_code': 'EPAYTEST'}
+
+    def sign_from_secret(values):
+        # What the views did before: re-encode the secret and key a new HMAC per signature
+        message = f"total_amount={values['total_amount']},transaction_uuid={values['transaction_uuid']},product_code=EPAYTEST"
+        return base64.b64encode(hmac.new(secret_key.encode(), message.encode(), hashlib.sha256).digest()).decode()
+
+    with FakeEsewa(secret_key=secret_key) as esewa:
+        esewa.complete('benchmark-1', '110.00')
+
+        def make_gateway(pool_size):
+            return EsewaGateway(secret_key, 'EPAYTEST', esewa.status_url, esewa.url, esewa.url, pool_size=pool_size)
+
+        gateway = make_gateway(max(sizes))
+        assert gateway.sign(values) == sign_from_secret(values)
+        for label, sign in (('sign, key per call', sign_from_secret), ('sign, precomputed key', gateway.sign)):
+            timings = time_calls(sign, repeat * 100, values)
+            command.stdout.write(f"{'':>8}  {label:<24} {1000 / statistics.mean(timings):10.0f} signatures/s")
+
+        def check_fresh():
+            fresh = make_gateway(1)
+            fresh.check_status('benchmark-1', '110.00')
+            fresh.pool.close()
+
+        def check_pooled():
+            gateway.check_status('benchmark-1', '110.00')
+
+        for clients in sizes:
+            command.stdout.write(f"{clients:>8} clients")
+            for label, check in (('new connection', check_fresh), ('pooled connections', check_pooled)):
+                with ThreadPoolExecutor(max_workers=clients) as pool:
+                    started = time.perf_counter()
+                    timings = sum(pool.map(lambda _: time_calls(check, repeat), range(clients)), [])
+                    elapsed = time.perf_counter() - started
+                command.stdout.write(f"{'':>8}  {label:<24} {len(timings) / elapsed:8.1f} checks/s  {summarize(timings)}")
+        gateway.pool.close()
+
+
+# name -> (benchmark, default sizes). Sizes are table sizes, except for 'orders' where they are lines per
+# order, 'writes' where they are concurrent writers and 'payments' where they are concurrent clients.
+BENCHMARKS = {
+    'catalog': (benchmark_catalog, '1000,10000,50000'),
+    'search': (benchmark_search, '1000,10000,100000'),
+    'suggest': (benchmark_suggest, '1000,10000,100000'),
+    'orders': (benchmark_orders, '1,10,50,200'),
+    'order_list': (benchmark_order_list, '100,1000'),
+    'admin': (benchmark_admin, '1000,10000,100000'),
+    'writes': (benchmark_writes, '1,4,8'),
+    'payments': (benchmark_payments, '1,8,32'),
+}
+
+# Benchmarks that need the SQLite test database in a file
+FILE_DATABASE_BENCHMARKS = {'writes'}
+
+
+class Command(BaseCommand):
+    help = "Run a performance benchmark against seeded data in a throwaway test database."
+
+    def add_arguments(self, parser):
+        parser.add_argument('target', choices=sorted(BENCHMARKS))
+        parser.add_argument('--sizes', help="Comma separated sizes to benchmark at (defaults depend on the target)")
+        parser.add_argument('--repeat', type=int, default=50, help="Requests per measurement")
+
+    def handle(self, *args, **options):
+        benchmark, default_sizes = BENCHMARKS[options['target']]
+        try:
+            sizes = sorted(int(size) for size in (options['sizes'] or default_sizes).split(','))
+        except ValueError:
+            raise CommandError("--sizes must be a comma separated list of integers")
+        if sizes[0] < 1:
+            raise CommandError("--sizes must be positive")
+
+        # Never seed the real database: benchmark against a freshly migrated test database
+        old_name = connection.settings_dict['NAME']
+        with tempfile.TemporaryDirectory() as directory:
+            if connection.vendor == 'sqlite' and options['target'] in FILE_DATABASE_BENCHMARKS:
+                # Journal and sync modes only matter for a database on disk, not the default in-memory one
+                connection.settings_dict['TEST']['NAME'] = os.path.join(directory, 'benchmark.sqlite3')
+            connection.creation.create_test_db(verbosity=0, autoclobber=True)
+            try:
+                benchmark(self, sizes, options['repeat'])
+            finally:
+                connection.creation.destroy_test_db(old_name, verbosity=0)
@@ -0,0 +1,92 @@
+import re
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, transaction
+from django.db.models import Count, Sum
+from django.utils import timezone
+
+from myapp.models import (
+    Booking, CartItem, CustomUser, IdempotencyKey, Order, OutboxEvent, Product, StockReservation, userPayment
+)
+
+
+def canonical_queries(using):
+    """name -> queryset for the lookups on the app's hot paths. Each one must be served by an index."""
+    since = timezone.now() - timedelta(days=30)
+    return {
+        'booking status (email + mobile)': Booking.objects.using(using).filter(
+            email='someone@example.com', mobile_number='9800000000').order_by('-created_at'),
+        'booked slots of a service': Booking.objects.using(using).filter(
+            service_id=1, booking_date__range=('2030-01-01', '2030-01-07')).exclude(status='cancelled').values_list(
+            'booking_date', 'appointment_time').annotate(taken=Count('id')).order_by(),
+        'email already in use': CustomUser.objects.using(using).filter(email='someone@example.com'),
+        'catalog page by id': Product.objects.using(using).filter(id__gt=1000).order_by('id')[:50],
+        'catalog page by updated_at': Product.objects.using(using).order_by('updated_at', 'id')[:50],
+        'catalog page by category': Product.objects.using(using).filter(category='OTC').order_by('id')[:50],
+        'order history page': Order.objects.using(using).filter(user_id=1).order_by('-id')[:21],
+        'orders of a user by date': Order.objects.using(using).filter(user_id=1, created_at__gte=since),
+        'pending orders': Order.objects.using(using).filter(status='pending').order_by('created_at')[:100],
+        'order lines': CartItem.objects.using(using).filter(order_id__in=[1, 2, 3]),
+        'cart lines': CartItem.objects.using(using).filter(cart_id=1),
+        'payments by status': userPayment.objects.using(using).filter(status='COMPLETE', created_at__gte=since),
+        'pending payments': userPayment.objects.using(using).filter(status='PENDING').order_by('created_at')[:100],
+        'payment by transaction': userPayment.objects.using(using).filter(transaction_uuid='abc'),
+        'payment by transaction code': userPayment.objects.using(using).filter(transaction_code='abc'),
+        'active stock holds': StockReservation.objects.using(using).filter(
+            product_id__in=[1, 2, 3], status='active', expires_at__gt=timezone.now()
+        ).values('product_id').annotate(held=Sum('quantity')),
+        'expired stock holds': StockReservation.objects.using(using).filter(
+            status='active', expires_at__lte=timezone.now()),
+        'idempotency key': IdempotencyKey.objects.using(using).filter(user_id=1, endpoint='checkout', key='abc'),
+        'due outbox events': OutboxEvent.objects.using(using).filter(
+            status='pending', available_at__lte=timezone.now()).order_by('available_at', 'id')[:100],
+    }
+
+
+def full_scans(plan, vendor):
+    """Tables the plan reads from start to end without an index."""
+    if vendor == 'postgresql':
+        return re.findall(r'Seq Scan on (\w+)', plan)
+    # SQLite: "SCAN table" is a full scan, "SCAN table USING [COVERING] INDEX ..." walks an index
+    tables = []
+    for line in plan.splitlines():
+        match = re.search(r'\bSCAN (\w+)(.*)', line)
+        if match and match.group(1) != 'CONSTANT' and 'USING' not in match.group(2):
+            tables.append(match.group(1))
+    return tables
+
+
+class Command(BaseCommand):
+    help = "EXPLAIN the app's canonical queries and fail if any of them is answered with a full table scan."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--database', default='default')
+
+    def handle(self, *args, **options):
+        using = options['database']
+        connection = connections[using]
+        if connection.vendor not in ('sqlite', 'postgresql'):
+            raise CommandError(f"Query plans can only be checked on SQLite or PostgreSQL, not {connection.vendor}")
+
+        failures = []
+        with transaction.atomic(using=using):
+            if connection.vendor == 'postgresql':
+                # Small (test) tables are cheaper to scan; only fail when no index could be used at all
+                with connection.cursor() as cursor:
+                    cursor.execute("SET LOCAL enable_seqscan = off")
+
+            for name, queryset in canonical_queries(using).items():
+                plan = queryset.explain()
+                scans = full_scans(plan, connection.vendor)
+                if scans:
+                    failures.append(name)
+                    self.stdout.write(self.style.ERROR(f"FULL SCAN  {name}: {', '.join(scans)}"))
+                else:
+                    self.stdout.write(f"ok         {name}")
+                if options['verbosity'] > 1:
+                    self.stdout.write(f"{plan}\n")
+
+        if failures:
+            raise CommandError(f"{len(failures)} queries regressed to a full table scan: {', '.join(failures)}")
+        self.stdout.write(self.style.SUCCESS("Every canonical query uses an index"))
@@ -0,0 +1,35 @@
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+
+from myapp.outbox import dispatch_events, purge_dispatched
+
+
+class Command(BaseCommand):
+    help = ("Hand pending outbox events (order, booking and payment status changes) to their handlers "
+            "(run from cron, or with --every). Several dispatchers may run at once.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100)
+        parser.add_argument('--limit', type=int, help="Handle at most this many events per run.")
+        parser.add_argument('--every', type=float, default=0,
+                            help="Keep running and dispatch every N seconds instead of once.")
+        parser.add_argument('--purge-after', type=float, default=7,
+                            help="Delete events dispatched more than this many days ago (default 7).")
+
+    def handle(self, *args, **options):
+        if options['batch_size'] < 1:
+            raise CommandError("--batch-size must be positive")
+
+        while True:
+            stats = dispatch_events(batch_size=options['batch_size'], limit=options['limit'])
+            purged = purge_dispatched(timedelta(days=options['purge_after']))
+            lag = '-' if stats['max_lag'] is None else f"{stats['max_lag']:.1f} s"
+            self.stdout.write(self.style.SUCCESS(
+                f"Dispatched {stats['dispatched']} events in {stats['seconds']:.2f} s ({stats['per_second']:.1f}/s); "
+                f"retrying {stats['retried']}, failed {stats['failed']}; max lag {lag}; purged {purged}"
+            ))
+            if not options['every']:
+                break
+            time.sleep(options['every'])
@@ -0,0 +1,114 @@
+import http.client
+import json
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+from django.core.management.base import BaseCommand, CommandError
+
+
+def percentile(timings, fraction):
+    """`timings` must be sorted."""
+    return timings[min(len(timings) - 1, int(len(timings) * fraction))]
+
+
+def run_load(url, concurrency, total, method='GET', body=None, timeout=30):
+    """Send `total` requests to `url` from `concurrency` keep-alive connections.
+
+    Returns (latencies in ms of the successful requests, error count, elapsed seconds).
+    """
+    parts = urlsplit(url)
+    if parts.scheme not in ('http', 'https') or not parts.hostname:
+        raise ValueError(f"Not an http(s) URL: {url}")
+    connection_class = http.client.HTTPSConnection if parts.scheme == 'https' else http.client.HTTPConnection
+    path = parts.path or '/'
+    if parts.query:
+        path += '?' + parts.query
+    headers = {'Content-Type': 'application/json'} if body is not None else {}
+
+    remaining = iter(range(total))
+    lock = threading.Lock()
+    latencies = []
+    errors = [0]
+
+    def worker():
+        connection = connection_class(parts.hostname, parts.port, timeout=timeout)
+        while True:
+            with lock:
+                if next(remaining, None) is None:
+                    break
+            started = time.perf_counter()
+            try:
+                connection.request(method, path, body=body, headers=headers)
+                response = connection.getresponse()
+                response.read()
+                ok = response.status < 400
+            except (OSError, http.client.HTTPException):
+                # Reconnect; the server may have dropped the keep-alive connection
+                connection.close()
+                ok = False
+            elapsed = (time.perf_counter() - started) * 1000
+            with lock:
+                if ok:
+                    latencies.append(elapsed)
+                else:
+                    errors[0] += 1
+        connection.close()
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for _ in range(concurrency):
+            pool.submit(worker)
+    return latencies, errors[0], time.perf_counter() - started
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure requests/s and latency percentiles of running endpoints under concurrent load.\n\n"
+        "Start the same code under both servers (with a shared CACHE_URL) and point this at each, e.g.\n"
+        "  gunicorn epharm.wsgi --workers 4 --threads 8 --bind 127.0.0.1:8000\n"
+        "  uvicorn epharm.asgi:application --workers 4 --port 8001\n"
+        "  manage.py loadtest http://127.0.0.1:8000/api/products/ http://127.0.0.1:8001/api/async/products/"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('urls', nargs='+')
+        parser.add_argument('--concurrency', type=int, default=50, help="Simultaneous connections")
+        parser.add_argument('--requests', type=int, default=2000, help="Requests per URL")
+        parser.add_argument('--warmup', type=int, default=50, help="Unmeasured requests sent first")
+        parser.add_argument('--post', metavar='JSON', help="POST this JSON body instead of GET")
+        parser.add_argument('--timeout', type=float, default=30)
+
+    def handle(self, *args, **options):
+        if options['concurrency'] < 1 or options['requests'] < 1:
+            raise CommandError("--concurrency and --requests must be positive")
+        body = None
+        if options['post'] is not None:
+            try:
+                body = json.dumps(json.loads(options['post']))
+            except ValueError:
+                raise CommandError("--post must be valid JSON")
+        method = 'GET' if body is None else 'POST'
+
+        for url in options['urls']:
+            try:
+                if options['warmup']:
+                    run_load(url, min(options['concurrency'], options['warmup']), options['warmup'],
+                             method, body, options['timeout'])
+                latencies, errors, elapsed = run_load(url, options['concurrency'], options['requests'],
+                                                      method, body, options['timeout'])
+            except ValueError as e:
+                raise CommandError(str(e))
+
+            self.stdout.write(url)
+            if not latencies:
+                self.stdout.write(self.style.ERROR(f"  all {errors} requests failed"))
+                continue
+            latencies.sort()
+            self.stdout.write(
+                f"  {len(latencies) / elapsed:9.1f} req/s   p50 {statistics.median(latencies):8.2f} ms   "
+                f"p95 {percentile(latencies, 0.95):8.2f} ms   p99 {percentile(latencies, 0.99):8.2f} ms   "
+                f"errors {errors}"
+            )
@@ -0,0 +1,21 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from myapp.idempotency import purge_expired_keys
+
+
+class Command(BaseCommand):
+    help = "Delete Idempotency-Key records older than IDEMPOTENCY_KEY_TTL (run from cron, or with --every)."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--every', type=int, default=0,
+                            help="Keep running and purge every N seconds instead of once.")
+
+    def handle(self, *args, **options):
+        while True:
+            purged = purge_expired_keys()
+            self.stdout.write(self.style.SUCCESS(f"Purged {purged} expired idempotency keys"))
+            if not options['every']:
+                break
+            time.sleep(options['every'])
@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from myapp.models import Product
+from myapp.search import get_search_backend
+
+
+class Command(BaseCommand):
+    help = "Rebuild the product full-text search index (needed after bulk imports, which skip signals)."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--database', default='default')
+
+    def handle(self, *args, **options):
+        backend = get_search_backend(options['database'])
+        backend.rebuild()
+        count = Product.objects.using(options['database']).count()
+        self.stdout.write(self.style.SUCCESS(f"Indexed {count} products with {type(backend).__name__}"))
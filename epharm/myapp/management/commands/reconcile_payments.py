@@ -0,0 +1,46 @@
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+
+from myapp.payments import reconcile_pending_payments
+
+
+def format_age(seconds):
+    return '-' if seconds is None else f"{seconds / 60:.1f} min"
+
+
+class Command(BaseCommand):
+    help = ("Ask eSewa about payments still PENDING after --older-than minutes and settle them "
+            "(run from cron, or with --every).")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--older-than', type=float, default=15,
+                            help="Only payments created at least this many minutes ago (default 15).")
+        parser.add_argument('--batch-size', type=int, default=100)
+        parser.add_argument('--workers', type=int, default=8, help="Concurrent gateway requests.")
+        parser.add_argument('--limit', type=int, help="Check at most this many payments per run.")
+        parser.add_argument('--every', type=int, default=0,
+                            help="Keep running and reconcile every N seconds instead of once.")
+
+    def handle(self, *args, **options):
+        if options['batch_size'] < 1 or options['workers'] < 1:
+            raise CommandError("--batch-size and --workers must be positive")
+
+        while True:
+            stats = reconcile_pending_payments(
+                timedelta(minutes=options['older_than']),
+                batch_size=options['batch_size'],
+                workers=options['workers'],
+                limit=options['limit'],
+            )
+            settled = ', '.join(f"{count} {status}" for status, count in sorted(stats['settled'].items())) or 'none'
+            self.stdout.write(self.style.SUCCESS(
+                f"Checked {stats['checked']} pending payments in {stats['seconds']:.2f} s "
+                f"({stats['per_second']:.1f}/s); settled: {settled}; still pending: {stats['still_pending']}"
+            ))
+            self.stdout.write(f"Lag: oldest settled {format_age(stats['oldest_settled_age'])}, "
+                              f"oldest still pending {format_age(stats['oldest_pending_age'])}")
+            if not options['every']:
+                break
+            time.sleep(options['every'])
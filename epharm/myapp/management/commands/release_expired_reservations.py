@@ -0,0 +1,21 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from myapp.inventory import release_expired_reservations
+
+
+class Command(BaseCommand):
+    help = "Release stock holds of orders whose payment did not arrive in time (run from cron, or with --every)."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--every', type=int, default=0,
+                            help="Keep running and sweep every N seconds instead of once.")
+
+    def handle(self, *args, **options):
+        while True:
+            released = release_expired_reservations()
+            self.stdout.write(self.style.SUCCESS(f"Released {released} expired stock reservations"))
+            if not options['every']:
+                break
+            time.sleep(options['every'])
@@ -0,0 +1,63 @@
+from django.db import migrations
+
+CATEGORY_LABELS = {
+    'OTC': 'Over-the-Counter',
+    'RX': 'Prescription Medicines',
+    'SUP': 'Supplements & Vitamins',
+    'WOM': 'Women’s Health',
+    'MEN': 'Men’s Health',
+    'PED': 'Pediatric Medicines',
+    'HERB': 'Herbal & Ayurvedic',
+    'DIAG': 'Diagnostics & Medical Devices',
+    'FIRST': 'First Aid',
+}
+
+
+def create_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+
+    if vendor == 'sqlite':
+        schema_editor.execute(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS myapp_product_fts USING fts5("
+            "name, generic_name, category, description, "
+            "tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3')"
+        )
+        Product = apps.get_model('myapp', 'Product')
+        rows = [
+            (p.id, p.name or '', p.generic_name or '',
+             f"{p.category} {CATEGORY_LABELS.get(p.category, '')}", p.description or '')
+            for p in Product.objects.all()
+        ]
+        with schema_editor.connection.cursor() as cursor:
+            cursor.executemany(
+                "INSERT INTO myapp_product_fts (rowid, name, generic_name, category, description) "
+                "VALUES (%s, %s, %s, %s, %s)",
+                rows
+            )
+
+    elif vendor == 'postgresql':
+        schema_editor.execute(
+            "CREATE INDEX IF NOT EXISTS myapp_product_search_idx ON myapp_product USING GIN ("
+            "to_tsvector('simple', coalesce(name, '') || ' ' || coalesce(generic_name, '') || ' ' "
+            "|| coalesce(description, '') || ' ' || category))"
+        )
+
+
+def drop_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+
+    if vendor == 'sqlite':
+        schema_editor.execute("DROP TABLE IF EXISTS myapp_product_fts")
+    elif vendor == 'postgresql':
+        schema_editor.execute("DROP INDEX IF EXISTS myapp_product_search_idx")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('myapp', '0033_product_updated_at_index'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
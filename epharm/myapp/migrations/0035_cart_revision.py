@@ -0,0 +1,18 @@
+# Generated by Django 5.0.2 on 2026-10-18 13:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('myapp', '0034_product_search_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cart',
+            name='revision',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
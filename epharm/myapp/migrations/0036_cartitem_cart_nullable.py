@@ -0,0 +1,19 @@
+# Generated by Django 5.0.2 on 2026-10-18 13:17
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('myapp', '0035_cart_revision'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='cartitem',
+            name='cart',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='cart_items', to='myapp.cart'),
+        ),
+    ]
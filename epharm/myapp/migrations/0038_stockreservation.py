@@ -0,0 +1,29 @@
+# Generated by Django 5.0.2 on 2026-10-18 13:22
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('myapp', '0037_idempotencykey'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StockReservation',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('quantity', models.PositiveIntegerField()),
+                ('status', models.CharField(choices=[('active', 'Active'), ('committed', 'Committed'), ('released', 'Released')], default='active', max_length=20)),
+                ('expires_at', models.DateTimeField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('order', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='reservations', to='myapp.order')),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='reservations', to='myapp.product')),
+            ],
+            options={
+                'indexes': [models.Index(condition=models.Q(('status', 'active')), fields=['product', 'expires_at'], name='reservation_active_idx'), models.Index(condition=models.Q(('status', 'active')), fields=['expires_at'], name='reservation_expiry_idx')],
+            },
+        ),
+    ]
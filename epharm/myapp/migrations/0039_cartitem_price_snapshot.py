@@ -0,0 +1,43 @@
+# Generated by Django 5.0.2 on 2026-10-18 13:27
+
+from django.db import migrations, models
+from django.db.models import F, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+
+
+def snapshot_ordered_lines(apps, schema_editor):
+    # Existing order lines get the current catalog name and price, the best we still know
+    CartItem = apps.get_model('myapp', 'CartItem')
+    Product = apps.get_model('myapp', 'Product')
+    product = Product.objects.filter(pk=OuterRef('product_id'))
+    CartItem.objects.filter(order__isnull=False).update(
+        product_name=Coalesce(Subquery(product.values('name')[:1]), Value('')),
+        unit_price=Subquery(product.values('price')[:1]),
+        total_price=Subquery(product.values('price')[:1]) * F('quantity'),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('myapp', '0038_stockreservation'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cartitem',
+            name='product_name',
+            field=models.CharField(blank=True, max_length=200),
+        ),
+        migrations.AddField(
+            model_name='cartitem',
+            name='total_price',
+            field=models.DecimalField(blank=True, decimal_places=2, max_digits=12, null=True),
+        ),
+        migrations.AddField(
+            model_name='cartitem',
+            name='unit_price',
+            field=models.DecimalField(blank=True, decimal_places=2, max_digits=10, null=True),
+        ),
+        migrations.RunPython(snapshot_ordered_lines, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 5.0.2 on 2026-10-18 13:29
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('myapp', '0039_cartitem_price_snapshot'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='userpayment',
+            index=models.Index(fields=['status', 'created_at'], name='payment_status_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='userpayment',
+            index=models.Index(fields=['created_at'], name='payment_created_idx'),
+        ),
+    ]
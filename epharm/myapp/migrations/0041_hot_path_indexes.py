@@ -0,0 +1,38 @@
+# Generated by Django 5.0.2 on 2026-10-18 13:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0012_alter_user_first_name_max_length'),
+        ('myapp', '0040_userpayment_admin_indexes'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='booking',
+            index=models.Index(fields=['email', 'mobile_number', '-created_at'], name='booking_contact_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='customuser',
+            index=models.Index(fields=['email'], name='user_email_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['user', 'created_at'], name='order_user_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(condition=models.Q(('status', 'pending')), fields=['created_at'], name='order_pending_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['category', 'id'], name='product_category_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='userpayment',
+            index=models.Index(condition=models.Q(('status', 'PENDING')), fields=['created_at'], name='payment_pending_idx'),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 5.0.2 on 2026-10-18 13:53
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('myapp', '0041_hot_path_indexes'),
+    ]
+
+    operations = [
+        migrations.AddConstraint(
+            model_name='userpayment',
+            constraint=models.UniqueConstraint(condition=models.Q(('transaction_code__isnull', False)), fields=('transaction_code',), name='payment_transaction_code_uniq'),
+        ),
+    ]
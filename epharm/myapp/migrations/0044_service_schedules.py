@@ -0,0 +1,53 @@
+# Generated by Django 5.0.2 on 2026-10-18 14:02
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('myapp', '0043_outboxevent'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ServiceSchedule',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('weekday', models.PositiveSmallIntegerField(choices=[(0, 'Monday'), (1, 'Tuesday'), (2, 'Wednesday'), (3, 'Thursday'), (4, 'Friday'), (5, 'Saturday'), (6, 'Sunday')])),
+                ('opens_at', models.TimeField()),
+                ('closes_at', models.TimeField()),
+                ('slot_minutes', models.PositiveSmallIntegerField(default=30)),
+                ('capacity', models.PositiveSmallIntegerField(default=1)),
+            ],
+            options={
+                'ordering': ['service', 'weekday', 'opens_at'],
+            },
+        ),
+        migrations.RemoveConstraint(
+            model_name='booking',
+            name='unique_booking_slot',
+        ),
+        migrations.AddIndex(
+            model_name='booking',
+            index=models.Index(condition=models.Q(('status', 'cancelled'), _negated=True), fields=['service', 'booking_date', 'appointment_time'], name='booking_slot_idx'),
+        ),
+        migrations.AddField(
+            model_name='serviceschedule',
+            name='service',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='schedules', to='myapp.service'),
+        ),
+        migrations.AddConstraint(
+            model_name='serviceschedule',
+            constraint=models.UniqueConstraint(fields=('service', 'weekday', 'opens_at'), name='unique_schedule_start'),
+        ),
+        migrations.AddConstraint(
+            model_name='serviceschedule',
+            constraint=models.CheckConstraint(check=models.Q(('closes_at__gt', models.F('opens_at'))), name='schedule_hours_order'),
+        ),
+        migrations.AddConstraint(
+            model_name='serviceschedule',
+            constraint=models.CheckConstraint(check=models.Q(('capacity__gt', 0), ('slot_minutes__gt', 0)), name='schedule_slots_positive'),
+        ),
+    ]
@@ -0,0 +1,44 @@
+from django.db import migrations
+
+CATEGORY_LABELS = {
+    'OTC': 'Over-the-Counter',
+    'RX': 'Prescription Medicines',
+    'SUP': 'Supplements & Vitamins',
+    'WOM': 'Women’s Health',
+    'MEN': 'Men’s Health',
+    'PED': 'Pediatric Medicines',
+    'HERB': 'Herbal & Ayurvedic',
+    'DIAG': 'Diagnostics & Medical Devices',
+    'FIRST': 'First Aid',
+}
+
+OLD_DOCUMENT = (
+    "to_tsvector('simple', coalesce(name, '') || ' ' || coalesce(generic_name, '') || ' ' "
+    "|| coalesce(description, '') || ' ' || category)"
+)
+# Also index the category labels, as the SQLite FTS5 table does
+LABEL = "CASE category {} ELSE '' END".format(
+    ' '.join(f"WHEN '{code}' THEN '{label}'" for code, label in CATEGORY_LABELS.items()))
+NEW_DOCUMENT = (
+    "to_tsvector('simple', coalesce(name, '') || ' ' || coalesce(generic_name, '') || ' ' "
+    f"|| coalesce(description, '') || ' ' || category || ' ' || {LABEL})"
+)
+
+
+def recreate_index(document):
+    def run(apps, schema_editor):
+        if schema_editor.connection.vendor == 'postgresql':
+            schema_editor.execute("DROP INDEX IF EXISTS myapp_product_search_idx")
+            schema_editor.execute(f"CREATE INDEX myapp_product_search_idx ON myapp_product USING GIN ({document})")
+    return run
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('myapp', '0044_service_schedules'),
+    ]
+
+    operations = [
+        migrations.RunPython(recreate_index(NEW_DOCUMENT), recreate_index(OLD_DOCUMENT)),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.0.2 on 2026-10-18 14:24
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('myapp', '0046_idempotencykey_created_at_index'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='order',
+            name='status',
+            field=models.CharField(choices=[('pending', 'Pending'), ('shipped', 'Shipped'), ('delivered', 'Delivered'), ('unfulfillable', 'Unfulfillable')], default='pending', max_length=50),
+        ),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 5.0.2 on 2026-10-18 15:02
+
+from django.db import migrations, models
+
+
+def number_seats(apps, schema_editor):
+    # Bookings already holding a slot take its seats in the order they were made
+    Booking = apps.get_model('myapp', 'Booking')
+    seats = {}
+    for booking in Booking.objects.exclude(status='cancelled').order_by('pk').only(
+            'pk', 'service_id', 'booking_date', 'appointment_time'):
+        slot = (booking.service_id, booking.booking_date, booking.appointment_time)
+        seat = seats.get(slot, 0)
+        seats[slot] = seat + 1
+        if seat:
+            Booking.objects.filter(pk=booking.pk).update(seat=seat)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('myapp', '0047_order_status_unfulfillable'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='booking',
+            name='seat',
+            field=models.PositiveSmallIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(number_seats, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='booking',
+            constraint=models.UniqueConstraint(condition=models.Q(('status', 'cancelled'), _negated=True), fields=('service', 'booking_date', 'appointment_time', 'seat'), name='unique_booking_seat'),
+        ),
+    ]
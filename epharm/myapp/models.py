@@ -1,6 +1,7 @@
 from datetime import timezone
 from django.utils import timezone
 
+from django.core.serializers.json import DjangoJSONEncoder
 from django.db import models
 from django.contrib.auth.models import AbstractUser
 from rest_framework.exceptions import ValidationError
@@ -15,6 +16,9 @@ class CustomUser(AbstractUser):
     class Meta:
         verbose_name = 'Custom User'
         verbose_name_plural = 'Custom Users'
+        indexes = [
+            models.Index(fields=['email'], name='user_email_idx'),  # check_email, email lookups
+        ]
 
     def __str__(self):
         return self.username
@@ -43,11 +47,17 @@ class Product(models.Model):
     stock = models.IntegerField(default=0)
     prescription_required = models.BooleanField(default=False)
     created_at = models.DateTimeField(auto_now_add=True)
-    updated_at = models.DateTimeField(auto_now=True)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)  # Catalog cursor ordering
 
     def __str__(self):
         return self.generic_name if self.generic_name else self.name if self.name else "Unnamed Product"
 
+    class Meta:
+        indexes = [
+            # Category filtered catalog, ordered by id
+            models.Index(fields=['category', 'id'], name='product_category_idx'),
+        ]
+
 
 
 class Order(models.Model):
@@ -55,6 +65,7 @@ class Order(models.Model):
         ('pending', 'Pending'),
         ('shipped', 'Shipped'),
         ('delivered', 'Delivered'),
+        ('unfulfillable', 'Unfulfillable'),  # Paid, but the stock went to someone else: refund due
     ]
 
     user = models.ForeignKey(CustomUser, on_delete=models.CASCADE)
@@ -66,27 +77,39 @@ class Order(models.Model):
     updated_at = models.DateTimeField(auto_now=True)
 
     def __str__(self):
-        cart_items = self.cartitem_set.all()  # Get related cart items
-        cart_items_str = ", ".join([f"{item.quantity} x {item.product.name}" for item in cart_items])
-        return (f"Order {self.id} - {self.user.first_name} {self.user.last_name} ({self.user.phone}) "
-                f"Status: {self.status} - Address: {self.address} - Cart Items: {cart_items_str}")
+        # Only this row's own columns: no query for the user or the lines, so it is safe in logs and lists
+        return f"Order {self.id} - Status: {self.status} - Total: {self.total_price}"
+
+    class Meta:
+        indexes = [
+            # A user's orders by date (order list date filters)
+            models.Index(fields=['user', 'created_at'], name='order_user_created_idx'),
+            # Orders still waiting to be shipped, oldest first
+            models.Index(fields=['created_at'], condition=models.Q(status='pending'), name='order_pending_idx'),
+        ]
 
 # CartItem model\
 
 class Cart(models.Model):
     user = models.OneToOneField(CustomUser, on_delete=models.CASCADE, related_name='cart')
+    revision = models.PositiveIntegerField(default=0)  # Bumped on every change to the cart lines
 
     def __str__(self):
         return f"Cart of {self.user.username}"
 
 
 class CartItem(models.Model):
-    cart = models.ForeignKey(Cart, related_name='cart_items', on_delete=models.CASCADE,default=1)
+    cart = models.ForeignKey(Cart, related_name='cart_items', on_delete=models.CASCADE, null=True, blank=True)  # Empty for order-only lines
     product = models.ForeignKey(Product, on_delete=models.CASCADE)
     quantity = models.PositiveIntegerField(default=1)
     order = models.ForeignKey(Order, on_delete=models.CASCADE, null=True, blank=True)  # Link to the order
     prescription_file = models.FileField(upload_to='cart_prescriptions/', null=True, blank=True)
 
+    # Snapshot written once when the line is ordered, so order reads never join the live catalog
+    product_name = models.CharField(max_length=200, blank=True)
+    unit_price = models.DecimalField(max_digits=10, decimal_places=2, null=True, blank=True)
+    total_price = models.DecimalField(max_digits=12, decimal_places=2, null=True, blank=True)
+
     def __str__(self):
         return f"{self.quantity} x {self.product.name}"
 
@@ -103,6 +126,38 @@ class Service(models.Model):
     class Meta:
         ordering = ['name']
 
+
+class ServiceSchedule(models.Model):
+    """Working hours of a service on one weekday, cut into bookable slots (see availability.py)."""
+    WEEKDAY_CHOICES = [
+        (0, 'Monday'),
+        (1, 'Tuesday'),
+        (2, 'Wednesday'),
+        (3, 'Thursday'),
+        (4, 'Friday'),
+        (5, 'Saturday'),
+        (6, 'Sunday'),
+    ]
+
+    service = models.ForeignKey(Service, on_delete=models.CASCADE, related_name='schedules')
+    weekday = models.PositiveSmallIntegerField(choices=WEEKDAY_CHOICES)
+    opens_at = models.TimeField()
+    closes_at = models.TimeField()  # The last slot ends by then
+    slot_minutes = models.PositiveSmallIntegerField(default=30)
+    capacity = models.PositiveSmallIntegerField(default=1)  # Bookings per slot
+
+    def __str__(self):
+        return f"{self.service_id} {self.get_weekday_display()} {self.opens_at:%H:%M}-{self.closes_at:%H:%M}"
+
+    class Meta:
+        ordering = ['service', 'weekday', 'opens_at']
+        constraints = [
+            # Several rows per weekday are fine (e.g. a lunch break), as long as they start apart
+            models.UniqueConstraint(fields=['service', 'weekday', 'opens_at'], name='unique_schedule_start'),
+            models.CheckConstraint(check=models.Q(closes_at__gt=models.F('opens_at')), name='schedule_hours_order'),
+            models.CheckConstraint(check=models.Q(slot_minutes__gt=0, capacity__gt=0), name='schedule_slots_positive'),
+        ]
+
 class Booking(models.Model):
     STATUS_CHOICES = (
         ('pending', 'Pending'),
@@ -130,6 +185,8 @@ class Booking(models.Model):
     address = models.TextField(blank=True, null=True)
     notes = models.TextField(blank=True)
     status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='pending')
+    # Which of the slot's places the booking holds, given by check_slot (see availability.py)
+    seat = models.PositiveSmallIntegerField(default=0, editable=False)
     created_at = models.DateTimeField(auto_now_add=True)
 
     def __str__(self):
@@ -137,12 +194,17 @@ class Booking(models.Model):
 
     class Meta:
         ordering = ['-created_at']
-        # Prevent double booking
+        indexes = [
+            # BookingStatusView: bookings of one contact, newest first
+            models.Index(fields=['email', 'mobile_number', '-created_at'], name='booking_contact_idx'),
+            # Bookings holding a slot: availability range query and the capacity check on booking
+            models.Index(fields=['service', 'booking_date', 'appointment_time'],
+                         condition=~models.Q(status='cancelled'), name='booking_slot_idx'),
+        ]
         constraints = [
-            models.UniqueConstraint(
-                fields=['service', 'booking_date', 'appointment_time'],
-                name='unique_booking_slot'
-            )
+            # Two bookings holding a slot never share a seat, so a slot takes at most its capacity
+            models.UniqueConstraint(fields=['service', 'booking_date', 'appointment_time', 'seat'],
+                                    condition=~models.Q(status='cancelled'), name='unique_booking_seat'),
         ]
 
 
@@ -187,4 +249,108 @@ class userPayment(models.Model):
     def get_order_details(self):
         if self.order:
             return f"Order ID: {self.order.id}, Status: {self.order.status}, Address: {self.order.address}, Total: {self.order.total_price}"
-        return "No order details available"
\ No newline at end of file
+        return "No order details available"
+
+    class Meta:
+        indexes = [
+            # Admin changelist: filtered by status and/or created_at
+            models.Index(fields=['status', 'created_at'], name='payment_status_created_idx'),
+            models.Index(fields=['created_at'], name='payment_created_idx'),
+            # Payments still waiting for the gateway, oldest first
+            models.Index(fields=['created_at'], condition=models.Q(status='PENDING'), name='payment_pending_idx'),
+        ]
+        constraints = [
+            # One eSewa transaction settles one payment; also the dedupe key for repeated callbacks
+            models.UniqueConstraint(fields=['transaction_code'], condition=models.Q(transaction_code__isnull=False),
+                                    name='payment_transaction_code_uniq'),
+        ]
+
+
+class IdempotencyKey(models.Model):
+    """Response of a request made with an Idempotency-Key header, replayed on client retries."""
+    user = models.ForeignKey(CustomUser, on_delete=models.CASCADE, related_name='idempotency_keys')
+    endpoint = models.CharField(max_length=50)
+    key = models.CharField(max_length=255)
+    response_code = models.PositiveSmallIntegerField(null=True, blank=True)  # Empty while the request is running
+    response_body = models.JSONField(null=True, blank=True, encoder=DjangoJSONEncoder)
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)  # Expiry, see idempotency.py
+
+    def __str__(self):
+        return f"{self.endpoint} {self.key} ({self.user_id})"
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'endpoint', 'key'], name='unique_idempotency_key')
+        ]
+
+
+class StockReservation(models.Model):
+    """Stock held for an order while it waits for payment.
+
+    Holds do not touch Product.stock; the stock available to new orders is
+    stock minus the active, unexpired holds (see inventory.py). A hold is
+    committed (stock actually taken) when the payment succeeds, and released
+    when it fails or the hold expires.
+    """
+    ACTIVE = 'active'
+    COMMITTED = 'committed'
+    RELEASED = 'released'
+    STATUS_CHOICES = [
+        (ACTIVE, 'Active'),
+        (COMMITTED, 'Committed'),
+        (RELEASED, 'Released'),
+    ]
+
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='reservations')
+    order = models.ForeignKey(Order, on_delete=models.CASCADE, related_name='reservations')
+    quantity = models.PositiveIntegerField()
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=ACTIVE)
+    expires_at = models.DateTimeField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.quantity} x {self.product_id} for order {self.order_id} ({self.status})"
+
+    class Meta:
+        indexes = [
+            # Only active holds are ever summed or swept, so keep the indexes to those rows
+            models.Index(fields=['product', 'expires_at'], condition=models.Q(status='active'),
+                         name='reservation_active_idx'),
+            models.Index(fields=['expires_at'], condition=models.Q(status='active'),
+                         name='reservation_expiry_idx'),
+        ]
+
+
+class OutboxEvent(models.Model):
+    """A committed state change waiting for its follow-up work.
+
+    Written in the same transaction as the change it describes and handed to
+    the handlers for its topic by the outbox dispatcher (see outbox.py).
+    """
+    PENDING = 'pending'
+    DISPATCHED = 'dispatched'
+    FAILED = 'failed'
+    STATUS_CHOICES = [
+        (PENDING, 'Pending'),
+        (DISPATCHED, 'Dispatched'),
+        (FAILED, 'Failed'),
+    ]
+
+    topic = models.CharField(max_length=100)
+    payload = models.JSONField(default=dict, encoder=DjangoJSONEncoder)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=PENDING)
+    attempts = models.PositiveIntegerField(default=0)
+    available_at = models.DateTimeField(default=timezone.now)  # Not handed out again before this
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    dispatched_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f"{self.topic} #{self.id} ({self.status})"
+
+    class Meta:
+        indexes = [
+            # The dispatcher only ever looks for pending events that are due, oldest first
+            models.Index(fields=['available_at', 'id'], condition=models.Q(status='pending'),
+                         name='outbox_pending_idx'),
+        ]
@@ -0,0 +1,205 @@
+"""Transactional outbox: order, booking and payment state changes as events handled off the request path.
+
+Code that changes a status also builds an event (order_status_changed() and
+friends) and publish()es it inside the same transaction: one extra INSERT, and
+the event exists exactly when the change was committed. Follow-up work
+(emails, analytics, anything slow or talking to other services) does not run
+in the request; it belongs in a handler.
+
+The dispatch_outbox command (dispatch_events()) leases due events in batches
+and calls the handlers settings.OUTBOX_HANDLERS lists for their topic ('*'
+handlers see every event). A handler raising puts the event back with an
+exponential backoff; after OUTBOX_MAX_ATTEMPTS it is marked failed and kept
+for a person to look at. Delivery is at least once and, after a retry, not in
+order: when one handler of an event fails, all of them run again, and an event
+whose lease (OUTBOX_LEASE) runs out before it is handled is handed out again.
+Handlers must therefore be idempotent and read current state when order matters.
+"""
+import logging
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.mail import mail_admins, send_mail
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from .models import Booking, OutboxEvent
+
+logger = logging.getLogger(__name__)
+
+ORDER_STATUS_CHANGED = 'order.status_changed'
+BOOKING_STATUS_CHANGED = 'booking.status_changed'
+PAYMENT_STATUS_CHANGED = 'payment.status_changed'
+PAYMENT_REFUND_NEEDED = 'payment.refund_needed'
+
+MAX_RETRY_DELAY = 60 * 60  # seconds
+
+
+def order_status_changed(order):
+    return OutboxEvent(topic=ORDER_STATUS_CHANGED, payload={'order_id': order.pk, 'status': order.status})
+
+
+def booking_status_changed(booking_id, status):
+    return OutboxEvent(topic=BOOKING_STATUS_CHANGED, payload={'booking_id': booking_id, 'status': status})
+
+
+def payment_status_changed(payment, status):
+    return OutboxEvent(topic=PAYMENT_STATUS_CHANGED, payload={
+        'payment_id': payment.pk,
+        'transaction_uuid': payment.transaction_uuid,
+        'status': status,
+        'order_id': payment.order_id,
+        'booking_id': payment.booking_id,
+    })
+
+
+def payment_refund_needed(payment, reason):
+    """A payment that succeeded for an order that can not be fulfilled; someone has to refund it."""
+    return OutboxEvent(topic=PAYMENT_REFUND_NEEDED, payload={
+        'payment_id': payment.pk,
+        'transaction_uuid': payment.transaction_uuid,
+        'total_amount': payment.total_amount,
+        'order_id': payment.order_id,
+        'reason': reason,
+    })
+
+
+def publish(*events):
+    """Record events with a single INSERT; call it inside the transaction making the changes."""
+    if events:
+        OutboxEvent.objects.bulk_create(events)
+
+
+def get_max_attempts():
+    return getattr(settings, 'OUTBOX_MAX_ATTEMPTS', 8)
+
+
+def get_lease():
+    return timedelta(seconds=getattr(settings, 'OUTBOX_LEASE', 5 * 60))
+
+
+def retry_delay(attempts):
+    """Seconds before an event that failed `attempts` times is handed out again."""
+    return min(getattr(settings, 'OUTBOX_RETRY_DELAY', 30) * 2 ** (attempts - 1), MAX_RETRY_DELAY)
+
+
+def get_handlers():
+    """settings.OUTBOX_HANDLERS, imported: {topic: [callable(event), ...]}."""
+    return {topic: [import_string(path) for path in paths]
+            for topic, paths in getattr(settings, 'OUTBOX_HANDLERS', {}).items()}
+
+
+def claim_events(batch_size):
+    """Lease up to `batch_size` due events to this dispatcher, oldest first.
+
+    Other dispatchers skip the locked rows while they are being claimed, and
+    the claimed ones until the lease runs out.
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        events = list(OutboxEvent.objects.select_for_update(skip_locked=True).filter(
+            status=OutboxEvent.PENDING, available_at__lte=now).order_by('available_at', 'id')[:batch_size])
+        OutboxEvent.objects.filter(pk__in=[event.pk for event in events]).update(available_at=now + get_lease())
+    return events
+
+
+def retry_later(event, error):
+    attempts = event.attempts + 1
+    give_up = attempts >= get_max_attempts()
+    if give_up:
+        logger.error(f"Giving up on outbox event {event.pk} ({event.topic}) after {attempts} attempts: {error!r}")
+    else:
+        logger.warning(f"Outbox event {event.pk} ({event.topic}) failed, will retry: {error!r}")
+    OutboxEvent.objects.filter(pk=event.pk).update(
+        attempts=attempts,
+        last_error=repr(error),
+        status=OutboxEvent.FAILED if give_up else OutboxEvent.PENDING,
+        available_at=timezone.now() + timedelta(seconds=retry_delay(attempts)),
+    )
+    return give_up
+
+
+def dispatch_events(batch_size=100, limit=None):
+    """Hand due events to their handlers, batch after batch, until none is due or `limit` were handled.
+
+    Each event's handlers run in one transaction, so the database writes of a
+    failed attempt are rolled back. Events handled without error are marked
+    dispatched with one UPDATE per batch.
+    Returns metrics: dispatched, retried, failed, seconds, per_second and
+    max_lag, the longest time in seconds an event waited from being published
+    to being dispatched.
+    """
+    started = time.perf_counter()
+    handlers = get_handlers()
+    stats = {'dispatched': 0, 'retried': 0, 'failed': 0, 'max_lag': None}
+    handled = 0
+
+    while limit is None or handled < limit:
+        events = claim_events(batch_size if limit is None else min(batch_size, limit - handled))
+        if not events:
+            break
+        handled += len(events)
+
+        done = []
+        for event in events:
+            try:
+                with transaction.atomic():
+                    for handler in handlers.get('*', []) + handlers.get(event.topic, []):
+                        handler(event)
+            except Exception as e:
+                stats['failed' if retry_later(event, e) else 'retried'] += 1
+            else:
+                done.append(event)
+
+        now = timezone.now()
+        OutboxEvent.objects.filter(pk__in=[event.pk for event in done]).update(
+            status=OutboxEvent.DISPATCHED, dispatched_at=now, attempts=F('attempts') + 1)
+        stats['dispatched'] += len(done)
+        for event in done:
+            stats['max_lag'] = max(stats['max_lag'] or 0, (now - event.created_at).total_seconds())
+
+    stats['seconds'] = time.perf_counter() - started
+    stats['per_second'] = handled / stats['seconds'] if stats['seconds'] else 0
+    return stats
+
+
+def purge_dispatched(older_than):
+    """Delete events dispatched more than `older_than` (a timedelta) ago; returns how many."""
+    deleted, _ = OutboxEvent.objects.filter(
+        status=OutboxEvent.DISPATCHED, dispatched_at__lt=timezone.now() - older_than).delete()
+    return deleted
+
+
+# Handlers
+
+def log_event(event):
+    """Write every event to the log, as a feed for analytics."""
+    logger.info(f"{event.topic} {event.payload}")
+
+
+def email_booking_update(event):
+    """Tell the customer their booking was confirmed or cancelled."""
+    if event.payload['status'] not in ('confirmed', 'cancelled'):
+        return
+    booking = Booking.objects.select_related('service').filter(pk=event.payload['booking_id']).first()
+    if booking is None:
+        return
+    send_mail(
+        f"Your {booking.service.name} booking is {event.payload['status']}",
+        f"Hello {booking.name},\n\nYour {booking.service.name} appointment on {booking.booking_date} at "
+        f"{booking.appointment_time:%H:%M} is {event.payload['status']}.",
+        None,
+        [booking.email],
+    )
+
+
+def email_refund_request(event):
+    """Ask the site admins (settings.ADMINS) to refund a payment whose order can not be fulfilled."""
+    mail_admins(
+        f"Refund needed for payment {event.payload['transaction_uuid']}",
+        f"Order {event.payload['order_id']} was paid ({event.payload['total_amount']}) but can not be fulfilled: "
+        f"{event.payload['reason']}\nRefund the payment in eSewa and set it to FULL_REFUND in the admin.",
+    )
@@ -0,0 +1,60 @@
+from django.core.paginator import Paginator
+from django.db import connections
+from django.utils.functional import cached_property
+from rest_framework.pagination import CursorPagination
+
+
+# Keyset (cursor) pagination for the product catalog.
+# Each page is fetched with "WHERE <ordering field> > <cursor> ORDER BY ... LIMIT n",
+# so the cost of a page does not grow with the size of the catalog.
+class ProductCursorPagination(CursorPagination):
+    page_size = 50
+    page_size_query_param = 'page_size'
+    max_page_size = 200
+    ordering = 'id'
+
+    # Orderings a client may ask for with ?ordering=. 'id' is the primary key and
+    # 'updated_at' is indexed, so both are served by an index range scan.
+    ordering_query_param = 'ordering'
+    allowed_orderings = {
+        'id': ('id',),
+        '-id': ('-id',),
+        'updated_at': ('updated_at', 'id'),
+        '-updated_at': ('-updated_at', '-id'),
+    }
+
+    def get_ordering(self, request, queryset, view):
+        requested = request.query_params.get(self.ordering_query_param)
+        if requested in self.allowed_orderings:
+            return self.allowed_orderings[requested]
+        return (self.ordering,)
+
+
+# Order history of one user, newest first. Orders are only ever appended, so
+# the id order is the creation order and pages stay stable while new orders arrive.
+class OrderHistoryCursorPagination(CursorPagination):
+    page_size = 20
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+    ordering = '-id'
+
+
+# Paginator for admin changelists of large tables. An exact COUNT(*) scans the
+# whole table on every page; for an unfiltered list on PostgreSQL the planner's
+# row estimate (kept up to date by autovacuum) is used instead once the table is
+# big enough that nobody needs the exact number. Filtered lists are counted exactly.
+class EstimatedCountPaginator(Paginator):
+    estimate_threshold = 10000
+
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+        connection = connections[queryset.db]
+        if connection.vendor == 'postgresql' and not queryset.query.where:
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT reltuples::bigint FROM pg_class WHERE relname = %s",
+                               [queryset.model._meta.db_table])
+                row = cursor.fetchone()
+            if row and row[0] >= self.estimate_threshold:
+                return row[0]
+        return super().count
@@ -0,0 +1,548 @@
+"""eSewa payments: the gateway client and callback verification off the request path.
+
+EsewaGateway (get_gateway()) owns everything that talks to eSewa: signing the
+payment form with a precomputed HMAC-SHA256 key and checking a transaction's status
+over pooled keep-alive connections, with timeouts and retries. fake_esewa.py
+is a local stand-in for the eSewa API, for tests and benchmarks.
+
+A gateway callback is acknowledged as soon as the payment is found. Checking
+the reported outcome and settling the order or booking happens on a small
+thread pool (settings.PAYMENT_VERIFICATION_WORKERS), so a burst of callbacks
+never holds web workers while the gateway is slow. The frontend follows the
+outcome through the payment status endpoint (async_views.payment_status).
+
+The pool lives in the web process: verifications queued when it stops are
+lost and those payments stay PENDING until they are verified again. So are
+payments whose callback never came (the user closed the eSewa tab):
+reconcile_pending_payments() (the reconcile_payments command) asks eSewa
+about old PENDING payments in batches and settles them in bulk.
+
+Settling a payment publishes its status change, and the booking's when it is
+confirmed, to the outbox (outbox.py) in the same transaction. A payment that
+succeeded for an order whose stock is gone, or for less than its total, still
+settles; the order is marked unfulfillable and a payment.refund_needed event
+asks for the refund.
+"""
+import base64
+import binascii
+import hashlib
+import hmac
+import http.client
+import json
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from urllib.parse import urlencode, urlsplit
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.signals import setting_changed
+from django.db import close_old_connections, transaction
+from django.db.models import Q
+from django.dispatch import receiver
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from .inventory import InsufficientStock, commit_reservations, release_reservations
+from .models import Booking, Order, StockReservation, userPayment
+from .outbox import booking_status_changed, order_status_changed, payment_refund_needed, payment_status_changed, publish
+
+logger = logging.getLogger(__name__)
+
+# eSewa transaction statuses that settle an order's stock holds
+PAYMENT_SUCCESS_STATUSES = {'SUCCESS', 'COMPLETE'}
+PAYMENT_FAILURE_STATUSES = {'FAILED', 'CANCELED', 'NOT_FOUND'}
+PAYMENT_REFUND_STATUSES = {'FULL_REFUND', 'PARTIAL_REFUND'}
+
+# Status changes a payment may go through, from -> allowed to. Settling is a conditional
+# UPDATE ... WHERE status IN (<allowed from>), so duplicate and out of order callbacks change nothing.
+PAYMENT_TRANSITIONS = {
+    'PENDING': PAYMENT_SUCCESS_STATUSES | PAYMENT_FAILURE_STATUSES | PAYMENT_REFUND_STATUSES,
+    'SUCCESS': PAYMENT_REFUND_STATUSES,
+    'COMPLETE': PAYMENT_REFUND_STATUSES,
+    'PARTIAL_REFUND': {'FULL_REFUND'},
+}
+
+# Fields eSewa expects to be signed, in this order
+SIGNED_FIELD_NAMES = ('total_amount', 'transaction_uuid', 'product_code')
+# Statuses eSewa reports while a payment is not settled yet
+GATEWAY_UNSETTLED_STATUSES = {'PENDING', 'AMBIGUOUS'}
+
+
+class GatewayError(Exception):
+    pass
+
+
+class InvalidCallback(Exception):
+    pass
+
+
+class ConnectionPool:
+    """Keep-alive HTTP(S) connections to one host, shared between threads."""
+
+    def __init__(self, url, size=10, timeout=5):
+        parts = urlsplit(url)
+        self.connection_class = http.client.HTTPSConnection if parts.scheme == 'https' else http.client.HTTPConnection
+        self.host = parts.hostname
+        self.port = parts.port
+        self.timeout = timeout
+        self.idle = queue.LifoQueue(maxsize=size)
+
+    def request(self, method, path, body=None, headers=None):
+        """Send one request and return (status, body bytes). Raises OSError or http.client.HTTPException."""
+        try:
+            connection = self.idle.get_nowait()
+        except queue.Empty:
+            connection = self.connection_class(self.host, self.port, timeout=self.timeout)
+        try:
+            connection.request(method, path, body=body, headers=headers or {})
+            response = connection.getresponse()
+            data = response.read()
+        except Exception:
+            # Also covers a keep-alive connection the server has closed in the meantime
+            connection.close()
+            raise
+
+        if response.will_close:
+            connection.close()
+        else:
+            try:
+                self.idle.put_nowait(connection)
+            except queue.Full:
+                connection.close()
+        return response.status, data
+
+    def close(self):
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+class EsewaGateway:
+    """Signs eSewa ePay v2 payment forms and asks eSewa for the status of a transaction."""
+
+    def __init__(self, secret_key, product_code, status_url, success_url, failure_url,
+                 timeout=5, retries=2, backoff=0.2, pool_size=10):
+        # HMAC-SHA256 keyed once; a signature copies it instead of re-encoding the secret and keying a new HMAC
+        self.mac = hmac.new(secret_key.encode(), digestmod=hashlib.sha256)
+        self.product_code = product_code
+        self.status_path = urlsplit(status_url).path
+        self.success_url = success_url
+        self.failure_url = failure_url
+        self.retries = retries
+        self.backoff = backoff
+        self.pool = ConnectionPool(status_url, size=pool_size, timeout=timeout)
+
+    @classmethod
+    def from_settings(cls):
+        return cls(
+            secret_key=settings.ESEWA_SECRET_KEY,
+            product_code=getattr(settings, 'ESEWA_PRODUCT_CODE', 'EPAYTEST'),
+            status_url=settings.ESEWA_STATUS_URL,
+            success_url=settings.ESEWA_SUCCESS_URL,
+            failure_url=settings.ESEWA_FAILURE_URL,
+            timeout=getattr(settings, 'ESEWA_TIMEOUT', 5),
+            retries=getattr(settings, 'ESEWA_RETRIES', 2),
+            pool_size=getattr(settings, 'ESEWA_POOL_SIZE', 10),
+        )
+
+    def sign(self, values, field_names=SIGNED_FIELD_NAMES):
+        """Base64 HMAC-SHA256 of "name=value,name=value" over `field_names`, as eSewa computes it."""
+        message = ','.join(f"{name}={values[name]}" for name in field_names)
+        signature = self.mac.copy()
+        signature.update(message.encode())
+        return base64.b64encode(signature.digest()).decode()
+
+    def payment_form(self, amount, tax_amount, transaction_uuid):
+        """The signed fields the frontend posts to eSewa to start a payment."""
+        total_amount = amount + tax_amount
+        form = {
+            "amount": str(amount),
+            "tax_amount": str(tax_amount),
+            "total_amount": str(total_amount),
+            "transaction_uuid": transaction_uuid,
+            "product_code": self.product_code,
+            "product_service_charge": "0",
+            "product_delivery_charge": "0",
+            "success_url": self.success_url,
+            "failure_url": self.failure_url,
+            "signed_field_names": ','.join(SIGNED_FIELD_NAMES),
+        }
+        form["signature"] = self.sign(form)
+        return form
+
+    def decode_callback(self, data):
+        """Decode the base64 JSON `data` eSewa appends to the success URL and check its signature.
+
+        Returns the payload (transaction_code, status, total_amount, transaction_uuid, ...).
+        Raises InvalidCallback when it can not be decoded or was not signed with our key.
+        """
+        try:
+            fields = json.loads(base64.b64decode(data, validate=True))
+        except (ValueError, TypeError, binascii.Error):
+            raise InvalidCallback("Payment data is not base64 encoded JSON")
+        if not isinstance(fields, dict):
+            raise InvalidCallback("Payment data is not a JSON object")
+
+        field_names = str(fields.get('signed_field_names', '')).split(',')
+        if 'transaction_uuid' not in field_names or 'status' not in field_names:
+            raise InvalidCallback("Payment data does not sign the transaction and its status")
+        if any(name not in fields for name in field_names):
+            raise InvalidCallback("Payment data lacks signed fields")
+        if not hmac.compare_digest(self.sign(fields, field_names), str(fields.get('signature', ''))):
+            raise InvalidCallback("Payment data signature does not match")
+        if fields.get('product_code', self.product_code) != self.product_code:
+            raise InvalidCallback("Payment data is for another merchant")
+        return fields
+
+    def check_status(self, transaction_uuid, total_amount, product_code=None):
+        """eSewa's status of a transaction (COMPLETE, PENDING, CANCELED, NOT_FOUND, ...).
+
+        Connection errors, timeouts and 5xx answers are retried with exponential
+        backoff; GatewayError is raised once the retries are used up.
+        """
+        query = urlencode({
+            'product_code': product_code or self.product_code,
+            'total_amount': total_amount,
+            'transaction_uuid': transaction_uuid,
+        })
+        error = None
+        for attempt in range(self.retries + 1):
+            if attempt:
+                time.sleep(self.backoff * 2 ** (attempt - 1))
+            try:
+                status_code, body = self.pool.request('GET', f"{self.status_path}?{query}",
+                                                      headers={'Accept': 'application/json'})
+            except (OSError, http.client.HTTPException) as e:
+                error = e
+                continue
+            if status_code >= 500:
+                error = GatewayError(f"eSewa answered {status_code}")
+                continue
+            try:
+                data = json.loads(body)
+            except ValueError:
+                raise GatewayError(f"eSewa answered {status_code} with a body that is not JSON")
+            if status_code != 200 or 'status' not in data:
+                raise GatewayError(f"eSewa answered {status_code}: {data}")
+            return data['status']
+        raise GatewayError(f"eSewa status check for {transaction_uuid} failed: {error}")
+
+
+_gateway = None
+
+
+def get_gateway():
+    global _gateway
+    if _gateway is None:
+        _gateway = EsewaGateway.from_settings()
+    return _gateway
+
+
+@receiver(setting_changed)
+def reset_gateway(setting, **kwargs):
+    global _gateway
+    if setting.startswith('ESEWA_') and _gateway is not None:
+        _gateway.pool.close()
+        _gateway = None
+
+
+_executor = None
+_executor_lock = threading.Lock()
+_pending = set()
+_pending_lock = threading.Lock()
+
+
+def get_verification_workers():
+    return getattr(settings, 'PAYMENT_VERIFICATION_WORKERS', 4)
+
+
+def get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=get_verification_workers(),
+                                           thread_name_prefix='payment-verification')
+        return _executor
+
+
+def payment_status_key(transaction_uuid):
+    return f"payment:status:{transaction_uuid}"
+
+
+def get_verification_window():
+    return getattr(settings, 'PAYMENT_VERIFICATION_WINDOW', 60)
+
+
+def claim_verification(transaction_uuid):
+    """True for the first unsigned callback of a payment in PAYMENT_VERIFICATION_WINDOW seconds.
+
+    Unsigned callbacks have no transaction code for record_callback to
+    deduplicate on, so a burst of them would each ask eSewa; only the first
+    verifies, the others are answered from the payment as it is.
+    """
+    return cache.add(f"payment:verifying:{transaction_uuid}", True, get_verification_window())
+
+
+def trust_reported_status(payment, reported_status, transaction_code):
+    """Default verifier: accept the status the callback reported."""
+    return reported_status
+
+
+def verify_with_gateway(payment, reported_status, transaction_code):
+    """Verifier asking eSewa for the payment's status; the callback's own claim is not trusted."""
+    try:
+        gateway_status = get_gateway().check_status(payment.transaction_uuid, payment.total_amount,
+                                                    payment.product_code)
+    except GatewayError as e:
+        logger.warning(f"Could not verify payment {payment.transaction_uuid}: {e}")
+        return 'PENDING'
+    return 'PENDING' if gateway_status in GATEWAY_UNSETTLED_STATUSES else gateway_status
+
+
+def get_verifier():
+    """settings.PAYMENT_VERIFIER: dotted path to a callable(payment, reported_status, transaction_code)
+    returning the payment's actual status, or 'PENDING' when the gateway does not know yet."""
+    return import_string(getattr(settings, 'PAYMENT_VERIFIER', 'myapp.payments.verify_with_gateway'))
+
+
+def transition_payments(payments, status_code, **fields):
+    """Move payments (a queryset) to `status_code` where PAYMENT_TRANSITIONS allows it; returns the count."""
+    sources = [source for source, targets in PAYMENT_TRANSITIONS.items() if status_code in targets]
+    return payments.filter(status__in=sources).update(status=status_code, updated_at=timezone.now(), **fields)
+
+
+def record_callback(payment, transaction_code):
+    """Claim `transaction_code` for a PENDING payment; False when an earlier callback already did.
+
+    Later callbacks for the payment are not verified again; if the first
+    verification could not settle it, the reconciler picks it up. The code is
+    unique across payments (payment_transaction_code_uniq), so the same eSewa
+    transaction can not settle two payments: IntegrityError is raised then.
+    """
+    with transaction.atomic():
+        return bool(userPayment.objects.filter(
+            pk=payment.pk, status='PENDING', transaction_code__isnull=True
+        ).update(transaction_code=transaction_code, updated_at=timezone.now()))
+
+
+def commit_paid_order(payment):
+    """Take the stock held for a paid payment's order; returns the events to publish with it.
+
+    Must run inside transaction.atomic(). When less than the order total was
+    paid, or the holds expired and the stock went to someone else, the order is
+    marked unfulfillable instead, its holds are released and a refund is
+    requested (payment_refund_needed).
+    """
+    order = payment.order
+    if payment.total_amount < order.total_price:
+        reason = f"Paid {payment.total_amount} for an order of {order.total_price}."
+    else:
+        try:
+            with transaction.atomic():
+                commit_reservations(order)
+            return []
+        except InsufficientStock as e:
+            # The holds expired and the stock went to someone else before the payment arrived
+            reason = str(e)
+    logger.error(f"Paid order for transaction {payment.transaction_uuid} cannot be fulfilled: {reason}")
+    release_reservations(order)
+    Order.objects.filter(pk=order.pk).update(status='unfulfillable', updated_at=timezone.now())
+    order.status = 'unfulfillable'
+    return [order_status_changed(order), payment_refund_needed(payment, reason)]
+
+
+def settle_payment(payment, status_code, transaction_code=None):
+    """Store a verified payment status and settle the order's stock holds or the booking.
+
+    A payment that already left that state (a duplicate callback, or the
+    reconciler got there first) is left alone and None is returned. A paid
+    order whose stock is gone is marked unfulfillable (see commit_paid_order).
+    """
+    fields = {'transaction_code': transaction_code} if transaction_code else {}
+    with transaction.atomic():
+        if not transition_payments(userPayment.objects.filter(pk=payment.pk), status_code, **fields):
+            return None
+        payment = userPayment.objects.select_related('order').get(pk=payment.pk)
+
+        # Turn the order's stock holds into real stock changes, or give them back
+        events = [payment_status_changed(payment, status_code)]
+        if payment.order and status_code in PAYMENT_SUCCESS_STATUSES:
+            events += commit_paid_order(payment)
+        elif payment.order and status_code in PAYMENT_FAILURE_STATUSES:
+            release_reservations(payment.order)
+
+        if payment.booking_id and status_code in PAYMENT_SUCCESS_STATUSES:
+            Booking.objects.filter(pk=payment.booking_id).update(status='confirmed', payment_status='paid')
+            events.append(booking_status_changed(payment.booking_id, 'confirmed'))
+        elif payment.booking_id and status_code in PAYMENT_FAILURE_STATUSES:
+            Booking.objects.filter(pk=payment.booking_id).update(payment_status='failed')
+        publish(*events)
+
+    # Lets long-polling clients see the outcome without querying the database
+    cache.set(payment_status_key(payment.transaction_uuid), status_code, 5 * 60)
+    return payment
+
+
+def verify_payment(payment_id, reported_status, transaction_code=None):
+    """Check a callback's outcome with the verifier and settle the payment. Returns the status."""
+    payment = userPayment.objects.only('id', 'transaction_uuid', 'total_amount', 'product_code', 'status').get(
+        pk=payment_id)
+    status_code = get_verifier()(payment, reported_status, transaction_code)
+    if status_code == 'PENDING':
+        return status_code
+    settled = settle_payment(payment, status_code, transaction_code)
+    if settled is None:
+        return userPayment.objects.values_list('status', flat=True).get(pk=payment_id)
+    logger.info(f"Payment {payment.transaction_uuid} verified as {status_code}")
+    return status_code
+
+
+def run_verification(payment_id, reported_status, transaction_code):
+    try:
+        verify_payment(payment_id, reported_status, transaction_code)
+    except Exception:
+        logger.exception(f"Verifying payment {payment_id} failed")
+    finally:
+        # Pool threads are not request threads, so nothing else closes their connections
+        close_old_connections()
+
+
+def forget(future):
+    with _pending_lock:
+        _pending.discard(future)
+
+
+def schedule_verification(payment, reported_status, transaction_code=None):
+    """Queue the verification of a callback for `payment`; returns immediately.
+
+    With PAYMENT_VERIFICATION_WORKERS = 0 the verification runs inline and its
+    resulting status is returned (tests and management commands); otherwise None.
+    """
+    if get_verification_workers() == 0:
+        return verify_payment(payment.pk, reported_status, transaction_code)
+
+    def submit():
+        future = get_executor().submit(run_verification, payment.pk, reported_status, transaction_code)
+        with _pending_lock:
+            _pending.add(future)
+        future.add_done_callback(forget)
+
+    # The pool uses its own connections, so it must only look once our writes are committed
+    transaction.on_commit(submit)
+    return None
+
+
+def wait_for_verifications(timeout=None):
+    """Block until every queued verification has finished; returns how many are still running."""
+    with _pending_lock:
+        futures = set(_pending)
+    _, not_done = wait(futures, timeout=timeout)
+    return len(not_done)
+
+
+def settle_in_bulk(payments, statuses):
+    """Settle verified payments with a few set-based UPDATEs; `statuses` maps payment id -> status.
+
+    Only rows still PENDING are touched, so a callback settling a payment
+    meanwhile wins. Returns {payment id: status} of the payments settled here.
+    """
+    settled = {}
+    with transaction.atomic():
+        # Lock the rows still pending; those a callback settled meanwhile are skipped
+        still_pending = set(userPayment.objects.select_for_update().filter(
+            pk__in=[payment.pk for payment in payments], status='PENDING').values_list('id', flat=True))
+        payments = [payment for payment in payments if payment.pk in still_pending]
+
+        # Taking stock needs the per-product guard, so paid orders are committed one at a time
+        events = []
+        for payment in payments:
+            status_code = statuses[payment.pk]
+            if payment.order_id and status_code in PAYMENT_SUCCESS_STATUSES:
+                events += commit_paid_order(payment)
+            settled[payment.pk] = status_code
+
+        by_status = {}
+        for pk, status_code in settled.items():
+            by_status.setdefault(status_code, []).append(pk)
+        for status_code, pks in by_status.items():
+            transition_payments(userPayment.objects.filter(pk__in=pks), status_code)
+
+        failed = [payment for payment in payments if settled.get(payment.pk) in PAYMENT_FAILURE_STATUSES]
+        paid = [payment for payment in payments if settled.get(payment.pk) in PAYMENT_SUCCESS_STATUSES]
+        StockReservation.objects.filter(
+            order_id__in=[payment.order_id for payment in failed if payment.order_id],
+            status=StockReservation.ACTIVE,
+        ).update(status=StockReservation.RELEASED)
+        Booking.objects.filter(id__in=[payment.booking_id for payment in paid if payment.booking_id]).update(
+            status='confirmed', payment_status='paid')
+        Booking.objects.filter(id__in=[payment.booking_id for payment in failed if payment.booking_id]).update(
+            payment_status='failed')
+        publish(*[payment_status_changed(payment, settled[payment.pk]) for payment in payments if payment.pk in settled],
+                *[booking_status_changed(payment.booking_id, 'confirmed') for payment in paid if payment.booking_id],
+                *events)
+
+    cache.set_many({payment_status_key(payment.transaction_uuid): settled[payment.pk]
+                    for payment in payments if payment.pk in settled}, 5 * 60)
+    return settled
+
+
+def reconcile_pending_payments(older_than, batch_size=100, workers=8, limit=None):
+    """Verify PENDING payments created more than `older_than` (a timedelta) ago and settle them.
+
+    Payments are read oldest first in batches (the payment_pending_idx index);
+    each batch is checked with the gateway on up to `workers` threads, which
+    only make HTTP calls, then settled in bulk. Payments the gateway can not
+    settle yet stay PENDING for the next run.
+    Returns metrics: checked, settled (per status), still_pending, seconds,
+    per_second, and the age in seconds of the oldest settled and of the oldest
+    still pending payment.
+    """
+    started = time.perf_counter()
+    now = timezone.now()
+    pending = userPayment.objects.filter(status='PENDING', created_at__lte=now - older_than).select_related(
+        'order').only('id', 'transaction_uuid', 'total_amount', 'product_code', 'created_at', 'order', 'booking_id')
+    verifier = get_verifier()
+
+    def verify(payment):
+        try:
+            return verifier(payment, None, None)
+        except Exception:
+            logger.exception(f"Verifying payment {payment.transaction_uuid} failed")
+            return 'PENDING'
+
+    stats = {'checked': 0, 'settled': {}, 'still_pending': 0, 'oldest_settled_age': None, 'oldest_pending_age': None}
+    last = None
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='payment-reconciliation') as pool:
+        while limit is None or stats['checked'] < limit:
+            batch = pending.order_by('created_at', 'id')
+            if last is not None:
+                # Keyset: resume after the last payment seen, including those left pending
+                batch = batch.filter(Q(created_at__gt=last.created_at) | Q(created_at=last.created_at, id__gt=last.id))
+            size = batch_size if limit is None else min(batch_size, limit - stats['checked'])
+            payments = list(batch[:size])
+            if not payments:
+                break
+            last = payments[-1]
+
+            statuses = dict(zip((payment.pk for payment in payments), pool.map(verify, payments)))
+            verified = [payment for payment in payments if statuses[payment.pk] not in (None, 'PENDING')]
+            settled = settle_in_bulk(verified, statuses)
+
+            stats['checked'] += len(payments)
+            for payment in payments:
+                age = (now - payment.created_at).total_seconds()
+                if payment.pk in settled:
+                    stats['settled'][settled[payment.pk]] = stats['settled'].get(settled[payment.pk], 0) + 1
+                    stats['oldest_settled_age'] = max(stats['oldest_settled_age'] or 0, age)
+                else:
+                    stats['still_pending'] += 1
+                    stats['oldest_pending_age'] = max(stats['oldest_pending_age'] or 0, age)
+
+    stats['seconds'] = time.perf_counter() - started
+    stats['per_second'] = stats['checked'] / stats['seconds'] if stats['seconds'] else 0
+    return stats
@@ -0,0 +1,195 @@
+"""Full-text product search.
+
+Products are indexed over name, generic_name, description and category so the
+storefront search box does not have to run LIKE '%term%' over every row.
+The backend is picked from settings.PRODUCT_SEARCH_BACKEND (a dotted path) or,
+when that is not set, from the database vendor:
+
+* sqlite     -> SQLiteFTSSearchBackend (FTS5 virtual table kept in sync by signals)
+* postgresql -> PostgresSearchBackend (GIN index on a tsvector expression)
+* anything else falls back to IcontainsSearchBackend.
+"""
+import re
+
+from django.conf import settings
+from django.db import connections
+from django.db.models import Q
+from django.utils.module_loading import import_string
+
+from .models import Product
+
+FTS_TABLE = 'myapp_product_fts'
+
+CATEGORY_LABELS = dict(Product.CATEGORIES)
+
+
+def category_label_sql(column):
+    """SQL giving a category code's label, so Postgres indexes the same words as the FTS5 table."""
+    cases = ' '.join(f"WHEN '{code}' THEN '{label}'" for code, label in CATEGORY_LABELS.items())
+    return f"CASE {column} {cases} ELSE '' END"
+
+
+# Same expression as the GIN index created in migration 0045, so Postgres can use it.
+# Changing the category labels needs a migration recreating that index.
+POSTGRES_DOCUMENT = (
+    "to_tsvector('simple', coalesce(p.name, '') || ' ' || coalesce(p.generic_name, '') || ' ' "
+    f"|| coalesce(p.description, '') || ' ' || p.category || ' ' || {category_label_sql('p.category')})"
+)
+
+
+def search_terms(query):
+    """Split a raw search box string into lowercase word tokens."""
+    return re.findall(r'\w+', query.lower())
+
+
+class IcontainsSearchBackend:
+    """The original LIKE '%query%' scan over name and description. Keeps no index;
+    used on databases without a full-text backend and as the benchmark baseline."""
+
+    def __init__(self, using='default'):
+        self.using = using
+
+    def search(self, query, category=None, limit=20, offset=0):
+        query = query.strip()
+        if not query:
+            return []
+
+        filters = Q(name__icontains=query) | Q(description__icontains=query)
+        if category:
+            filters &= Q(category=category)
+        products = Product.objects.using(self.using).filter(filters).order_by('id')
+        return list(products.values_list('id', flat=True)[offset:offset + limit])
+
+    def index_product(self, product):
+        pass
+
+    def remove_product(self, product_id):
+        pass
+
+    def rebuild(self):
+        pass
+
+
+class SQLiteFTSSearchBackend:
+    """Ranked prefix search over an FTS5 table whose rowid is the product id."""
+
+    # bm25 column weights: name, generic_name, category, description
+    RANK = f"bm25({FTS_TABLE}, 10.0, 8.0, 2.0, 1.0)"
+
+    def __init__(self, using='default'):
+        self.using = using
+
+    @staticmethod
+    def match_expression(terms):
+        # Every term has to match, and each one matches as a prefix ("parac" -> "paracetamol")
+        return ' '.join('"{}"*'.format(term.replace('"', '""')) for term in terms)
+
+    @staticmethod
+    def document(product):
+        return (
+            product.name or '',
+            product.generic_name or '',
+            f"{product.category} {CATEGORY_LABELS.get(product.category, '')}",
+            product.description or '',
+        )
+
+    def search(self, query, category=None, limit=20, offset=0):
+        terms = search_terms(query)
+        if not terms:
+            return []
+
+        sql = f"SELECT f.rowid FROM {FTS_TABLE} f"
+        params = [self.match_expression(terms)]
+        if category:
+            sql += " JOIN myapp_product p ON p.id = f.rowid"
+        sql += f" WHERE {FTS_TABLE} MATCH %s"
+        if category:
+            sql += " AND p.category = %s"
+            params.append(category)
+        sql += f" ORDER BY {self.RANK} LIMIT %s OFFSET %s"
+        params += [limit, offset]
+
+        with connections[self.using].cursor() as cursor:
+            cursor.execute(sql, params)
+            return [row[0] for row in cursor.fetchall()]
+
+    def index_product(self, product):
+        with connections[self.using].cursor() as cursor:
+            cursor.execute(f"DELETE FROM {FTS_TABLE} WHERE rowid = %s", [product.pk])
+            cursor.execute(
+                f"INSERT INTO {FTS_TABLE} (rowid, name, generic_name, category, description) "
+                f"VALUES (%s, %s, %s, %s, %s)",
+                [product.pk, *self.document(product)]
+            )
+
+    def remove_product(self, product_id):
+        with connections[self.using].cursor() as cursor:
+            cursor.execute(f"DELETE FROM {FTS_TABLE} WHERE rowid = %s", [product_id])
+
+    def rebuild(self):
+        """Re-index every product, e.g. after bulk_create/update which skip signals."""
+        fields = ('id', 'name', 'generic_name', 'category', 'description')
+        with connections[self.using].cursor() as cursor:
+            cursor.execute(f"DELETE FROM {FTS_TABLE}")
+            cursor.executemany(
+                f"INSERT INTO {FTS_TABLE} (rowid, name, generic_name, category, description) "
+                f"VALUES (%s, %s, %s, %s, %s)",
+                [
+                    [product.pk, *self.document(product)]
+                    for product in Product.objects.using(self.using).only(*fields).iterator()
+                ]
+            )
+
+
+class PostgresSearchBackend:
+    """Ranked prefix search with to_tsquery over an expression GIN index.
+
+    The index is computed by Postgres itself, so nothing needs syncing on save.
+    """
+
+    def __init__(self, using='default'):
+        self.using = using
+
+    def search(self, query, category=None, limit=20, offset=0):
+        terms = search_terms(query)
+        if not terms:
+            return []
+
+        tsquery = ' & '.join(f"{term}:*" for term in terms)
+        sql = (
+            f"SELECT p.id FROM myapp_product p "
+            f"WHERE {POSTGRES_DOCUMENT} @@ to_tsquery('simple', %s)"
+        )
+        params = [tsquery]
+        if category:
+            sql += " AND p.category = %s"
+            params.append(category)
+        sql += f" ORDER BY ts_rank({POSTGRES_DOCUMENT}, to_tsquery('simple', %s)) DESC, p.id LIMIT %s OFFSET %s"
+        params += [tsquery, limit, offset]
+
+        with connections[self.using].cursor() as cursor:
+            cursor.execute(sql, params)
+            return [row[0] for row in cursor.fetchall()]
+
+    def index_product(self, product):
+        pass
+
+    def remove_product(self, product_id):
+        pass
+
+    def rebuild(self):
+        pass
+
+
+VENDOR_BACKENDS = {
+    'sqlite': SQLiteFTSSearchBackend,
+    'postgresql': PostgresSearchBackend,
+}
+
+
+def get_search_backend(using='default'):
+    backend_path = getattr(settings, 'PRODUCT_SEARCH_BACKEND', None)
+    if backend_path:
+        return import_string(backend_path)(using=using)
+    backend_class = VENDOR_BACKENDS.get(connections[using].vendor, IcontainsSearchBackend)
+    return backend_class(using=using)
@@ -5,6 +5,8 @@ from rest_framework_simplejwt.tokens import RefreshToken
 from rest_framework_simplejwt.serializers import TokenObtainPairSerializer
 from .models import Product, CustomUser, Cart, CartItem, Order, Booking
 from rest_framework import generics
+from django.db.models import DecimalField, ExpressionWrapper, F, Prefetch, Sum
+from decimal import Decimal
 
 # User Serializer for creating and managing users (register)
 class RegisterSerializer(serializers.ModelSerializer):
@@ -73,6 +75,15 @@ class ProductSerializer(serializers.ModelSerializer):
         model = Product
         fields = ['id', 'name', 'price', 'image', 'prescription_required', 'category', 'description']
 
+    def __init__(self, *args, **kwargs):
+        # Optional sparse fieldset, e.g. ProductSerializer(products, many=True, fields=['id', 'name'])
+        fields = kwargs.pop('fields', None)
+        super().__init__(*args, **kwargs)
+
+        if fields is not None:
+            for field_name in set(self.fields) - set(fields):
+                self.fields.pop(field_name)
+
 # CartItem Serializer
 class CartItemSerializer(serializers.ModelSerializer):
     product = ProductSerializer()
@@ -82,6 +93,79 @@ class CartItemSerializer(serializers.ModelSerializer):
         fields = ['product', 'quantity']
 
 
+# Flat cart line used by every cart endpoint (add/remove/update/view)
+class CartLineSerializer(serializers.ModelSerializer):
+    product_id = serializers.IntegerField(read_only=True)
+    name = serializers.CharField(source='product.name', read_only=True)
+    price = serializers.FloatField(source='product.price', read_only=True)
+    total_item_price = serializers.FloatField(source='line_total', read_only=True)
+    image = serializers.SerializerMethodField()
+    prescription = serializers.SerializerMethodField()
+
+    class Meta:
+        model = CartItem
+        fields = ['id', 'product_id', 'name', 'quantity', 'price', 'total_item_price', 'image', 'prescription']
+
+    def absolute_url(self, file_field):
+        if not file_field:
+            return None
+        request = self.context.get('request')
+        return request.build_absolute_uri(file_field.url) if request else file_field.url
+
+    def get_image(self, obj):
+        return self.absolute_url(obj.product.image)
+
+    def get_prescription(self, obj):
+        return self.absolute_url(obj.prescription_file)
+
+
+def get_cart_lines(cart):
+    """Cart items with their product joined in and the line total computed by the database."""
+    return cart.cart_items.select_related('product').annotate(
+        line_total=ExpressionWrapper(F('product__price') * F('quantity'),
+                                     output_field=DecimalField(max_digits=12, decimal_places=2))
+    ).order_by('id')
+
+
+def serialize_cart(cart, request):
+    """Render a cart as {'cart_items': [...], 'total_price': ...} with a single query for the lines."""
+    items = list(get_cart_lines(cart)) if cart else []
+    total_price = sum((item.line_total for item in items), Decimal('0'))
+    return {
+        'cart_items': CartLineSerializer(items, many=True, context={'request': request}).data,
+        'total_price': float(total_price),
+        'revision': cart.revision if cart else 0,
+    }
+
+
+def serialize_cart_delta(cart, request, product_id):
+    """Render only the line for `product_id` (None if it was removed), the new total and the revision.
+
+    Lets clients patch their local copy of a large cart instead of re-reading every line.
+    """
+    line = get_cart_lines(cart).filter(product_id=product_id).first()
+    total_price = cart.cart_items.aggregate(
+        total=Sum(F('product__price') * F('quantity'), output_field=DecimalField(max_digits=12, decimal_places=2))
+    )['total'] or Decimal('0')
+    return {
+        'product_id': product_id,
+        'line': CartLineSerializer(line, context={'request': request}).data if line else None,
+        'total_price': float(total_price),
+        'revision': cart.revision,
+    }
+
+
+def bump_cart_revision(cart):
+    Cart.objects.filter(pk=cart.pk).update(revision=F('revision') + 1)
+    cart.refresh_from_db(fields=['revision'])
+
+
+# One operation of a batch cart update; quantity 0 removes the line
+class CartBatchItemSerializer(serializers.Serializer):
+    product_id = serializers.IntegerField()
+    quantity = serializers.IntegerField(min_value=0)
+
+
 # Cart Serializer
 class CartSerializer(serializers.ModelSerializer):
     items = CartItemSerializer(many=True)
@@ -91,19 +175,49 @@ class CartSerializer(serializers.ModelSerializer):
         fields = ['id', 'items']
 
 
+# One line of a placed order, read from the snapshot taken when it was ordered
+class OrderLineSerializer(serializers.ModelSerializer):
+    product_id = serializers.IntegerField(read_only=True)
+    price = serializers.DecimalField(source='unit_price', max_digits=10, decimal_places=2, read_only=True)
+
+    class Meta:
+        model = CartItem
+        fields = ['product_id', 'product_name', 'quantity', 'price', 'total_price']
+
+
+# Order history entry; expects cartitem_set prefetched (see get_order_history)
+class OrderHistorySerializer(serializers.ModelSerializer):
+    order_id = serializers.IntegerField(source='id', read_only=True)
+    cart_items = OrderLineSerializer(source='cartitem_set', many=True, read_only=True)
+
+    class Meta:
+        model = Order
+        fields = ['order_id', 'total_price', 'status', 'address', 'created_at', 'cart_items']
+
+
+def with_order_items(queryset, lookup='cartitem_set'):
+    """Prefetch order lines, as OrderSerializer and OrderHistorySerializer read them.
+
+    The lines carry their own name and price snapshot, so the catalog is not joined.
+    Pass e.g. lookup='order__cartitem_set' for a queryset of payments.
+    """
+    return queryset.prefetch_related(Prefetch(lookup, queryset=CartItem.objects.order_by('id')))
+
+
+def get_order_history(user):
+    """The user's orders with every line loaded in one extra query per page."""
+    return with_order_items(Order.objects.filter(user=user))
+
+
 # Order Serializer (includes CartItem details for the order)
 class OrderSerializer(serializers.ModelSerializer):
-    items = serializers.SerializerMethodField()
+    # Reads the lines prefetched by with_order_items(), so listing orders never queries per order
+    items = OrderLineSerializer(source='cartitem_set', many=True, read_only=True)
 
     class Meta:
         model = Order
         fields = ['id', 'user', 'items', 'total_price', 'status', 'created_at']
 
-    def get_items(self, obj):
-        # Fetch related CartItems for the order
-        cart_items = CartItem.objects.filter(order=obj)
-        return CartItemSerializer(cart_items, many=True).data
-
 
 
 from .models import Service, Booking, BookingReport
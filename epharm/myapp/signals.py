@@ -0,0 +1,53 @@
+from functools import partial
+
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+
+from .availability import invalidate_day
+from .cache import bump_catalog_version
+from .models import Booking, Product
+from .search import get_search_backend
+from .suggest import suggestion_index
+
+
+# Keep the search index, the suggestion index and the catalog cache in sync with
+# the catalog. The search index is a table, written in the same transaction. The
+# in-memory suggestion index and the cache version are updated after commit, so
+# a rollback leaves nothing behind and a concurrent request cannot cache the
+# pre-commit rows under the new version.
+@receiver(post_save, sender=Product)
+def index_product(sender, instance, using, **kwargs):
+    get_search_backend(using).index_product(instance)
+    transaction.on_commit(partial(suggestion_index.update_product, instance), using=using)
+    transaction.on_commit(bump_catalog_version, using=using)
+
+
+@receiver(post_delete, sender=Product)
+def unindex_product(sender, instance, using, **kwargs):
+    get_search_backend(using).remove_product(instance.pk)
+    transaction.on_commit(partial(suggestion_index.remove_product, instance.pk), using=using)
+    transaction.on_commit(bump_catalog_version, using=using)
+
+
+# A booking made, cancelled or edited changes which slots of its day are free. An edit
+# may also move it to another day or service, which frees a slot of the day it leaves.
+@receiver(pre_save, sender=Booking)
+def remember_booked_day(sender, instance, using, update_fields=None, **kwargs):
+    instance._booked_day = None
+    if instance.pk and (update_fields is None or {'service', 'booking_date'} & set(update_fields)):
+        instance._booked_day = Booking.objects.using(using).filter(pk=instance.pk).values_list(
+            'service_id', 'booking_date').first()
+
+
+@receiver(post_save, sender=Booking)
+@receiver(post_delete, sender=Booking)
+def invalidate_availability(sender, instance, using, **kwargs):
+    days = {(instance.service_id, str(instance.booking_date))}
+    if getattr(instance, '_booked_day', None):
+        days.add((instance._booked_day[0], str(instance._booked_day[1])))
+
+    def invalidate():
+        for service_id, day in days:
+            invalidate_day(service_id, day)
+    transaction.on_commit(invalidate, using=using)
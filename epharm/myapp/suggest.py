@@ -0,0 +1,202 @@
+"""Typo tolerant autocomplete over product names and generic names.
+
+The index lives in process memory: trigram -> terms, so a suggestion request
+never touches the database once the index is loaded. It is loaded lazily on the
+first request and then kept up to date by the Product save/delete signals, once
+the change is committed. Each process keeps its own copy, capped at
+settings.PRODUCT_SUGGEST_MAX_TERMS terms; a change also bumps a version in the
+shared cache, and the other processes reload their copy when they see it moved.
+"""
+import logging
+import threading
+from collections import Counter, defaultdict
+
+from django.conf import settings
+
+from .cache import bump_version, get_version
+from .models import Product
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_TERMS = 100000
+VERSION_KEY = 'catalog:suggest_version'
+
+# How many trigram candidates get the (more expensive) edit distance check
+CANDIDATES_TO_SCORE = 50
+
+
+def normalize(text):
+    return ' '.join(text.lower().split())
+
+
+def trigrams(text, pad_end=True):
+    # Pad the start so short prefixes ("pa") still produce trigrams. Queries are
+    # not padded at the end because they are usually an unfinished word.
+    padded = f"  {text} " if pad_end else f"  {text}"
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def max_edits_for(query):
+    if len(query) <= 3:
+        return 0
+    if len(query) <= 6:
+        return 1
+    return 2
+
+
+def prefix_edit_distance(query, term, max_edits=None):
+    """Smallest Levenshtein distance between `query` and any prefix of `term`.
+
+    "paracetmol" vs "paracetamol 500mg" -> 1. One DP pass over the term, the last
+    cell of each column is the distance to term[:j]. With `max_edits` the pass stops
+    as soon as no prefix can get within that distance (the result is then > max_edits).
+    """
+    column = list(range(len(query) + 1))
+    best = column[-1]
+    for j, term_char in enumerate(term, start=1):
+        previous_diagonal, column[0] = column[0], j
+        for i, query_char in enumerate(query, start=1):
+            cost = 0 if query_char == term_char else 1
+            previous_diagonal, column[i] = column[i], min(
+                column[i] + 1,               # deletion
+                column[i - 1] + 1,           # insertion
+                previous_diagonal + cost,    # substitution
+            )
+        best = min(best, column[-1])
+        # Once the term is much longer than the query the distance can only grow
+        if j - len(query) > best:
+            break
+        # Every alignment is already over budget, longer prefixes cannot do better
+        if max_edits is not None and min(column) > max_edits:
+            break
+    return best
+
+
+class SuggestionIndex:
+    def __init__(self, max_terms=None):
+        self.max_terms = max_terms
+        self.lock = threading.RLock()
+        self.clear()
+
+    def clear(self):
+        """Drop everything; the next lookup reloads the index from the database."""
+        with self.lock:
+            self.loaded = False
+            self.version = None                    # shared version the loaded copy is current with
+            self.full = False
+            self.terms = {}                        # normalized term -> display text
+            self.term_products = defaultdict(set)  # normalized term -> product ids
+            self.product_terms = {}                # product id -> normalized terms
+            self.grams = defaultdict(set)          # trigram -> normalized terms
+
+    def get_max_terms(self):
+        if self.max_terms is not None:
+            return self.max_terms
+        return getattr(settings, 'PRODUCT_SUGGEST_MAX_TERMS', DEFAULT_MAX_TERMS)
+
+    def load(self):
+        """Load the index, or reload it when another process changed the products since."""
+        version = get_version(VERSION_KEY)
+        with self.lock:
+            if self.loaded and self.version == version:
+                return
+            if self.loaded:
+                self.clear()
+            for product_id, name, generic_name in Product.objects.values_list('id', 'name', 'generic_name').iterator():
+                self._add(product_id, [name, generic_name])
+            self.version = version
+            self.loaded = True
+            logger.info(f"Loaded product suggestion index with {len(self.terms)} terms")
+
+    def _add(self, product_id, texts):
+        keys = set()
+        for text in texts:
+            key = normalize(text or '')
+            if not key:
+                continue
+            if key not in self.terms:
+                if len(self.terms) >= self.get_max_terms():
+                    if not self.full:
+                        logger.warning("Product suggestion index is full, skipping new terms")
+                        self.full = True
+                    continue
+                self.terms[key] = text.strip()
+                for gram in trigrams(key):
+                    self.grams[gram].add(key)
+            self.term_products[key].add(product_id)
+            keys.add(key)
+        self.product_terms[product_id] = keys
+
+    def _remove(self, product_id):
+        for key in self.product_terms.pop(product_id, ()):
+            products = self.term_products[key]
+            products.discard(product_id)
+            if products:
+                continue
+            # Last product using this term: drop it from the index
+            del self.term_products[key]
+            del self.terms[key]
+            for gram in trigrams(key):
+                self.grams[gram].discard(key)
+                if not self.grams[gram]:
+                    del self.grams[gram]
+
+    def update_product(self, product):
+        """Apply a committed product change here and have the other processes reload."""
+        texts = [product.name, product.generic_name]
+        with self.lock:
+            if self.loaded:
+                if self.product_terms.get(product.pk) == {normalize(text or '') for text in texts} - {''}:
+                    return  # names unchanged (e.g. a stock edit)
+                self._remove(product.pk)
+                self._add(product.pk, texts)
+            self._changed()
+
+    def remove_product(self, product_id):
+        with self.lock:
+            if self.loaded:
+                self._remove(product_id)
+            self._changed()
+
+    def _changed(self):
+        version = bump_version(VERSION_KEY)
+        # Nobody else changed the products since this copy was loaded, so it is still complete
+        if self.loaded and version == self.version + 1:
+            self.version = version
+
+    def suggest(self, query, limit=10):
+        query = normalize(query)
+        if not query:
+            return []
+        self.load()
+
+        with self.lock:
+            postings = sorted((self.grams.get(gram, ()) for gram in trigrams(query, pad_end=False)), key=len)
+
+            # q-gram count filter: a term within max_edits of the query shares at least
+            # len(postings) - 3 * max_edits of its trigrams, so it has to appear in one
+            # of the rarest len(postings) - min_shared + 1 posting lists.
+            max_edits = max_edits_for(query)
+            min_shared = max(len(postings) - 3 * max_edits, 1)
+            candidates = set().union(*postings[:len(postings) - min_shared + 1])
+
+            counts = Counter()
+            for posting in postings:
+                counts.update(candidates.intersection(posting))
+            overlap = Counter({key: shared for key, shared in counts.items() if shared >= min_shared})
+
+            scored = []
+            for key, shared in overlap.most_common(CANDIDATES_TO_SCORE):
+                distance = prefix_edit_distance(query, key, max_edits)
+                if distance <= max_edits:
+                    scored.append((distance, -shared, len(key), key))
+
+            scored.sort()
+            return [{
+                'text': self.terms[key],
+                'distance': distance,
+                'product_ids': sorted(self.term_products[key])[:5],
+            } for distance, _, _, key in scored[:limit]]
+
+
+suggestion_index = SuggestionIndex()
@@ -3,12 +3,59 @@ from django.urls import reverse
 from rest_framework import status
 from rest_framework.test import APIClient
 from django.contrib.auth import get_user_model
-from myapp.models import Product, Service, Order, userPayment
+from myapp.models import (Booking, Cart, CartItem, IdempotencyKey, OutboxEvent, Product, Service, ServiceSchedule,
+                          Order, StockReservation, userPayment)
+import base64
+import importlib
 import json
+import sqlite3
+import threading
+import time
 import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import StringIO
+from unittest import mock
+from urllib.error import HTTPError
+from urllib.parse import urlencode
+from urllib.request import urlopen
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection, connections, transaction
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from myapp import inventory, payments, suggest
+from myapp.cache import bump_version, get_cache_stats
+from myapp.db import ReadReplicaRouter, configure_sqlite, pin_key
+from myapp.fake_esewa import FakeEsewa
+from myapp.idempotency import get_key_ttl, purge_expired_keys
+from myapp.inventory import hold_stock
+from myapp.management.commands.check_query_plans import full_scans
+from myapp.outbox import dispatch_events, publish
+from myapp.payments import settle_payment
+from myapp.search import CATEGORY_LABELS, POSTGRES_DOCUMENT
+from myapp.suggest import VERSION_KEY
 
 User = get_user_model()
 
+@pytest.fixture(autouse=True)
+def clear_cache():
+    cache.clear()
+
+@pytest.fixture(autouse=True)
+def inline_payment_verification(settings):
+    # Verify payment callbacks in the request so tests can assert on the outcome
+    settings.PAYMENT_VERIFICATION_WORKERS = 0
+
+@pytest.fixture
+def esewa(settings):
+    # Local stand-in for eSewa, which payment callbacks are verified against
+    with FakeEsewa() as fake:
+        settings.ESEWA_STATUS_URL = fake.status_url
+        yield fake
+
 @pytest.fixture
 def api_client():
     return APIClient()
@@ -38,6 +85,11 @@ def authenticated_client(api_client, create_user):
     api_client.credentials(HTTP_AUTHORIZATION=f'Bearer {token}')
     return api_client
 
+@pytest.fixture
+def force_authenticated_client(api_client, create_user):
+    api_client.force_authenticate(user=create_user)
+    return api_client
+
 @pytest.fixture
 def sample_product():
     return Product.objects.create(
@@ -97,8 +149,45 @@ def test_get_products(api_client, sample_product):
     url = reverse('myapp:products')
     response = api_client.get(url)
     assert response.status_code == status.HTTP_200_OK
-    assert len(response.data) == 1
-    assert response.data[0]['name'] == 'Test Product'
+    assert len(response.data['results']) == 1
+    assert response.data['results'][0]['name'] == 'Test Product'
+
+@pytest.mark.django_db
+def test_get_products_cursor_pagination(api_client):
+    for i in range(5):
+        Product.objects.create(name=f'Product {i}', category='OTC', price=i)
+
+    url = reverse('myapp:products')
+    response = api_client.get(url, {'page_size': 2})
+    assert response.status_code == status.HTTP_200_OK
+    assert [p['name'] for p in response.data['results']] == ['Product 0', 'Product 1']
+    assert response.data['previous'] is None
+
+    seen = [p['id'] for p in response.data['results']]
+    next_url = response.data['next']
+    while next_url:
+        response = api_client.get(next_url)
+        seen += [p['id'] for p in response.data['results']]
+        next_url = response.data['next']
+    assert seen == sorted(Product.objects.values_list('id', flat=True))
+
+@pytest.mark.django_db
+def test_get_products_sparse_fields(api_client, sample_product):
+    url = reverse('myapp:products')
+    response = api_client.get(url, {'fields': 'name,price'})
+    assert response.status_code == status.HTTP_200_OK
+    assert response.data['results'] == [{'id': sample_product.id, 'name': 'Test Product', 'price': '10.99'}]
+
+    response = api_client.get(url, {'fields': 'name,secret'})
+    assert response.status_code == status.HTTP_400_BAD_REQUEST
+
+@pytest.mark.django_db
+def test_get_products_query_count_is_constant(api_client, django_assert_num_queries):
+    Product.objects.bulk_create([Product(name=f'Product {i}', category='OTC') for i in range(120)])
+    url = reverse('myapp:products')
+    with django_assert_num_queries(1):
+        response = api_client.get(url, {'page_size': 100})
+    assert len(response.data['results']) == 100
 
 @pytest.mark.django_db
 def test_get_product_detail(api_client, sample_product):
@@ -108,6 +197,136 @@ def test_get_product_detail(api_client, sample_product):
     assert response.data['name'] == 'Test Product'
     assert response.data['price'] == '10.99'
 
+@pytest.mark.django_db
+def test_catalog_cache_is_keyed_by_host(api_client):
+    Product.objects.bulk_create([Product(name=f'Product {i}', category='OTC') for i in range(3)])
+    url = reverse('myapp:products')
+    for host in ('shop.example.com', 'api.example.com', 'shop.example.com'):
+        response = api_client.get(url, {'page_size': 1}, HTTP_HOST=host)
+        assert response.json()['next'].startswith(f'http://{host}/')
+
+@pytest.mark.django_db
+def test_catalog_responses_are_cached_per_version(api_client, sample_product, django_assert_num_queries,
+                                                  django_capture_on_commit_callbacks):
+    url = reverse('myapp:product-detail', kwargs={'pk': sample_product.id})
+    first = api_client.get(url)
+    etag = first['ETag']
+
+    with django_assert_num_queries(0):
+        cached = api_client.get(url)
+    assert cached.status_code == status.HTTP_200_OK
+    assert cached.content == first.content
+
+    not_modified = api_client.get(url, HTTP_IF_NONE_MATCH=etag)
+    assert not_modified.status_code == status.HTTP_304_NOT_MODIFIED
+
+    # Editing the product bumps the catalog version and invalidates the entry
+    with django_capture_on_commit_callbacks(execute=True):
+        sample_product.name = 'Renamed Product'
+        sample_product.save()
+    response = api_client.get(url, HTTP_IF_NONE_MATCH=etag)
+    assert response.status_code == status.HTTP_200_OK
+    assert response.json()['name'] == 'Renamed Product'
+
+    stats = get_cache_stats()
+    assert (stats['hits'], stats['misses'], stats['not_modified']) == (1, 2, 1)
+
+# Search Tests
+@pytest.mark.django_db
+def test_search_products_prefix_and_ranking(api_client, django_capture_on_commit_callbacks):
+    Product.objects.create(name='Cold Relief', category='OTC', description='Contains paracetamol 500mg')
+    paracetamol = Product.objects.create(name='Paracetamol 500mg', generic_name='paracetamol', category='OTC')
+    Product.objects.create(name='Amoxicillin', category='RX')
+
+    url = reverse('myapp:product-search')
+    response = api_client.get(url, {'search': 'parac'})
+    assert response.status_code == status.HTTP_200_OK
+    names = [p['name'] for p in response.data['results']]
+    assert names == ['Paracetamol 500mg', 'Cold Relief']
+
+    response = api_client.get(url, {'search': 'parac', 'category': 'RX'})
+    assert response.data['results'] == []
+
+    # Index follows product edits and deletes
+    with django_capture_on_commit_callbacks(execute=True):
+        paracetamol.name = 'Ibuprofen'
+        paracetamol.generic_name = 'ibuprofen'
+        paracetamol.save()
+    assert [p['name'] for p in api_client.get(url, {'search': 'ibupro'}).json()['results']] == ['Ibuprofen']
+    with django_capture_on_commit_callbacks(execute=True):
+        paracetamol.delete()
+    assert api_client.get(url, {'search': 'ibupro'}).json()['results'] == []
+
+@pytest.mark.django_db
+def test_search_products_pagination(api_client):
+    for i in range(5):
+        Product.objects.create(name=f'Vitamin C {i}', category='SUP')
+
+    url = reverse('myapp:product-search')
+    response = api_client.get(url, {'search': 'vitamin', 'page_size': 3})
+    assert len(response.data['results']) == 3
+    assert response.data['previous'] is None
+
+    response = api_client.get(response.data['next'])
+    assert len(response.data['results']) == 2
+    assert response.data['next'] is None
+
+def test_postgres_search_document_matches_its_index_and_labels():
+    migration = importlib.import_module('myapp.migrations.0045_product_search_index_labels')
+    # Postgres only uses the GIN index for the very same expression
+    assert POSTGRES_DOCUMENT.replace('p.', '') == migration.NEW_DOCUMENT
+    # Category labels are searchable there too, as in the SQLite FTS5 table
+    assert all(f"THEN '{label}'" in POSTGRES_DOCUMENT for label in CATEGORY_LABELS.values())
+
+@pytest.fixture
+def suggestion_index():
+    suggest.suggestion_index.clear()
+    yield suggest.suggestion_index
+    suggest.suggestion_index.clear()
+
+@pytest.mark.django_db
+def test_suggest_products_tolerates_typos(api_client, suggestion_index):
+    paracetamol = Product.objects.create(name='Paracetamol 500mg', generic_name='Paracetamol', category='OTC')
+    Product.objects.create(name='Amoxicillin 250mg', generic_name='Amoxicillin', category='RX')
+
+    url = reverse('myapp:product-suggest')
+    response = api_client.get(url, {'q': 'paracetmol'})
+    assert response.status_code == status.HTTP_200_OK
+    assert response.data[0]['text'] == 'Paracetamol'
+    assert response.data[0]['product_ids'] == [paracetamol.id]
+
+    assert api_client.get(url, {'q': 'amoxicilin'}).data[0]['text'] == 'Amoxicillin'
+    assert api_client.get(url, {'q': 'zzzzzz'}).data == []
+
+@pytest.mark.django_db
+def test_suggest_products_index_is_updated_without_queries(api_client, suggestion_index, django_assert_num_queries,
+                                                           django_capture_on_commit_callbacks):
+    product = Product.objects.create(name='Cetirizine', category='OTC')
+    url = reverse('myapp:product-suggest')
+    assert api_client.get(url, {'q': 'cetiri'}).data[0]['text'] == 'Cetirizine'
+
+    with django_capture_on_commit_callbacks(execute=True):
+        product.name = 'Levocetirizine'
+        product.save()
+    with django_assert_num_queries(0):
+        response = api_client.get(url, {'q': 'levoceti'})
+    assert [s['text'] for s in response.data] == ['Levocetirizine']
+
+    # A rolled back change never reaches the index
+    with transaction.atomic():
+        Product.objects.create(name='Phantomycin', category='OTC')
+        transaction.set_rollback(True)
+    assert api_client.get(url, {'q': 'phantomy'}).data == []
+
+    # A change made by another process is picked up by reloading
+    Product.objects.filter(pk=product.pk).update(name='Cetirizine Syrup')
+    bump_version(VERSION_KEY)
+    assert [s['text'] for s in api_client.get(url, {'q': 'cetirizine sy'}).data] == ['Cetirizine Syrup']
+
+    with django_capture_on_commit_callbacks(execute=True):
+        product.delete()
+    assert api_client.get(url, {'q': 'levoceti'}).data == []
+
 # Cart Tests
 @pytest.mark.django_db
 def test_add_to_cart(authenticated_client, sample_product):
@@ -120,6 +339,107 @@ def test_add_to_cart(authenticated_client, sample_product):
     assert response.data['cart_items'][0]['quantity'] == 1
     assert response.data['total_price'] == float(sample_product.price)
 
+def fill_cart(user, count):
+    cart, _ = Cart.objects.get_or_create(user=user)
+    products = Product.objects.bulk_create([
+        Product(name=f'Cart Product {i}', category='OTC', price='2.50', stock=100) for i in range(count)
+    ])
+    CartItem.objects.bulk_create([CartItem(cart=cart, product=product, quantity=2) for product in products])
+    return cart
+
+@pytest.mark.django_db
+def test_view_cart_totals(force_authenticated_client, create_user):
+    fill_cart(create_user, 3)
+    response = force_authenticated_client.get(reverse('myapp:cart'))
+    assert response.status_code == status.HTTP_200_OK
+    assert [item['total_item_price'] for item in response.data['cart_items']] == [5.0, 5.0, 5.0]
+    assert response.data['total_price'] == 15.0
+
+@pytest.mark.django_db
+@pytest.mark.parametrize('cart_size', [1, 25])
+def test_cart_endpoints_query_count_is_constant(force_authenticated_client, create_user, cart_size,
+                                                 django_assert_num_queries):
+    cart = fill_cart(create_user, cart_size)
+    product_id = cart.cart_items.first().product_id
+
+    with django_assert_num_queries(2):
+        response = force_authenticated_client.get(reverse('myapp:cart'))
+    assert len(response.data['cart_items']) == cart_size
+
+    with django_assert_num_queries(6):
+        force_authenticated_client.post(reverse('myapp:update-cart-item', kwargs={'product_id': product_id}),
+                                        {'action': 'increase'})
+
+    with django_assert_num_queries(5):
+        response = force_authenticated_client.delete(reverse('myapp:remove-from-cart', kwargs={'product_id': product_id}))
+    assert len(response.data['cart_items']) == cart_size - 1
+
+@pytest.mark.django_db
+def test_cart_mutation_delta_response(force_authenticated_client, create_user):
+    cart = fill_cart(create_user, 30)
+    product_id = cart.cart_items.first().product_id
+    url = reverse('myapp:update-cart-item', kwargs={'product_id': product_id}) + '?response=delta'
+
+    response = force_authenticated_client.post(url, {'action': 'increase'})
+    assert response.status_code == status.HTTP_200_OK
+    assert 'cart_items' not in response.data
+    assert response.data['line']['quantity'] == 3
+    assert response.data['total_price'] == 30 * 5.0 + 2.5
+    assert response.data['revision'] == 1
+
+    url = reverse('myapp:remove-from-cart', kwargs={'product_id': product_id}) + '?response=delta'
+    response = force_authenticated_client.delete(url)
+    assert response.data['line'] is None
+    assert response.data['product_id'] == product_id
+    assert response.data['total_price'] == 29 * 5.0
+    assert response.data['revision'] == 2
+
+    # Full cart reads report the same revision the deltas were built on
+    assert force_authenticated_client.get(reverse('myapp:cart')).data['revision'] == 2
+
+@pytest.mark.django_db
+def test_batch_update_cart(force_authenticated_client, create_user, django_assert_max_num_queries):
+    cart = fill_cart(create_user, 3)
+    first, second, third = [item.product_id for item in cart.cart_items.order_by('id')]
+    new_product = Product.objects.create(name='New', category='OTC', price='1.00', stock=50)
+
+    url = reverse('myapp:batch-update-cart')
+    payload = {'items': [
+        {'product_id': first, 'quantity': 30},
+        {'product_id': second, 'quantity': 0},
+        {'product_id': new_product.id, 'quantity': 10},
+    ]}
+    # Fixed number of statements whatever the number of operations
+    with django_assert_max_num_queries(12):
+        response = force_authenticated_client.post(url, payload, format='json')
+    assert response.status_code == status.HTTP_200_OK
+    quantities = {item['product_id']: item['quantity'] for item in response.data['cart_items']}
+    assert quantities == {first: 30, third: 2, new_product.id: 10}
+    assert response.data['total_price'] == 30 * 2.5 + 2 * 2.5 + 10 * 1.0
+
+@pytest.mark.django_db
+def test_batch_update_cart_rejects_insufficient_stock(force_authenticated_client, create_user):
+    cart = fill_cart(create_user, 1)
+    product_id = cart.cart_items.get().product_id
+
+    url = reverse('myapp:batch-update-cart')
+    response = force_authenticated_client.post(url, {'items': [{'product_id': product_id, 'quantity': 101}]},
+                                               format='json')
+    assert response.status_code == status.HTTP_400_BAD_REQUEST
+    assert product_id in response.data['details']
+    assert cart.cart_items.get().quantity == 2
+
+    # Stock held for someone else's unpaid order is not available either
+    hold_stock(Order.objects.create(user=create_user, total_price=0), {product_id: 60})
+    response = force_authenticated_client.post(url, {'items': [{'product_id': product_id, 'quantity': 41}]},
+                                               format='json')
+    assert response.status_code == status.HTTP_400_BAD_REQUEST
+    assert 'Only 40 units' in response.data['details'][product_id]
+
+    # A bare list is a bad request, not a server error
+    response = force_authenticated_client.post(url, [{'product_id': product_id, 'quantity': 1}], format='json')
+    assert response.status_code == status.HTTP_400_BAD_REQUEST
+
 # Order Tests
 @pytest.mark.django_db
 def test_place_order(authenticated_client, sample_product):
@@ -147,6 +467,556 @@ def test_place_order(authenticated_client, sample_product):
     assert order.total_price == sample_product.price
     assert order.address == '123 Test Street, Test City'
 
+@pytest.mark.django_db
+def test_place_order_takes_stock_for_all_lines(force_authenticated_client, create_user):
+    first = Product.objects.create(name='First', category='OTC', price='3.00', stock=5)
+    second = Product.objects.create(name='Second', category='OTC', price='4.50', stock=2)
+
+    url = reverse('myapp:order-place')
+    cart_items = [{'id': first.id, 'quantity': 2}, {'id': second.id, 'quantity': 2}, {'id': first.id, 'quantity': 1}]
+    response = force_authenticated_client.post(url, {'cart_items': json.dumps(cart_items), 'address': 'Somewhere'})
+    assert response.status_code == status.HTTP_201_CREATED
+
+    order = Order.objects.get(id=response.data['order_id'])
+    assert order.total_price == 3 * 3 + 2 * 4.5
+    assert sorted(order.cartitem_set.values_list('product_id', 'quantity')) == [(first.id, 3), (second.id, 2)]
+    first.refresh_from_db()
+    second.refresh_from_db()
+    assert (first.stock, second.stock) == (2, 0)
+
+@pytest.mark.django_db
+def test_place_order_out_of_stock_changes_nothing(force_authenticated_client, create_user):
+    first = Product.objects.create(name='First', category='OTC', price='3.00', stock=5)
+    second = Product.objects.create(name='Second', category='OTC', price='4.50', stock=1)
+
+    url = reverse('myapp:order-place')
+    cart_items = [{'id': first.id, 'quantity': 2}, {'id': second.id, 'quantity': 2}]
+    response = force_authenticated_client.post(url, {'cart_items': json.dumps(cart_items), 'address': 'Somewhere'})
+    assert response.status_code == status.HTTP_400_BAD_REQUEST
+    assert not Order.objects.exists()
+    first.refresh_from_db()
+    assert first.stock == 5
+
+@pytest.mark.django_db(transaction=True)
+def test_concurrent_orders_never_oversell():
+    product = Product.objects.create(name='Last Units', category='OTC', price='1.00', stock=3)
+    buyers = [User.objects.create_user(username=f'buyer{i}', email=f'buyer{i}@example.com', password='x')
+              for i in range(8)]
+
+    def place_order(user):
+        client = APIClient()
+        client.force_authenticate(user=user)
+        try:
+            # SQLite refuses some concurrent writers with "database/table is locked" (the view rolls
+            # back and answers 500); those are retried, so every buyer gets a real answer
+            for attempt in range(50):
+                response = client.post(reverse('myapp:order-place'), {
+                    'cart_items': json.dumps([{'id': product.id, 'quantity': 1}]),
+                    'address': 'Somewhere',
+                })
+                if response.status_code != status.HTTP_500_INTERNAL_SERVER_ERROR \
+                        or 'locked' not in response.data['detail']:
+                    return response.status_code
+                time.sleep(0.01 * (attempt + 1))
+            return response.status_code
+        finally:
+            connection.close()
+
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        results = list(pool.map(place_order, buyers))
+
+    product.refresh_from_db()
+    assert sorted(results) == [status.HTTP_201_CREATED] * 3 + [status.HTTP_400_BAD_REQUEST] * 5
+    assert product.stock == 0
+    assert Order.objects.count() == 3
+
+@pytest.mark.django_db
+def test_take_stock_guard_catches_stale_reads(monkeypatch):
+    product = Product.objects.create(name='Contended', category='OTC', price='1.00', stock=2)
+    stale = Product.objects.get(id=product.id)
+    # Another checkout takes the stock after our locked read
+    Product.objects.filter(id=product.id).update(stock=0)
+    locked = mock.MagicMock()
+    locked.only.return_value.in_bulk.return_value = {product.id: stale}
+    monkeypatch.setattr(inventory.Product.objects, 'select_for_update', lambda: locked)
+
+    with pytest.raises(inventory.InsufficientStock):
+        with transaction.atomic():
+            inventory.take_stock({product.id: 1})
+    product.refresh_from_db()
+    assert product.stock == 0
+
+@pytest.mark.django_db
+def test_online_order_holds_stock_until_paid(force_authenticated_client, create_user, esewa):
+    product = Product.objects.create(name='Promo', category='OTC', price='2.00', stock=3)
+    url = reverse('myapp:order-place')
+
+    def place(quantity):
+        return force_authenticated_client.post(url, {
+            'cart_items': json.dumps([{'id': product.id, 'quantity': quantity}]),
+            'address': 'Somewhere',
+            'payment_method': 'online',
+        })
+
+    response = place(2)
+    assert response.status_code == status.HTTP_200_OK
+    assert 'reserved_until' in response.data
+    product.refresh_from_db()
+    assert product.stock == 3  # held, not taken
+    # Only one unit is left to hold
+    assert place(2).status_code == status.HTTP_400_BAD_REQUEST
+
+    payment_url = reverse('myapp:process-payment')
+    force_authenticated_client.post(payment_url, {'amount': 4, 'transaction_uuid': 'promo-1',
+                                                  'order_id': response.data['order_id']})
+    esewa.complete('promo-1', 4)
+    response = force_authenticated_client.post(payment_url, {'transaction_uuid': 'promo-1', 'status': 'COMPLETE'})
+    assert response.status_code == status.HTTP_202_ACCEPTED
+    assert response.data['status'] == 'COMPLETE'
+    product.refresh_from_db()
+    assert product.stock == 1
+    assert StockReservation.objects.get().status == StockReservation.COMMITTED
+
+@pytest.mark.django_db
+def test_online_order_payment_is_linked_without_order_id(force_authenticated_client, create_user, esewa):
+    # The existing client only sends amount and transaction_uuid when it starts the payment
+    product = Product.objects.create(name='Promo', category='OTC', price='2.00', stock=3)
+    response = force_authenticated_client.post(reverse('myapp:order-place'), {
+        'cart_items': json.dumps([{'id': product.id, 'quantity': 2}]),
+        'address': 'Somewhere',
+        'payment_method': 'online',
+    })
+    order_id = response.data['order_id']
+
+    payment_url = reverse('myapp:process-payment')
+    # Paying less than the order total is refused, however the order was found
+    response = force_authenticated_client.post(payment_url, {'amount': 1, 'transaction_uuid': 'promo-cheap'})
+    assert response.status_code == status.HTTP_400_BAD_REQUEST
+    response = force_authenticated_client.post(payment_url, {'amount': 1, 'transaction_uuid': 'promo-cheap',
+                                                             'order_id': order_id})
+    assert response.status_code == status.HTTP_400_BAD_REQUEST
+    force_authenticated_client.post(payment_url, {'amount': 4, 'transaction_uuid': 'promo-2'})
+    assert userPayment.objects.get(transaction_uuid='promo-2').order_id == order_id
+
+    esewa.complete('promo-2', 4)
+    response = force_authenticated_client.post(payment_url, {'data': esewa.callback_data('promo-2', 4)})
+    assert response.data['status'] == 'COMPLETE'
+    product.refresh_from_db()
+    assert product.stock == 1
+    assert StockReservation.objects.get().status == StockReservation.COMMITTED
+
+    # A paid order is not picked up by the next payment
+    force_authenticated_client.post(payment_url, {'amount': 4, 'transaction_uuid': 'promo-3'})
+    assert userPayment.objects.get(transaction_uuid='promo-3').order_id is None
+
+@pytest.mark.django_db
+def test_expired_and_failed_holds_are_released(force_authenticated_client, create_user, esewa):
+    product = Product.objects.create(name='Promo', category='OTC', price='2.00', stock=2)
+    url = reverse('myapp:order-place')
+    payload = {'cart_items': json.dumps([{'id': product.id, 'quantity': 2}]), 'address': 'Somewhere',
+               'payment_method': 'online'}
+
+    first = force_authenticated_client.post(url, payload)
+    assert force_authenticated_client.post(url, payload).status_code == status.HTTP_400_BAD_REQUEST
+
+    # An expired hold no longer blocks other buyers, and the sweeper marks it released
+    StockReservation.objects.update(expires_at=timezone.now() - timedelta(seconds=1))
+    second = force_authenticated_client.post(url, payload)
+    assert second.status_code == status.HTTP_200_OK
+    call_command('release_expired_reservations', stdout=StringIO())
+    assert StockReservation.objects.get(order_id=first.data['order_id']).status == StockReservation.RELEASED
+
+    # A failed payment gives the stock back right away
+    payment_url = reverse('myapp:process-payment')
+    force_authenticated_client.post(payment_url, {'amount': 4, 'transaction_uuid': 'promo-2',
+                                                  'order_id': second.data['order_id']})
+    esewa.complete('promo-2', 4, status='CANCELED')
+    force_authenticated_client.post(payment_url, {'transaction_uuid': 'promo-2', 'status': 'CANCELED'})
+    assert StockReservation.objects.get(order_id=second.data['order_id']).status == StockReservation.RELEASED
+    product.refresh_from_db()
+    assert product.stock == 2
+
+def create_orders(user, count, lines=3):
+    products = Product.objects.bulk_create([
+        Product(name=f'History Product {i}', category='OTC', price='2.00', stock=100) for i in range(lines)
+    ])
+    orders = Order.objects.bulk_create([Order(user=user, total_price=lines * 2, address='Somewhere') for _ in range(count)])
+    CartItem.objects.bulk_create([CartItem(order=order, product=product, quantity=1, product_name=product.name,
+                                           unit_price=product.price, total_price=product.price)
+                                  for order in orders for product in products])
+    return orders
+
+@pytest.mark.django_db
+def test_order_history_is_paginated(force_authenticated_client, create_user):
+    create_orders(create_user, 3)
+    url = reverse('myapp:user-order-history')
+
+    response = force_authenticated_client.get(url, {'page_size': 2})
+    assert response.status_code == status.HTTP_200_OK
+    first_page = response.data['results']
+    assert len(first_page) == 2
+    assert first_page[0]['order_id'] > first_page[1]['order_id']
+    assert [line['product_name'] for line in first_page[0]['cart_items']] == [
+        'History Product 0', 'History Product 1', 'History Product 2']
+    assert first_page[0]['cart_items'][0]['total_price'] == '2.00'
+
+    response = force_authenticated_client.get(response.data['next'])
+    assert len(response.data['results']) == 1
+    assert response.data['next'] is None
+
+    profile = force_authenticated_client.get(reverse('myapp:user-profile'))
+    assert 'orders' not in profile.data
+
+@pytest.mark.django_db
+@pytest.mark.parametrize('order_count', [1, 40])
+def test_order_history_query_count_is_constant(force_authenticated_client, create_user, order_count,
+                                               django_assert_num_queries):
+    create_orders(create_user, order_count, lines=5)
+    with django_assert_num_queries(2):
+        response = force_authenticated_client.get(reverse('myapp:user-order-history'))
+    assert len(response.data['results']) == min(order_count, 20)
+
+@pytest.mark.django_db
+def test_order_lines_keep_the_price_they_were_bought_at(force_authenticated_client, create_user):
+    cart = fill_cart(create_user, 2)
+    checkout = force_authenticated_client.post(reverse('myapp:checkout'), {'address': 'Somewhere'})
+    product = Product.objects.create(name='Direct', category='OTC', price='4.00', stock=10)
+    placed = force_authenticated_client.post(reverse('myapp:order-place'), {
+        'cart_items': json.dumps([{'id': product.id, 'quantity': 3}]), 'address': 'Somewhere'})
+
+    # Later catalog changes do not rewrite past orders
+    Product.objects.update(price='99.00', name='Renamed')
+    lines = {
+        order['order_id']: order['cart_items']
+        for order in force_authenticated_client.get(reverse('myapp:user-order-history')).data['results']
+    }
+    assert [(line['product_name'], line['price'], line['total_price']) for line in lines[placed.data['order_id']]] == [
+        ('Direct', '4.00', '12.00')]
+    assert [line['total_price'] for line in lines[checkout.data['order_id']]] == ['5.00', '5.00']
+    assert lines[checkout.data['order_id']][0]['product_name'].startswith('Cart Product')
+
+@pytest.mark.django_db
+@pytest.mark.parametrize('order_count', [1, 100])
+def test_order_admin_changelist_query_count_is_constant(admin_client, create_user, order_count,
+                                                       django_assert_num_queries):
+    orders = create_orders(create_user, order_count)
+    with django_assert_num_queries(8):
+        response = admin_client.get(reverse('admin:myapp_order_changelist'))
+    assert response.status_code == 200
+    assert '1x History Product 0<br>1x History Product 1' in response.content.decode()
+    assert str(orders[0]) == f"Order {orders[0].id} - Status: pending - Total: 6"
+
+@pytest.mark.django_db
+@pytest.mark.parametrize('row_count', [1, 60])
+def test_payment_and_cart_item_changelists_query_count_is_constant(admin_client, create_user, row_count,
+                                                                   django_assert_num_queries):
+    orders = create_orders(create_user, row_count, lines=1)
+    userPayment.objects.bulk_create([
+        userPayment(user=create_user, order=order, amount=6, total_amount=6, transaction_uuid=f'admin-{order.id}')
+        for order in orders
+    ])
+    fill_cart(create_user, 1)
+
+    with django_assert_num_queries(7):
+        response = admin_client.get(reverse('admin:myapp_userpayment_changelist'))
+    assert response.status_code == 200
+    # Ordered lines have no cart any more
+    with django_assert_num_queries(6):
+        response = admin_client.get(reverse('admin:myapp_cartitem_changelist'))
+    assert response.status_code == 200
+
+@pytest.mark.django_db
+def test_admin_payment_status_changes_are_settled(admin_client, create_user):
+    product = Product.objects.create(name='Held', category='OTC', price='2.00', stock=5)
+    order = Order.objects.create(user=create_user, total_price=4)
+    hold_stock(order, {product.id: 2})
+    payment = userPayment.objects.create(user=create_user, order=order, amount=4, total_amount=4,
+                                         transaction_uuid='admin-paid')
+    url = reverse('admin:myapp_userpayment_change', args=[payment.id])
+
+    def change_status(new_status):
+        return admin_client.post(url, {
+            'user': create_user.id, 'order': order.id, 'amount': '4', 'tax_amount': '0', 'total_amount': '4',
+            'transaction_uuid': 'admin-paid', 'transaction_code': '', 'status': new_status,
+            'product_code': 'EPAYTEST',
+        }, follow=True)
+
+    # Marking it paid takes the held stock and publishes the change
+    assert change_status('COMPLETE').status_code == 200
+    product.refresh_from_db()
+    assert product.stock == 3
+    assert StockReservation.objects.get().status == StockReservation.COMMITTED
+    assert OutboxEvent.objects.get(topic='payment.status_changed').payload['status'] == 'COMPLETE'
+
+    # Transitions PAYMENT_TRANSITIONS does not allow are refused
+    response = change_status('PENDING')
+    assert 'can not go from COMPLETE to PENDING' in response.content.decode()
+    payment.refresh_from_db()
+    assert payment.status == 'COMPLETE'
+
+@pytest.mark.django_db
+def test_order_list_filters(force_authenticated_client, create_user):
+    old, pending, shipped = create_orders(create_user, 3)
+    Order.objects.filter(id=old.id).update(created_at=timezone.now() - timedelta(days=10))
+    Order.objects.filter(id=shipped.id).update(status='shipped')
+    other_user = User.objects.create_user(username='other', email='other@example.com', password='x')
+    create_orders(other_user, 1)
+    url = reverse('myapp:order-list')
+
+    def ids(**params):
+        response = force_authenticated_client.get(url, params)
+        assert response.status_code == status.HTTP_200_OK
+        return [order['id'] for order in response.data['results']]
+
+    assert ids() == [shipped.id, pending.id, old.id]
+    assert ids(status='shipped') == [shipped.id]
+    assert ids(created_from=str(timezone.now().date())) == [shipped.id, pending.id]
+    assert ids(created_to=str((timezone.now() - timedelta(days=5)).date())) == [old.id]
+    assert force_authenticated_client.get(url, {'status': 'lost'}).status_code == status.HTTP_400_BAD_REQUEST
+    assert force_authenticated_client.get(url, {'created_from': '2024-02-30'}).status_code == \
+        status.HTTP_400_BAD_REQUEST
+
+    # Staff may filter by user, with a valid id
+    create_user.is_staff = True
+    create_user.save()
+    assert ids(user=other_user.id) == [Order.objects.get(user=other_user).id]
+    assert force_authenticated_client.get(url, {'user': 'abc'}).status_code == status.HTTP_400_BAD_REQUEST
+
+@pytest.mark.django_db
+@pytest.mark.parametrize('order_count', [1, 40])
+def test_order_list_query_count_is_constant(force_authenticated_client, create_user, order_count,
+                                            django_assert_num_queries):
+    create_orders(create_user, order_count, lines=5)
+    with django_assert_num_queries(2):
+        response = force_authenticated_client.get(reverse('myapp:order-list'))
+    assert len(response.data['results']) == min(order_count, 20)
+    assert len(response.data['results'][0]['items']) == 5
+
+@pytest.mark.django_db
+def test_checkout_moves_cart_lines_to_order(force_authenticated_client, create_user):
+    cart = fill_cart(create_user, 4)
+    response = force_authenticated_client.post(reverse('myapp:checkout'),
+                                               {'address': 'Somewhere', 'payment_method': 'online'})
+    assert response.status_code == status.HTTP_200_OK
+
+    order = Order.objects.get(id=response.data['order_id'])
+    assert order.total_price == 4 * 5
+    assert order.total_price == sum(line.total_price for line in order.cartitem_set.all())
+    assert order.cartitem_set.count() == 4
+    assert order.reservations.filter(status=StockReservation.ACTIVE).count() == 4
+    assert not cart.cart_items.exists()
+    assert force_authenticated_client.post(reverse('myapp:checkout'), {'address': 'Somewhere'}).status_code == \
+        status.HTTP_400_BAD_REQUEST
+
+    # Other payment methods take the stock right away instead of holding it
+    cart = fill_cart(create_user, 1)
+    product = cart.cart_items.get().product
+    response = force_authenticated_client.post(reverse('myapp:checkout'), {'address': 'Somewhere'})
+    assert response.status_code == status.HTTP_200_OK and 'reserved_until' not in response.data
+    product.refresh_from_db()
+    assert product.stock == 100 - 2
+    assert not StockReservation.objects.filter(order_id=response.data['order_id']).exists()
+
+@pytest.mark.django_db
+@pytest.mark.parametrize('cart_size', [1, 30])
+@pytest.mark.parametrize('payment_method', ['cod', 'online'])
+def test_checkout_query_count_is_constant(force_authenticated_client, create_user, cart_size, payment_method,
+                                          django_assert_num_queries):
+    fill_cart(create_user, cart_size)
+    with django_assert_num_queries(12):
+        response = force_authenticated_client.post(reverse('myapp:checkout'),
+                                                   {'address': 'Somewhere', 'payment_method': payment_method})
+    assert response.status_code == status.HTTP_200_OK
+
+@pytest.mark.django_db
+def test_checkout_idempotency_key_replays_response(force_authenticated_client, create_user):
+    fill_cart(create_user, 2)
+    url = reverse('myapp:checkout')
+
+    first = force_authenticated_client.post(url, {'address': 'Somewhere'}, HTTP_IDEMPOTENCY_KEY='retry-1')
+    retry = force_authenticated_client.post(url, {'address': 'Somewhere'}, HTTP_IDEMPOTENCY_KEY='retry-1')
+    assert first.status_code == retry.status_code == status.HTTP_200_OK
+    assert retry.data['order_id'] == first.data['order_id']
+    assert retry['Idempotent-Replayed'] == 'true'
+    assert Order.objects.count() == 1
+
+    # A failed attempt does not burn the key
+    response = force_authenticated_client.post(url, {'address': 'Somewhere'}, HTTP_IDEMPOTENCY_KEY='retry-2')
+    assert response.status_code == status.HTTP_400_BAD_REQUEST
+    fill_cart(create_user, 1)
+    response = force_authenticated_client.post(url, {'address': 'Somewhere'}, HTTP_IDEMPOTENCY_KEY='retry-2')
+    assert response.status_code == status.HTTP_200_OK
+    assert Order.objects.count() == 2
+
+    # Keys expire: an old key runs the view again, and the purge deletes expired rows
+    IdempotencyKey.objects.filter(key='retry-1').update(created_at=timezone.now() - get_key_ttl() - timedelta(1))
+    fill_cart(create_user, 1)
+    response = force_authenticated_client.post(url, {'address': 'Somewhere'}, HTTP_IDEMPOTENCY_KEY='retry-1')
+    assert response.status_code == status.HTTP_200_OK
+    assert 'Idempotent-Replayed' not in response
+    assert Order.objects.count() == 3
+
+    IdempotencyKey.objects.filter(key='retry-2').update(created_at=timezone.now() - get_key_ttl() - timedelta(1))
+    assert purge_expired_keys() == 1
+    assert list(IdempotencyKey.objects.values_list('key', flat=True)) == ['retry-1']
+
+@pytest.mark.django_db
+def test_canonical_queries_use_indexes():
+    out = StringIO()
+    call_command('check_query_plans', stdout=out)
+    assert 'Every canonical query uses an index' in out.getvalue()
+
+    assert full_scans("2 0 0 SCAN myapp_product\n5 0 0 USE TEMP B-TREE FOR ORDER BY", 'sqlite') == ['myapp_product']
+    assert full_scans("5 0 0 SCAN myapp_product USING INDEX product_category_idx", 'sqlite') == []
+    assert full_scans("Seq Scan on myapp_booking  (cost=0.00..1.01 rows=1 width=4)", 'postgresql') == ['myapp_booking']
+
+@pytest.mark.django_db
+def test_sqlite_connections_are_tuned(settings):
+    with connection.cursor() as cursor:
+        cursor.execute("PRAGMA synchronous")
+        assert cursor.fetchone()[0] == 1  # NORMAL
+        cursor.execute("PRAGMA busy_timeout")
+        assert cursor.fetchone()[0] == settings.SQLITE_PRAGMAS['busy_timeout']
+
+    # journal_mode is kept in the database file, so later connections do not set it again
+    settings.SQLITE_PRAGMAS = {'journal_mode': settings.SQLITE_PRAGMAS['journal_mode'], 'busy_timeout': 1000}
+    with CaptureQueriesContext(connection) as queries:
+        configure_sqlite(sender=None, connection=connection)
+    pragmas = [query['sql'] for query in queries.captured_queries]
+    assert any('busy_timeout' in sql for sql in pragmas)
+    assert not any('journal_mode' in sql for sql in pragmas)
+
+    settings.SQLITE_PRAGMAS = {'journal_mode': 'wal; DROP TABLE myapp_product'}
+    with pytest.raises(ValueError):
+        configure_sqlite(sender=None, connection=connection)
+
+@pytest.fixture
+def replica_reads(settings, monkeypatch):
+    """Pretend a read replica is configured; records the alias every read is routed to, then serves it
+    from the test database."""
+    settings.READ_REPLICA_ALIAS = 'replica'
+    routed = []
+    route = ReadReplicaRouter.db_for_read
+
+    def db_for_read(self, model, **hints):
+        routed.append(route(self, model, **hints))
+        return None
+    monkeypatch.setattr(ReadReplicaRouter, 'db_for_read', db_for_read)
+    return routed
+
+@pytest.mark.django_db
+def test_catalog_reads_go_to_replica_until_the_user_writes(replica_reads, create_user, sample_product):
+    client = APIClient()
+    client.force_authenticate(user=create_user)
+    client.get(reverse('myapp:product-detail', kwargs={'pk': sample_product.id}))
+    assert replica_reads == ['replica']
+
+    # The user's own write pins them to the primary, by cookie and by user
+    response = client.post(reverse('myapp:add-to-cart', kwargs={'product_id': sample_product.id}))
+    assert 'pin_primary' in response.cookies
+    replica_reads.clear()
+    client.get(reverse('myapp:products'))
+    other_device = APIClient()
+    other_device.force_authenticate(user=create_user)
+    other_device.get(reverse('myapp:products'), {'page_size': 5})
+    assert replica_reads and 'replica' not in replica_reads
+
+    # Other clients, and this user once the pin expires, read from the replica again
+    cache.delete(pin_key(create_user.pk))
+    replica_reads.clear()
+    other_device.get(reverse('myapp:products'), {'page_size': 6})
+    APIClient().post(reverse('myapp:booking-status'), {'email': 'a@example.com', 'mobile_number': '1'})
+    assert set(replica_reads) == {'replica'}
+
+@pytest.mark.django_db(transaction=True)
+def test_catalog_reads_from_a_real_sqlite_replica(settings, tmp_path):
+    cache.clear()
+    user = User.objects.create_user(username='pinned', email='pinned@example.com', password='x')
+    product = Product.objects.create(name='Original', category='OTC', price='1.00', stock=5)
+
+    # The replica is a copy of the primary in its own file, configured without TEST MIRROR;
+    # writes made after the copy never reach it
+    path = str(tmp_path / 'replica.sqlite3')
+    connection.ensure_connection()
+    copy = sqlite3.connect(path)
+    connection.connection.backup(copy)
+    copy.close()
+    connections.settings['replica'] = dict(connection.settings_dict, NAME=path, TEST={})
+    settings.READ_REPLICA_ALIAS = 'replica'
+    try:
+        Product.objects.filter(id=product.id).update(name='Renamed')
+
+        def names(client, page_size):
+            response = client.get(reverse('myapp:products'), {'page_size': page_size})
+            return [item['name'] for item in response.data['results']]
+
+        pinned = APIClient()
+        pinned.force_authenticate(user=user)
+        assert names(pinned, 5) == ['Original']
+        pinned.post(reverse('myapp:add-to-cart', kwargs={'product_id': product.id}))
+        assert names(pinned, 6) == ['Renamed']
+        assert names(APIClient(), 7) == ['Original']
+    finally:
+        connections['replica'].close()
+        del connections.settings['replica']
+        del connections._connections.replica
+
+@pytest.mark.django_db
+def test_async_read_endpoints_match_sync_ones(sample_product):
+    service = Service.objects.create(name='Blood test', price=50)
+    for i in range(3):
+        Product.objects.create(name=f'Async {i}', price=5, stock=1, category='OTC')
+    Booking.objects.create(name='A', mobile_number='1', email='a@example.com', service=service,
+                           booking_date='2030-01-01', appointment_time='10:00', address='X')
+    api, client = APIClient(), Client()
+
+    detail = client.get(reverse('myapp:async-product-detail', kwargs={'pk': sample_product.id}))
+    assert detail.json() == api.get(reverse('myapp:product-detail', kwargs={'pk': sample_product.id})).json()
+    assert client.get(reverse('myapp:async-product-detail', kwargs={'pk': 999999})).status_code == 404
+
+    search = {'search': 'async', 'page_size': 2}
+    assert (client.get(reverse('myapp:async-product-search'), search).json()['results']
+            == api.get(reverse('myapp:product-search'), search).json()['results'])
+    assert client.get(reverse('myapp:async-services')).json() == api.get(reverse('myapp:services')).json()
+    lookup = {'email': 'a@example.com', 'mobile_number': '1'}
+    assert (client.post(reverse('myapp:async-booking-status'), lookup, content_type='application/json').json()
+            == api.post(reverse('myapp:booking-status'), lookup, format='json').json())
+
+    # Keyset pages walk the whole catalog once
+    seen, url = [], reverse('myapp:async-products') + '?page_size=3&fields=id,name'
+    while url:
+        page = client.get(url).json()
+        assert all(set(product) == {'id', 'name'} for product in page['results'])
+        seen += [product['id'] for product in page['results']]
+        url = page['next']
+    assert seen == sorted(Product.objects.values_list('id', flat=True))
+    assert client.post(reverse('myapp:async-products')).status_code == 405
+
+
+def test_loadtest_reports_throughput_and_latency():
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header('Content-Length', '2')
+            self.end_headers()
+            self.wfile.write(b'{}')
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        out = StringIO()
+        call_command('loadtest', f'http://127.0.0.1:{server.server_port}/', concurrency=4, requests=40,
+                     warmup=0, stdout=out)
+    finally:
+        server.shutdown()
+        server.server_close()
+    assert 'req/s' in out.getvalue() and 'p99' in out.getvalue() and 'errors 0' in out.getvalue()
+
 # Payment Tests
 @pytest.mark.django_db
 def test_process_payment(authenticated_client, create_user):
@@ -170,7 +1040,7 @@ def test_process_payment(authenticated_client, create_user):
     assert payment.status == 'PENDING'
 
 @pytest.mark.django_db
-def test_payment_callback(authenticated_client, create_user):
+def test_payment_callback(authenticated_client, create_user, esewa):
     # First create a payment
     transaction_uuid = str(uuid.uuid4())
     userPayment.objects.create(
@@ -182,19 +1052,383 @@ def test_payment_callback(authenticated_client, create_user):
         user=create_user
     )
 
-    # Then simulate callback
+    # Then simulate callback, for a payment eSewa reports as complete
+    esewa.complete(transaction_uuid, 110)
     url = reverse('myapp:process-payment')
     payload = {
-        'transaction_uuid': transaction_uuid,
-        'status': 'SUCCESS',
-        'transaction_code': 'TEST123',
-        'data': 'test-data'
+        'data': esewa.callback_data(transaction_uuid, 110, transaction_code='TEST123'),
     }
     response = authenticated_client.post(url, payload)
-    assert response.status_code == status.HTTP_200_OK
-    assert response.data['message'] == 'Payment successful'
+    assert response.status_code == status.HTTP_202_ACCEPTED
+    assert response.data['message'] == 'Payment received'
 
     # Verify payment was updated
     payment = userPayment.objects.get(transaction_uuid=transaction_uuid)
-    assert payment.status == 'SUCCESS'
+    assert payment.status == 'COMPLETE'
     assert payment.transaction_code == 'TEST123'
+
+@pytest.mark.django_db
+def test_payment_form_is_signed_and_callbacks_are_verified_with_esewa(force_authenticated_client, esewa):
+    url = reverse('myapp:process-payment')
+    form = force_authenticated_client.post(url, {'amount': 100, 'tax_amount': 10, 'transaction_uuid': 'esewa-1'}).data
+
+    # eSewa accepts the signed form and rejects a tampered one
+    assert json.load(urlopen(esewa.form_url, urlencode(form).encode()))['status'] == 'PENDING'
+    with pytest.raises(HTTPError):
+        urlopen(esewa.form_url, urlencode({**form, 'total_amount': '1.0'}).encode())
+
+    # The callback's own claim is not trusted: the payment stays pending until eSewa reports it complete
+    callback = {'transaction_uuid': 'esewa-1', 'status': 'COMPLETE'}
+    assert force_authenticated_client.post(url, callback).data['status'] == 'PENDING'
+    assert esewa.requests == 3
+    # Unsigned repeats within the verification window do not ask eSewa again
+    for _ in range(5):
+        assert force_authenticated_client.post(url, callback).status_code == status.HTTP_200_OK
+    assert esewa.requests == 3
+    esewa.complete('esewa-1', 110)
+    esewa.fail_next = 2  # retried
+    response = force_authenticated_client.post(url, {'data': esewa.callback_data('esewa-1', '110.0')})
+    assert response.data['status'] == 'COMPLETE'
+    assert esewa.requests == 6
+
+@pytest.mark.django_db
+def test_repeated_payment_callbacks_cost_one_read(force_authenticated_client, create_user, esewa,
+                                                  django_assert_num_queries):
+    product = Product.objects.create(name='Held', category='OTC', price='2.00', stock=5)
+    order = Order.objects.create(user=create_user, total_price=4)
+    hold_stock(order, {product.id: 2})
+    payment = userPayment.objects.create(user=create_user, order=order, amount=4, total_amount=4,
+                                         transaction_uuid='dup-1')
+    esewa.complete('dup-1', 4)
+    url = reverse('myapp:process-payment')
+    data = esewa.callback_data('dup-1', '4.0', transaction_code='CODE-1')
+
+    first = force_authenticated_client.post(url, {'data': data})
+    assert (first.status_code, first.data['status']) == (status.HTTP_202_ACCEPTED, 'COMPLETE')
+    with django_assert_num_queries(1):
+        again = force_authenticated_client.post(url, {'data': data})
+    assert (again.status_code, again.data['status']) == (status.HTTP_200_OK, 'COMPLETE')
+    # A late failure report neither reopens the payment nor gives the stock back
+    assert settle_payment(payment, 'CANCELED') is None
+    product.refresh_from_db()
+    assert product.stock == 3
+    assert StockReservation.objects.get().status == StockReservation.COMMITTED
+
+    # Forged payloads and a transaction code replayed for another payment are refused
+    forged = json.loads(base64.b64decode(esewa.callback_data('dup-2', '4.0', transaction_code='CODE-2')))
+    forged['total_amount'] = '0.1'
+    forged = base64.b64encode(json.dumps(forged).encode()).decode()
+    assert force_authenticated_client.post(url, {'data': forged}).status_code == status.HTTP_400_BAD_REQUEST
+    assert force_authenticated_client.post(url, {'data': 'not base64'}).status_code == status.HTTP_400_BAD_REQUEST
+    userPayment.objects.create(user=create_user, amount=4, total_amount=4, transaction_uuid='dup-2')
+    replayed = esewa.callback_data('dup-2', '4.0', transaction_code='CODE-1')
+    assert force_authenticated_client.post(url, {'data': replayed}).status_code == status.HTTP_409_CONFLICT
+
+    # An unsigned callback can not claim a transaction code ahead of the real, signed one
+    userPayment.objects.create(user=create_user, amount=4, total_amount=4, transaction_uuid='dup-3')
+    esewa.complete('dup-3', 4, status='PENDING')
+    force_authenticated_client.post(url, {'transaction_uuid': 'dup-3', 'status': 'COMPLETE',
+                                          'transaction_code': 'CODE-3'})
+    assert userPayment.objects.get(transaction_uuid='dup-3').transaction_code is None
+    esewa.complete('dup-3', 4)
+    signed = esewa.callback_data('dup-3', '4.0', transaction_code='CODE-3')
+    response = force_authenticated_client.post(url, {'data': signed})
+    assert (response.status_code, response.data['status']) == (status.HTTP_202_ACCEPTED, 'COMPLETE')
+    assert userPayment.objects.get(transaction_uuid='dup-3').transaction_code == 'CODE-3'
+
+@pytest.mark.django_db
+def test_reconcile_payments_settles_old_pending_payments(create_user, esewa):
+    product = Product.objects.create(name='Held', category='OTC', price='2.00', stock=5)
+    order = Order.objects.create(user=create_user, total_price=4)
+    hold_stock(order, {product.id: 2})
+    service = Service.objects.create(name='Checkup', price=50)
+    booking = Booking.objects.create(name='A', mobile_number='1', email='a@example.com', service=service,
+                                     booking_date='2030-01-01', appointment_time='10:00')
+    old = timezone.now() - timedelta(hours=1)
+
+    def pending(transaction_uuid, amount, created_at=old, **kwargs):
+        return userPayment.objects.create(user=create_user, amount=amount, total_amount=amount,
+                                          transaction_uuid=transaction_uuid, created_at=created_at, **kwargs)
+    pending('paid-order', 4, order=order)
+    pending('canceled-booking', 50, booking=booking)
+    pending('abandoned', 9)
+    pending('still-open', 9)
+    pending('recent', 9, created_at=timezone.now())
+    esewa.complete('paid-order', 4)
+    esewa.complete('canceled-booking', 50, status='CANCELED')
+    esewa.complete('still-open', 9, status='PENDING')
+
+    out = StringIO()
+    call_command('reconcile_payments', '--batch-size', '2', '--workers', '2', stdout=out)
+    assert dict(userPayment.objects.values_list('transaction_uuid', 'status')) == {
+        'paid-order': 'COMPLETE', 'canceled-booking': 'CANCELED', 'abandoned': 'NOT_FOUND',
+        'still-open': 'PENDING', 'recent': 'PENDING',
+    }
+    product.refresh_from_db()
+    assert product.stock == 3
+    booking.refresh_from_db()
+    assert (booking.status, booking.payment_status) == ('pending', 'failed')
+    assert 'Checked 4 pending payments' in out.getvalue() and 'still pending: 1' in out.getvalue()
+    assert 'oldest still pending 60.0 min' in out.getvalue()
+    assert sorted(event.payload['transaction_uuid'] for event in OutboxEvent.objects.filter(
+        topic='payment.status_changed')) == ['abandoned', 'canceled-booking', 'paid-order']
+
+@pytest.mark.django_db
+def test_paid_order_without_stock_is_flagged_for_refund(force_authenticated_client, create_user, esewa, settings,
+                                                        mailoutbox):
+    product = Product.objects.create(name='Sold out', category='OTC', price='2.00', stock=2)
+    old = timezone.now() - timedelta(hours=1)
+    orders = {}
+    for transaction_uuid in ('late-callback', 'late-reconcile'):
+        orders[transaction_uuid] = Order.objects.create(user=create_user, total_price=4)
+        hold_stock(orders[transaction_uuid], {product.id: 2}, ttl=timedelta(seconds=-1))
+        userPayment.objects.create(user=create_user, order=orders[transaction_uuid], amount=4, total_amount=4,
+                                   transaction_uuid=transaction_uuid, created_at=old)
+        esewa.complete(transaction_uuid, 4)
+    # The holds expired and another buyer took the stock
+    Product.objects.filter(id=product.id).update(stock=0)
+
+    # Both the callback and the reconciler settle the payment for good instead of leaving it PENDING
+    url = reverse('myapp:process-payment')
+    assert force_authenticated_client.post(url, {'data': esewa.callback_data('late-callback', 4)}).data['status'] \
+        == 'COMPLETE'
+    call_command('reconcile_payments', stdout=StringIO())
+    assert set(userPayment.objects.values_list('status', flat=True)) == {'COMPLETE'}
+    assert set(Order.objects.values_list('status', flat=True)) == {'unfulfillable'}
+    assert not StockReservation.objects.filter(status=StockReservation.ACTIVE).exists()
+    assert sorted(event.payload['transaction_uuid'] for event in OutboxEvent.objects.filter(
+        topic='payment.refund_needed')) == ['late-callback', 'late-reconcile']
+
+    # A payment of less than the order total does not take its stock either
+    product.stock = 2
+    product.save()
+    order = Order.objects.create(user=create_user, total_price=4)
+    hold_stock(order, {product.id: 2})
+    userPayment.objects.create(user=create_user, order=order, amount=1, total_amount=1, transaction_uuid='underpaid')
+    esewa.complete('underpaid', 1)
+    data = esewa.callback_data('underpaid', 1, transaction_code='UNDER-1')
+    assert force_authenticated_client.post(url, {'data': data}).data['status'] == 'COMPLETE'
+    product.refresh_from_db()
+    assert product.stock == 2
+    assert Order.objects.get(id=order.id).status == 'unfulfillable'
+    assert OutboxEvent.objects.get(topic='payment.refund_needed', payload__transaction_uuid='underpaid')
+
+    # Someone is asked to refund them
+    settings.ADMINS = [('Payments', 'payments@example.com')]
+    dispatch_events()
+    assert sorted(mail.subject for mail in mailoutbox if 'Refund needed' in mail.subject) == [
+        '[Django] Refund needed for payment late-callback', '[Django] Refund needed for payment late-reconcile',
+        '[Django] Refund needed for payment underpaid']
+
+@pytest.mark.django_db(transaction=True)
+def test_payment_callbacks_are_acknowledged_without_waiting_for_the_gateway(settings, monkeypatch):
+    user = User.objects.create_user(username='payer', email='payer@example.com', password='x')
+    userPayment.objects.bulk_create([
+        userPayment(user=user, amount=1, total_amount=1, transaction_uuid=f'burst-{i}') for i in range(500)
+    ])
+
+    # Stand-in gateway that stalls until every callback has been answered
+    gateway_open = threading.Event()
+
+    def stand_in_gateway(payment, reported_status, transaction_code):
+        assert gateway_open.wait(30)
+        return 'COMPLETE'
+    monkeypatch.setattr(payments, 'get_verifier', lambda: stand_in_gateway)
+    monkeypatch.setattr(payments, '_executor', None)
+    settings.PAYMENT_VERIFICATION_WORKERS = 1
+
+    def callback(i):
+        # No transaction code: recording it is a write, and the in-memory SQLite test database
+        # refuses concurrent writers
+        try:
+            return APIClient().post(reverse('myapp:process-payment'), {
+                'transaction_uuid': f'burst-{i}', 'status': 'COMPLETE',
+            }).status_code
+        finally:
+            connection.close()
+
+    try:
+        with ThreadPoolExecutor(max_workers=50) as pool:
+            results = list(pool.map(callback, range(500)))
+        assert results == [status.HTTP_202_ACCEPTED] * 500
+        assert userPayment.objects.filter(status='PENDING').count() == 500
+
+        gateway_open.set()
+        assert payments.wait_for_verifications(timeout=60) == 0
+    finally:
+        # Nothing may outlive the test database
+        gateway_open.set()
+        payments.get_executor().shutdown(cancel_futures=True)
+    assert userPayment.objects.filter(status='COMPLETE').count() == 500
+    response = Client().get(reverse('myapp:payment-status', args=['burst-499']), {'wait': 5})
+    assert response.json() == {'transaction_uuid': 'burst-499', 'status': 'COMPLETE'}
+    assert Client().get(reverse('myapp:payment-status', args=['missing'])).status_code == 404
+
+handled_events = []
+
+def record_event(event):
+    handled_events.append((event.topic, event.payload))
+
+def failing_handler(event):
+    raise ConnectionError('analytics is down')
+
+@pytest.mark.django_db
+def test_status_changes_go_through_the_outbox(force_authenticated_client, create_user, settings, mailoutbox):
+    settings.OUTBOX_HANDLERS = {'*': ['myapp.tests.tests.record_event'],
+                                'booking.status_changed': ['myapp.outbox.email_booking_update']}
+    handled_events.clear()
+    order = Order.objects.create(user=create_user, total_price=4)
+    service = Service.objects.create(name='Checkup', price=50)
+    booking = Booking.objects.create(name='A', mobile_number='1', email='a@example.com', service=service,
+                                     booking_date='2030-01-01', appointment_time='10:00')
+
+    url = reverse('myapp:order-status-update', args=[order.id])
+    assert force_authenticated_client.patch(url, {'status': 'shipped'}, format='json').status_code == 200
+    assert force_authenticated_client.patch(url, {'status': 'shipped'}, format='json').status_code == 200
+    assert force_authenticated_client.patch(url, {'status': 'lost'}, format='json').status_code == 400
+    assert force_authenticated_client.post(reverse('myapp:booking-confirm', args=[booking.id])).status_code == 200
+    # Nothing is handled in the request; an unchanged status publishes nothing
+    assert handled_events == [] and mailoutbox == []
+    assert OutboxEvent.objects.filter(status=OutboxEvent.PENDING).count() == 2
+
+    out = StringIO()
+    call_command('dispatch_outbox', stdout=out)
+    assert handled_events == [('order.status_changed', {'order_id': order.id, 'status': 'shipped'}),
+                              ('booking.status_changed', {'booking_id': booking.id, 'status': 'confirmed'})]
+    assert [mail.to for mail in mailoutbox] == [['a@example.com']]
+    assert 'confirmed' in mailoutbox[0].subject
+    assert not OutboxEvent.objects.exclude(status=OutboxEvent.DISPATCHED).exists()
+    assert 'Dispatched 2 events' in out.getvalue()
+
+    call_command('dispatch_outbox', stdout=StringIO())
+    assert len(handled_events) == 2
+
+@pytest.mark.django_db
+def test_failing_outbox_handlers_are_retried_then_given_up(settings):
+    settings.OUTBOX_HANDLERS = {'order.status_changed': ['myapp.tests.tests.failing_handler']}
+    settings.OUTBOX_MAX_ATTEMPTS = 2
+    publish(OutboxEvent(topic='order.status_changed', payload={'order_id': 1}),
+            OutboxEvent(topic='booking.status_changed', payload={'booking_id': 1}))
+
+    stats = dispatch_events()
+    assert (stats['dispatched'], stats['retried'], stats['failed']) == (1, 1, 0)
+    event = OutboxEvent.objects.get(topic='order.status_changed')
+    assert (event.status, event.attempts) == (OutboxEvent.PENDING, 1)
+    assert 'analytics is down' in event.last_error
+    # Backing off: not handed out again yet
+    assert dispatch_events()['retried'] == 0
+
+    OutboxEvent.objects.update(available_at=event.created_at)
+    stats = dispatch_events()
+    assert stats['failed'] == 1
+    event.refresh_from_db()
+    assert (event.status, event.attempts) == (OutboxEvent.FAILED, 2)
+
+@pytest.mark.django_db
+def test_admin_bookings_respect_slot_capacity(admin_client):
+    service = Service.objects.create(name='Checkup', price=50)
+    Booking.objects.create(name='A', mobile_number='1', email='a@example.com', service=service,
+                           booking_date='2030-01-01', appointment_time='10:00')
+    fields = {'name': 'B', 'mobile_number': '2', 'email': 'b@example.com', 'service': service.id,
+              'booking_date': '2030-01-01', 'appointment_time': '10:00', 'status': 'pending',
+              'payment_status': 'pending', 'address': '', 'notes': ''}
+
+    response = admin_client.post(reverse('admin:myapp_booking_add'), fields)
+    assert response.status_code == 200 and 'This time slot is already booked' in response.content.decode()
+    assert Booking.objects.count() == 1
+    response = admin_client.post(reverse('admin:myapp_booking_add'), {**fields, 'appointment_time': '11:00'})
+    assert response.status_code == 302
+
+    # Editing other fields of a booking does not count it against its own slot
+    booking = Booking.objects.get(name='B')
+    response = admin_client.post(reverse('admin:myapp_booking_change', args=[booking.id]),
+                                 {**fields, 'appointment_time': '11:00', 'notes': 'Fasting'})
+    assert response.status_code == 302
+    response = admin_client.post(reverse('admin:myapp_booking_change', args=[booking.id]), fields)
+    assert 'This time slot is already booked' in response.content.decode()
+
+@pytest.mark.django_db
+def test_service_availability_and_slot_capacity(api_client, django_assert_num_queries,
+                                                 django_capture_on_commit_callbacks):
+    service = Service.objects.create(name='Blood test', price=50)
+    # Mondays, 09:00-10:30 in 30 minute slots taking two bookings each; 2030-01-07 is a Monday
+    ServiceSchedule.objects.create(service=service, weekday=0, opens_at='09:00', closes_at='10:30', capacity=2)
+    url = reverse('myapp:service-availability', args=[service.id])
+    params = {'from': '2030-01-07', 'to': '2030-01-08'}
+
+    def free():
+        return {day['date']: day['slots'] for day in api_client.get(url, params).data['days']}
+
+    def book(at):
+        with django_capture_on_commit_callbacks(execute=True):
+            return api_client.post(reverse('myapp:bookings'), {
+                'name': 'A', 'mobile_number': '1', 'email': 'a@example.com', 'service': service.id,
+                'booking_date': '2030-01-07', 'appointment_time': at,
+            }, format='json')
+
+    assert free() == {date(2030, 1, 7): ['09:00', '09:30', '10:00'], date(2030, 1, 8): []}
+    # Cached: the service and its schedule are read, the bookings are not
+    with django_assert_num_queries(2):
+        free()
+
+    assert book('09:00').status_code == status.HTTP_201_CREATED
+    assert free()[date(2030, 1, 7)] == ['09:00', '09:30', '10:00']
+    assert book('09:00').status_code == status.HTTP_201_CREATED
+    assert free()[date(2030, 1, 7)] == ['09:30', '10:00']
+    full = book('09:00')
+    assert full.status_code == status.HTTP_400_BAD_REQUEST and full.data['error'] == 'This time slot is already booked'
+    assert book('09:15').status_code == status.HTTP_400_BAD_REQUEST
+
+    booking = Booking.objects.filter(appointment_time='09:00').first()
+    booking.status = 'cancelled'
+    with django_capture_on_commit_callbacks(execute=True):
+        booking.save()
+    assert free()[date(2030, 1, 7)] == ['09:00', '09:30', '10:00']
+
+    # Moving a booking to another day frees its slot on the day it leaves too
+    assert book('09:00').status_code == status.HTTP_201_CREATED
+    assert free()[date(2030, 1, 7)] == ['09:30', '10:00']
+    # The new booking takes the seat the cancelled one left
+    assert sorted(Booking.objects.exclude(status='cancelled').values_list('seat', flat=True)) == [0, 1]
+    moved = Booking.objects.filter(appointment_time='09:00').exclude(status='cancelled').first()
+    moved.booking_date = date(2030, 1, 14)
+    with django_capture_on_commit_callbacks(execute=True):
+        moved.save()
+    assert free()[date(2030, 1, 7)] == ['09:00', '09:30', '10:00']
+
+    assert api_client.get(url, {'from': '2030-01-08', 'to': '2030-01-07'}).status_code == 400
+    assert api_client.get(url, {'from': 'monday'}).status_code == 400
+
+@pytest.mark.django_db(transaction=True)
+def test_concurrent_bookings_never_overbook(monkeypatch):
+    # No schedule: the slot takes a single booking
+    service = Service.objects.create(name='Home visit', price=80)
+
+    def post(i):
+        return APIClient().post(reverse('myapp:bookings'), {
+            'name': f'Customer {i}', 'mobile_number': str(i), 'email': f'c{i}@example.com',
+            'service': service.id, 'booking_date': '2030-01-07', 'appointment_time': '09:00',
+        }, format='json')
+
+    def book(i):
+        try:
+            # A booking that lost the race or met a locked database (409) is tried again,
+            # so every customer gets a real answer
+            for attempt in range(50):
+                response = post(i)
+                if response.status_code != status.HTTP_409_CONFLICT:
+                    return response.status_code
+                time.sleep(0.01 * (attempt + 1))
+            return response.status_code
+        finally:
+            connection.close()
+
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        results = list(pool.map(book, range(8)))
+
+    assert sorted(results) == [status.HTTP_201_CREATED] + [status.HTTP_400_BAD_REQUEST] * 7
+    assert Booking.objects.exclude(status='cancelled').count() == 1
+    # Even when the capacity check misses the taken seat, the database refuses it
+    monkeypatch.setattr('myapp.views.check_slot', lambda *args: 0)
+    assert post(8).status_code == status.HTTP_409_CONFLICT
+    assert Booking.objects.exclude(status='cancelled').count() == 1
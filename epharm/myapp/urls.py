@@ -1,8 +1,9 @@
 from django.urls import path
-from . import views
+from . import async_views, views
 from .views import (
     CustomLoginAPIView,
     UserProfileView,
+    OrderHistoryView,
     PlaceOrderView,
     update_cart_item_quantity,
     update_order_status,
@@ -11,7 +12,9 @@ from .views import (
     BookingStatusView,
     ServiceListView,
     ServiceDetailView,
+    ServiceAvailabilityView,
     OrderDetailView,
+    OrderListView,
     ViewCart,
     RegisterAPIView, ProductSearchAPIView, BookingPaymentView,
 
@@ -38,6 +41,7 @@ urlpatterns = [
     path('token/verify/', TokenVerifyView.as_view(), name='token_verify'),
     path('check-email/', views.check_email, name='check_email'),
     path('user/profile/', UserProfileView.as_view(), name='user-profile'),
+    path('user/orders/', OrderHistoryView.as_view(), name='user-order-history'),
 
     # Product Routes
     path('products/', views.getProducts, name='products'),
@@ -48,9 +52,11 @@ urlpatterns = [
     path('cart/add/<int:product_id>/', views.add_to_cart, name='add-to-cart'),
     path('cart/remove/<int:product_id>/', views.remove_from_cart, name='remove-from-cart'),
     path('cart/update-item/<int:product_id>/', update_cart_item_quantity, name='update-cart-item'),
+    path('cart/batch-update/', views.batch_update_cart, name='batch-update-cart'),
     path('cart/checkout/', views.checkout, name='checkout'),
 
     # Order Routes
+    path('orders/', OrderListView.as_view(), name='order-list'),
     path('order/place/', PlaceOrderView.as_view(), name='order-place'),
     path('order/<int:pk>/', OrderDetailView.as_view(), name='order-detail'),
     path('order/<int:order_id>/status/', update_order_status, name='order-status-update'),
@@ -58,18 +64,29 @@ urlpatterns = [
     # Service Routes
     path('services/', ServiceListView.as_view(), name='services'),
     path('service/<int:pk>/', ServiceDetailView.as_view(), name='service-detail'),
+    path('services/<int:pk>/availability/', ServiceAvailabilityView.as_view(), name='service-availability'),
 
     # Booking Routes
     path('bookings/', BookingCreateView.as_view(), name='bookings'),
     path('bookings/status/', BookingStatusView.as_view(), name='booking-status'),
     path('booking/confirm/<int:pk>/', ConfirmBookingView.as_view(), name='booking-confirm'),
     path('process-payment/', ProcessPaymentView.as_view(), name='process-payment'),
+    path('payment/status/<str:transaction_uuid>/', async_views.payment_status, name='payment-status'),
 
 
 
     path('payment-success/', PaymentSuccessView.as_view(), name='payment-success'),
 
     path('products/search/', ProductSearchAPIView.as_view(), name='product-search'),
+    path('products/suggest/', views.suggest_products, name='product-suggest'),
+    path('cache/stats/', views.catalog_cache_stats, name='catalog-cache-stats'),
+
+    # Async (ASGI native) variants of the read-heavy endpoints
+    path('async/products/', async_views.product_list, name='async-products'),
+    path('async/product/<int:pk>/', async_views.product_detail, name='async-product-detail'),
+    path('async/products/search/', async_views.product_search, name='async-product-search'),
+    path('async/services/', async_views.service_list, name='async-services'),
+    path('async/bookings/status/', async_views.booking_status, name='async-booking-status'),
 
     path('booking-payment/', BookingPaymentView.as_view(), name='booking-payment'),
 
@@ -1,6 +1,8 @@
 
 from rest_framework import permissions
-from .serializers import ProductSerializer, RegisterSerializer, OrderSerializer, CustomTokenObtainPairSerializer
+from .serializers import ProductSerializer, RegisterSerializer, OrderSerializer, CustomTokenObtainPairSerializer, serialize_cart
+from .serializers import serialize_cart_delta, bump_cart_revision, CartBatchItemSerializer
+from .serializers import OrderHistorySerializer, get_order_history, with_order_items
 
 from .models import  CustomUser, Cart, CartItem, Order
 from django.shortcuts import redirect, render
@@ -13,10 +15,11 @@ from rest_framework.decorators import api_view, permission_classes
 
 from django.views.decorators.csrf import csrf_exempt
 
-from django.db import transaction
+from django.db import IntegrityError, OperationalError, transaction
 
 
 import json
+from decimal import Decimal
 
 from django.http import JsonResponse
 
@@ -27,18 +30,31 @@ from django.shortcuts import get_object_or_404
 
 from .models import Service
 from .serializers import ServiceSerializer, BookingSerializer, BookingReportSerializer
-from django.db.models import Q
+from django.db.models import F, OuterRef, Q, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
 
 
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework import status
 from .models import Booking, userPayment,Product
-import hmac
-import hashlib
-import base64
+from .pagination import OrderHistoryCursorPagination, ProductCursorPagination
+from .idempotency import idempotent
+from .inventory import InsufficientStock, ProductNotFound, held_quantities, hold_stock, lock_products, merge_quantities
+from .inventory import order_awaiting_payment, take_stock
+from .payments import InvalidCallback, claim_verification, get_gateway, record_callback, schedule_verification
+from .outbox import booking_status_changed, order_status_changed, publish
+from .availability import SlotUnavailable, check_slot, free_slots
+from .search import get_search_backend, search_terms
+from .suggest import suggestion_index
+from .cache import cached_catalog_response, get_cache_stats
+from .db import get_read_alias, read_from_replica
+from django.urls import reverse
+from django.utils import timezone
+from django.utils.decorators import method_decorator
+from rest_framework.utils.urls import replace_query_param
 import logging
-import time
+from datetime import date, datetime, timedelta
 
 logger = logging.getLogger(__name__)
 
@@ -48,13 +64,49 @@ logger = logging.getLogger(__name__)
 def getRoutes(request):
     return Response({'message': 'Hello from Django!'})
 
+def get_requested_product_fields(request):
+    """Parse ?fields=id,name,price into a list of ProductSerializer fields.
+
+    Returns None when no sparse fieldset was requested and raises ValueError
+    for unknown field names. 'id' is always included.
+    """
+    raw_fields = request.GET.get('fields', '').strip()
+    if not raw_fields:
+        return None
+
+    fields = [field.strip() for field in raw_fields.split(',') if field.strip()]
+    unknown = [field for field in fields if field not in ProductSerializer.Meta.fields]
+    if unknown:
+        raise ValueError(f"Unknown product fields: {', '.join(unknown)}")
+
+    if 'id' not in fields:
+        fields.insert(0, 'id')
+    return fields
+
+
+@cached_catalog_response('products')
 @api_view(['GET'])
+@read_from_replica
 def getProducts(request):
-    products = Product.objects.all()
-    serializer = ProductSerializer(products, many=True)
-    return Response(serializer.data)
+    try:
+        fields = get_requested_product_fields(request)
+    except ValueError as e:
+        return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+    paginator = ProductCursorPagination()
+
+    # Only load the columns we serialize (plus the ones the cursor is ordered on)
+    columns = set(fields or ProductSerializer.Meta.fields)
+    columns.update(field.lstrip('-') for field in paginator.get_ordering(request, None, None))
+    products = Product.objects.only(*columns)
 
+    page = paginator.paginate_queryset(products, request)
+    serializer = ProductSerializer(page, many=True, fields=fields)
+    return paginator.get_paginated_response(serializer.data)
+
+@cached_catalog_response('product')
 @api_view(['GET'])
+@read_from_replica
 def getProduct(request, pk):
     try:
         product = get_object_or_404(Product, pk=pk)
@@ -123,6 +175,17 @@ def check_email(request):
 # View to get the user's profile information
 
 
+def cart_mutation_response(request, cart, product_id, status_code=status.HTTP_200_OK):
+    """Response for a cart change: the whole cart, or with ?response=delta only
+    the changed line, the new total and the cart revision."""
+    if request.query_params.get('response') != 'delta':
+        return Response(serialize_cart(cart, request), status=status_code)
+
+    if cart is None:
+        return Response({'product_id': product_id, 'line': None, 'total_price': 0, 'revision': 0}, status=status_code)
+    return Response(serialize_cart_delta(cart, request, product_id), status=status_code)
+
+
 # Add product to the cart
 @api_view(['POST'])
 @permission_classes([permissions.IsAuthenticated])
@@ -147,24 +210,9 @@ def add_to_cart(request, product_id):
                 cart_item.prescription_file = prescription_file
 
         cart_item.save()
+        bump_cart_revision(cart)
 
-        items = cart.cart_items.all()
-        cart_items = [{
-            'id': item.id,
-            'product_id': item.product.id,
-            'name': item.product.name,
-            'quantity': item.quantity,
-            'price': float(item.product.price),
-            'total_item_price': float(item.product.price * item.quantity),
-            'image': request.build_absolute_uri(item.product.image.url) if item.product.image else None,
-        } for item in items]
-
-        total_price = float(sum(item['total_item_price'] for item in cart_items))
-
-        return Response({
-            'cart_items': cart_items,
-            'total_price': total_price
-        }, status=200)
+        return cart_mutation_response(request, cart, product.id)
 
     except Product.DoesNotExist:
         logger.error(f"Product with ID {product_id} not found.")
@@ -182,42 +230,17 @@ def remove_from_cart(request, product_id):
 
         # If cart doesn't exist, return empty response
         if not cart:
-            return Response({
-                'cart_items': [],
-                'total_price': 0
-            }, status=status.HTTP_200_OK)
+            return cart_mutation_response(request, None, product_id)
 
-        # Try to get the cart item
-        cart_item = CartItem.objects.filter(cart=cart, product_id=product_id).first()
-
-        # If cart item doesn't exist, log it and return current cart state
-        if not cart_item:
+        # Delete the cart item; if it doesn't exist, log it and return current cart state
+        deleted, _ = CartItem.objects.filter(cart=cart, product_id=product_id).delete()
+        if deleted:
+            bump_cart_revision(cart)
+        else:
             logger.warning(
                 f"Attempted to remove non-existent cart item. User: {request.user.id}, Product: {product_id}")
-            items = cart.cart_items.all()
-        else:
-            # Delete the cart item if it exists
-            cart_item.delete()
-            items = cart.cart_items.all()
-
-        # Get updated cart items
-        cart_items = [{
-            'id': item.id,
-            'product_id': item.product.id,
-            'name': item.product.name,
-            'quantity': item.quantity,
-            'price': float(item.product.price),
-            'total_item_price': float(item.product.price * item.quantity),
-            'image': request.build_absolute_uri(item.product.image.url) if item.product.image else None,
-            'prescription': request.build_absolute_uri(item.prescription_file.url) if item.prescription_file else None
-        } for item in items]
-
-        total_price = float(sum(item['total_item_price'] for item in cart_items))
 
-        return Response({
-            'cart_items': cart_items,
-            'total_price': total_price
-        }, status=status.HTTP_200_OK)
+        return cart_mutation_response(request, cart, product_id)
 
     except Exception as e:
         logger.error(f"Error removing item from cart: {str(e)}", exc_info=True)
@@ -232,28 +255,7 @@ class ViewCart(APIView):
     def get(self, request):
         try:
             cart = get_object_or_404(Cart, user=request.user)
-            items = cart.cart_items.all()
-
-            if not items:
-                return Response({'cart_items': []}, status=200)
-
-            cart_items = [{
-                'id': item.id,
-                'product_id': item.product.id,
-                'name': item.product.name,
-                'quantity': item.quantity,
-                'price': float(item.product.price),
-                'total_item_price': float(item.product.price * item.quantity),
-                'image': request.build_absolute_uri(item.product.image.url) if item.product.image else None,
-                'prescription': request.build_absolute_uri(item.prescription_file.url) if item.prescription_file else None
-            } for item in items]
-
-            total_price = float(sum(item['total_item_price'] for item in cart_items))
-
-            return Response({
-                'cart_items': cart_items,
-                'total_price': total_price
-            }, status=200)
+            return Response(serialize_cart(cart, request), status=200)
 
         except Exception as e:
             logger.error(f"Error viewing cart: {e}")
@@ -279,51 +281,136 @@ def update_cart_item_quantity(request, product_id):
         else:
             return Response({"error": "Quantity cannot be decreased further."}, status=status.HTTP_400_BAD_REQUEST)
 
-        cart_item.save()
-
-        # Get all cart items for response
-        items = cart.cart_items.all()
-        cart_items = [{
-            'id': item.id,
-            'product_id': item.product.id,
-            'name': item.product.name,
-            'quantity': item.quantity,
-            'price': float(item.product.price),
-            'total_item_price': float(item.product.price * item.quantity),
-            'image': request.build_absolute_uri(item.product.image.url) if item.product.image else None,
-        } for item in items]
+        cart_item.save(update_fields=['quantity'])
+        bump_cart_revision(cart)
 
-        total_price = float(sum(item['total_item_price'] for item in cart_items))
-
-        return Response({
-            'cart_items': cart_items,
-            'total_price': total_price
-        })
+        return cart_mutation_response(request, cart, product_id)
 
     except Cart.DoesNotExist:
         return Response({"error": "Cart not found."}, status=status.HTTP_404_NOT_FOUND)
     except CartItem.DoesNotExist:
         return Response({"error": "Item not found in cart."}, status=status.HTTP_404_NOT_FOUND)
-@api_view(['POST'])
-@permission_classes([permissions.IsAuthenticated])
-def checkout(request):
-    try:
-        cart = get_object_or_404(Cart, user=request.user)
 
-        if cart.cart_items.count() == 0:
-            return Response({'message': 'Your cart is empty'}, status=status.HTTP_400_BAD_REQUEST)
 
-        total_price = sum([item.product.price * item.quantity for item in cart.cart_items.all()])
-        order = Order.objects.create(user=request.user, total_price=total_price, status="pending", address=request.data.get('address'))
+@api_view(['POST'])
+@permission_classes([permissions.IsAuthenticated])
+def batch_update_cart(request):
+    """Set the quantity of many cart lines at once.
+
+    Body: {"items": [{"product_id": 1, "quantity": 30}, {"product_id": 2, "quantity": 0}, ...]}
+    Quantity 0 removes the line. Stock, less what other orders hold, is checked for
+    all products with two queries and the changes are applied with bulk operations
+    in a single transaction.
+    """
+    if not isinstance(request.data, dict):
+        return Response({'error': 'Expected an object with an "items" list'}, status=status.HTTP_400_BAD_REQUEST)
+    serializer = CartBatchItemSerializer(data=request.data.get('items'), many=True, allow_empty=False)
+    if not serializer.is_valid():
+        return Response({'error': 'Invalid items', 'details': serializer.errors}, status=status.HTTP_400_BAD_REQUEST)
+
+    quantities = {op['product_id']: op['quantity'] for op in serializer.validated_data}
+    if len(quantities) != len(serializer.validated_data):
+        return Response({'error': 'Each product may only appear once'}, status=status.HTTP_400_BAD_REQUEST)
+
+    products = Product.objects.only('id', 'name', 'stock').in_bulk(quantities.keys())
+    held = held_quantities(quantities.keys())
+    errors = {}
+    for product_id, quantity in quantities.items():
+        product = products.get(product_id)
+        if product is None:
+            errors[product_id] = 'Product not found'
+        elif quantity > product.stock - held.get(product_id, 0):
+            available = max(product.stock - held.get(product_id, 0), 0)
+            errors[product_id] = f"Only {available} units of {product.name} in stock"
+    if errors:
+        return Response({'error': 'Some items could not be updated', 'details': errors},
+                        status=status.HTTP_400_BAD_REQUEST)
+
+    with transaction.atomic():
+        cart, _ = Cart.objects.get_or_create(user=request.user)
+        existing = {item.product_id: item for item in
+                    cart.cart_items.select_for_update().filter(product_id__in=quantities.keys())}
+
+        to_create, to_update, to_delete = [], [], []
+        for product_id, quantity in quantities.items():
+            item = existing.get(product_id)
+            if quantity == 0:
+                if item:
+                    to_delete.append(item.id)
+            elif item is None:
+                to_create.append(CartItem(cart=cart, product_id=product_id, quantity=quantity))
+            elif item.quantity != quantity:
+                item.quantity = quantity
+                to_update.append(item)
+
+        if to_delete:
+            CartItem.objects.filter(id__in=to_delete).delete()
+        if to_create:
+            CartItem.objects.bulk_create(to_create)
+        if to_update:
+            CartItem.objects.bulk_update(to_update, ['quantity'])
+        if to_delete or to_create or to_update:
+            bump_cart_revision(cart)
+
+    return Response(serialize_cart(cart, request), status=status.HTTP_200_OK)
 
-        for cart_item in cart.cart_items.all():
-            cart_item.order = order
-            cart_item.save()
 
-        # Clear the cart after creating the order
-        cart.cart_items.all().delete()
+@api_view(['POST'])
+@permission_classes([permissions.IsAuthenticated])
+@idempotent('checkout')
+def checkout(request):
+    address = request.data.get('address')
+    online = request.data.get('payment_method') == 'online'
+    if not address:
+        return Response({'message': 'Missing address.'}, status=status.HTTP_400_BAD_REQUEST)
 
-        return Response({'message': 'Checkout complete, your cart is now empty.', 'order_id': order.id}, status=status.HTTP_200_OK)
+    try:
+        with transaction.atomic():
+            cart = Cart.objects.select_for_update().filter(user=request.user).first()
+            if cart is None:
+                return Response({'message': 'Your cart is empty'}, status=status.HTTP_400_BAD_REQUEST)
+
+            quantities = {}
+            for product_id, quantity in cart.cart_items.values_list('product_id', 'quantity'):
+                quantities[product_id] = quantities.get(product_id, 0) + quantity
+            if not quantities:
+                return Response({'message': 'Your cart is empty'}, status=status.HTTP_400_BAD_REQUEST)
+
+            if online:
+                # Lock the products, then hold their stock for the order until eSewa confirms the payment
+                lock_products(quantities)
+            else:
+                # Lock and decrement stock for every product at once
+                take_stock(quantities)
+            order = Order.objects.create(user=request.user, total_price=0, status="pending", address=address)
+            if online:
+                reserved_until = hold_stock(order, quantities)
+
+            # Move every line from the cart to the order in one UPDATE, which also empties the cart
+            # and snapshots the name and price each line was bought at
+            product = Product.objects.filter(pk=OuterRef('product_id'))
+            cart.cart_items.update(
+                order=order,
+                cart=None,
+                product_name=Coalesce(Subquery(product.values('name')[:1]), Value('')),
+                unit_price=Subquery(product.values('price')[:1]),
+                total_price=Subquery(product.values('price')[:1]) * F('quantity'),
+            )
+            # The order total is the sum of the lines just written, so the two can not disagree
+            lines = CartItem.objects.filter(order=OuterRef('pk')).values('order')
+            Order.objects.filter(pk=order.pk).update(
+                total_price=Subquery(lines.annotate(total=Sum('total_price')).values('total')))
+            bump_cart_revision(cart)
+
+        response = {'message': 'Checkout complete, your cart is now empty.', 'order_id': order.id}
+        if online:
+            response['reserved_until'] = reserved_until
+        return Response(response, status=status.HTTP_200_OK)
+
+    except ProductNotFound:
+        return Response({'message': 'Product not found.'}, status=status.HTTP_404_NOT_FOUND)
+    except InsufficientStock as e:
+        return Response({'message': str(e)}, status=status.HTTP_400_BAD_REQUEST)
 
     except Exception as e:
         logger.error(f"Error during checkout: {e}")
@@ -344,57 +431,57 @@ class PlaceOrderView(APIView):
             if not cart_items_data or not address:
                 return Response({"detail": "Missing cart items or address."}, status=status.HTTP_400_BAD_REQUEST)
 
-            cart_items = json.loads(cart_items_data)
-            total_price = 0
+            try:
+                quantities = merge_quantities(json.loads(cart_items_data))
+            except (ValueError, KeyError, TypeError):
+                return Response({"detail": "Invalid cart items."}, status=status.HTTP_400_BAD_REQUEST)
+            if not quantities:
+                return Response({"detail": "Missing cart items or address."}, status=status.HTTP_400_BAD_REQUEST)
 
+            online = payment_method == "online"
             with transaction.atomic():
-                # Create the order first
-                order = Order.objects.create(user=request.user, total_price=0, address=address)
-
-                for item in cart_items:
-                    product = get_object_or_404(Product, id=item['id'])
-
-                    # Check stock availability
-                    if product.stock < item['quantity']:
-                        return Response({"detail": f"Not enough stock for {product.name}."},
-                                        status=status.HTTP_400_BAD_REQUEST)
+                if online:
+                    # Only hold the stock until eSewa confirms the payment
+                    products = lock_products(quantities)
+                else:
+                    # Lock and decrement stock for every product at once
+                    products = take_stock(quantities)
+                total_price = sum(products[pk].price * quantity for pk, quantity in quantities.items())
 
-                    total_price += product.price * item['quantity']
-
-                    # Reduce stock **before** payment
-                    product.stock -= item['quantity']
-                    product.save()
-
-                    # Link cart items to the order
-                    CartItem.objects.create(
-                        product=product,
-                        quantity=item['quantity'],
-                        order=order
-                    )
-
-                # Save the final total price
-                order.total_price = total_price
-                order.save()
+                order = Order(user=request.user, total_price=total_price, address=address)
 
                 # Handle prescription upload
                 if prescription:
                     prescription_file = request.FILES.get('prescription')
                     if prescription_file:
                         order.prescription = prescription_file
-                        order.save()
+                order.save()
+
+                # Link cart items to the order
+                CartItem.objects.bulk_create([
+                    CartItem(product_id=pk, quantity=quantity, order=order, product_name=products[pk].name or '',
+                             unit_price=products[pk].price, total_price=products[pk].price * quantity)
+                    for pk, quantity in quantities.items()
+                ])
+
+                if online:
+                    reserved_until = hold_stock(order, quantities)
 
-                # Check payment method
-                if payment_method == "online":
-                    return Response({
-                        "order_id": order.id,
-                        "message": "Proceed to eSewa payment",
-                        "total_price": total_price
-                    }, status=status.HTTP_200_OK)
+            # Check payment method
+            if online:
+                return Response({
+                    "order_id": order.id,
+                    "message": "Proceed to eSewa payment",
+                    "total_price": total_price,
+                    "reserved_until": reserved_until,
+                }, status=status.HTTP_200_OK)
 
-                return Response({"order_id": order.id}, status=status.HTTP_201_CREATED)
+            return Response({"order_id": order.id}, status=status.HTTP_201_CREATED)
 
-        except Product.DoesNotExist:
+        except ProductNotFound:
             return Response({"detail": "Product not found."}, status=status.HTTP_404_NOT_FOUND)
+        except InsufficientStock as e:
+            return Response({"detail": str(e)}, status=status.HTTP_400_BAD_REQUEST)
         except Exception as e:
             logger.error(f"Error placing order: {str(e)}")
             return Response({"detail": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
@@ -404,12 +491,49 @@ class OrderDetailView(APIView):
 
     def get(self, request, pk):
         try:
-            order = Order.objects.get(pk=pk, user=request.user)
+            order = with_order_items(Order.objects.filter(user=request.user)).get(pk=pk)
             serializer = OrderSerializer(order)
             return Response(serializer.data)
         except Order.DoesNotExist:
             return Response({"detail": "Order not found."}, status=status.HTTP_404_NOT_FOUND)
 
+class OrderListView(APIView):
+    """Cursor paginated orders, newest first.
+
+    Filters: ?status=, ?created_from=YYYY-MM-DD and ?created_to=YYYY-MM-DD (inclusive).
+    Staff see every order and may filter with ?user=<id>; others only see their own.
+    """
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request):
+        orders = Order.objects.all() if request.user.is_staff else Order.objects.filter(user=request.user)
+        params = request.query_params
+
+        if params.get('status'):
+            if params['status'] not in dict(Order.STATUS_CHOICES):
+                return Response({"detail": "Invalid status."}, status=status.HTTP_400_BAD_REQUEST)
+            orders = orders.filter(status=params['status'])
+        if params.get('user') and request.user.is_staff:
+            if not params['user'].isdigit():
+                return Response({"detail": "user must be a user id."}, status=status.HTTP_400_BAD_REQUEST)
+            orders = orders.filter(user_id=int(params['user']))
+
+        # Compare against timestamps rather than created_at__date so an index on created_at can be used
+        for param, lookup, days in (('created_from', 'created_at__gte', 0), ('created_to', 'created_at__lt', 1)):
+            if params.get(param):
+                try:
+                    day = date.fromisoformat(params[param])
+                except ValueError:
+                    return Response({"detail": f"{param} must be a date (YYYY-MM-DD)."},
+                                    status=status.HTTP_400_BAD_REQUEST)
+                start = timezone.make_aware(datetime.combine(day + timedelta(days=days), datetime.min.time()))
+                orders = orders.filter(**{lookup: start})
+
+        paginator = OrderHistoryCursorPagination()
+        page = paginator.paginate_queryset(with_order_items(orders), request, view=self)
+        return paginator.get_paginated_response(OrderSerializer(page, many=True).data)
+
+
 @api_view(['PATCH'])
 def update_order_status(request, order_id):
     try:
@@ -417,13 +541,17 @@ def update_order_status(request, order_id):
     except Order.DoesNotExist:
         return Response({"message": "Order not found."}, status=status.HTTP_404_NOT_FOUND)
 
-    status = request.data.get('status')
+    new_status = request.data.get('status')
 
-    if status not in ['pending', 'shipped', 'delivered']:  # Example statuses
+    if new_status not in dict(Order.STATUS_CHOICES):
         return Response({"message": "Invalid status."}, status=status.HTTP_400_BAD_REQUEST)
 
-    order.status = status
-    order.save()
+    if order.status != new_status:
+        # Follow-up work is done by the outbox handlers, not here
+        with transaction.atomic():
+            order.status = new_status
+            order.save(update_fields=['status', 'updated_at'])
+            publish(order_status_changed(order))
 
     return Response({"message": "Order status updated successfully.", "order_id": order.id}, status=status.HTTP_200_OK)
 
@@ -436,25 +564,27 @@ class BookingCreateView(views.APIView):
 
     def post(self, request):
         serializer = BookingSerializer(data=request.data)
-        if serializer.is_valid():
-            # Check for duplicate bookings
-            existing_booking = Booking.objects.filter(
-                service=serializer.validated_data['service'],
-                booking_date=serializer.validated_data['booking_date'],
-                appointment_time=serializer.validated_data['appointment_time']
-            ).exists()
-
-            if existing_booking:
-                return Response(
-                    {'error': 'This time slot is already booked'},
-                    status=status.HTTP_400_BAD_REQUEST
-                )
-
-            booking = serializer.save()
-            return Response(serializer.data, status=status.HTTP_201_CREATED)
-        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
-
-
+        try:
+            if not serializer.is_valid():
+                return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+            data = serializer.validated_data
+            with transaction.atomic():
+                # Bookings of one service are taken one at a time, so a slot never goes over its capacity
+                service = Service.objects.select_for_update().get(pk=data['service'].pk)
+                try:
+                    seat = check_slot(service, data['booking_date'], data['appointment_time'])
+                except SlotUnavailable as e:
+                    return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+                serializer.save(seat=seat)
+        except (IntegrityError, OperationalError) as e:
+            # Where the lock does nothing (SQLite) a concurrent booking took the seat or held the database
+            logger.warning(f"Booking lost a race for its slot: {e}")
+            return Response({'error': 'This time slot is being booked by someone else, please try again'},
+                            status=status.HTTP_409_CONFLICT)
+        return Response(serializer.data, status=status.HTTP_201_CREATED)
+
+
+@method_decorator(read_from_replica, name='post')  # a lookup, despite the POST
 class BookingStatusView(views.APIView):
     permission_classes = [AllowAny]
 
@@ -493,6 +623,7 @@ class BookingStatusView(views.APIView):
         return Response(booking_data)
 
 
+@method_decorator(read_from_replica, name='get')
 class ServiceListView(generics.ListCreateAPIView):
     queryset = Service.objects.all()
     serializer_class = ServiceSerializer
@@ -504,6 +635,50 @@ class ServiceDetailView(generics.RetrieveUpdateDestroyAPIView):
     serializer_class = ServiceSerializer
 
 
+MAX_AVAILABILITY_DAYS = 31
+
+
+class ServiceAvailabilityView(views.APIView):
+    """Free appointment slots of a service per day, ?from=YYYY-MM-DD&to=YYYY-MM-DD (a week by default).
+
+    Read from the primary: the per-day bitmaps computed here are cached, and
+    must not be built from a replica that has not seen the latest bookings.
+    """
+    permission_classes = [AllowAny]
+
+    def get(self, request, pk):
+        service = get_object_or_404(Service, pk=pk)
+        params = request.query_params
+        today = timezone.localdate()
+        try:
+            start = date.fromisoformat(params['from']) if params.get('from') else today
+            end = date.fromisoformat(params['to']) if params.get('to') else start + timedelta(days=6)
+        except ValueError:
+            return Response({"detail": "from and to must be dates (YYYY-MM-DD)."}, status=status.HTTP_400_BAD_REQUEST)
+        if end < start or (end - start).days >= MAX_AVAILABILITY_DAYS:
+            return Response({"detail": f"to must be on or after from, and at most {MAX_AVAILABILITY_DAYS} days in."},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        # Past days can not be booked
+        days = free_slots(service, max(start, today), end) if end >= today else {}
+        return Response({
+            'service': service.id,
+            'from': start,
+            'to': end,
+            'days': [{'date': day, 'slots': [f"{slot:%H:%M}" for slot in slots]} for day, slots in days.items()],
+        })
+
+
+def set_booking_status(booking, new_status):
+    """Move a booking to `new_status` and publish the change; the follow-up work is done by outbox handlers."""
+    if booking.status == new_status:
+        return
+    with transaction.atomic():
+        booking.status = new_status
+        booking.save(update_fields=['status'])
+        publish(booking_status_changed(booking.pk, new_status))
+
+
 class ConfirmBookingView(views.APIView):
     def post(self, request, pk):
         booking = get_object_or_404(Booking, pk=pk)
@@ -514,8 +689,7 @@ class ConfirmBookingView(views.APIView):
                 status=status.HTTP_400_BAD_REQUEST
             )
 
-        booking.status = 'confirmed'
-        booking.save()
+        set_booking_status(booking, 'confirmed')
 
         serializer = BookingSerializer(booking)
         return Response(serializer.data)
@@ -523,17 +697,13 @@ class ConfirmBookingView(views.APIView):
 
 def confirm_booking_view(request, pk):
     booking = get_object_or_404(Booking, pk=pk)
-    # Add your logic for confirming the booking
-    booking.status = 'confirmed'
-    booking.save()
+    set_booking_status(booking, 'confirmed')
     return redirect('admin:app_booking_change', pk=booking.pk)
 
 
 def cancel_booking_view(request, pk):
     booking = get_object_or_404(Booking, pk=pk)
-    # Add your logic for canceling the booking
-    booking.status = 'canceled'
-    booking.save()
+    set_booking_status(booking, 'cancelled')
     return redirect('admin:app_booking_change', pk=booking.pk)
 
 
@@ -544,29 +714,67 @@ def upload_report_view(request, pk):
 
 
 
-class ProcessPaymentView(APIView):
-    def post(self, request):
+def acknowledge_payment_callback(request):
+    """Accept a gateway callback: find the payment, queue its verification and answer right away.
+
+    eSewa's signed `data` payload is decoded and checked first; without it the
+    plain transaction_uuid/status fields only say which payment to verify, and
+    a transaction code is only recorded from a signed payload. Repeated
+    callbacks (gateway retries, page refreshes) cost one indexed read: a
+    settled payment is answered as is, and only the callback that records the
+    transaction code, or the first unsigned one in the verification window
+    (claim_verification), queues a verification. The order or booking is settled by
+    the verification (see payments.py); the frontend polls status_url, with
+    ?wait=<seconds> to long-poll, for the outcome.
+    """
+    if request.data.get('data'):
         try:
-            if 'data' in request.data or 'status' in request.data:
-                transaction_uuid = request.data.get('transaction_uuid')
-                status_code = request.data.get('status', 'SUCCESS')  # Default to SUCCESS if data present
-                transaction_code = request.data.get('transaction_code')
+            fields = get_gateway().decode_callback(request.data['data'])
+        except InvalidCallback as e:
+            logger.warning(f"Rejected payment callback: {e}")
+            return Response({"error": "Invalid payment data"}, status=status.HTTP_400_BAD_REQUEST)
+        transaction_code = fields.get('transaction_code') or None
+    else:
+        # Anyone can post these, so an unchecked transaction code must not claim the payment's dedupe key
+        fields = request.data
+        transaction_code = None
+    transaction_uuid = fields.get('transaction_uuid')
+    status_code = fields.get('status', 'SUCCESS')  # Default to SUCCESS if data present
+
+    payment = userPayment.objects.filter(transaction_uuid=transaction_uuid).only(
+        'id', 'status', 'transaction_code').first()
+    if payment is None:
+        logger.error(f"Payment not found for transaction {transaction_uuid}")
+        return Response({"error": "Payment not found"}, status=status.HTTP_404_NOT_FOUND)
+
+    response = {
+        "transaction_uuid": transaction_uuid,
+        "status": payment.status,
+        "status_url": request.build_absolute_uri(reverse('myapp:payment-status', args=[transaction_uuid])),
+    }
+    if payment.status != 'PENDING' or (transaction_code and payment.transaction_code == transaction_code):
+        return Response({"message": "Payment already received", **response}, status=status.HTTP_200_OK)
+
+    if transaction_code:
+        try:
+            if not record_callback(payment, transaction_code):
+                return Response({"message": "Payment already received", **response}, status=status.HTTP_200_OK)
+        except IntegrityError:
+            logger.error(f"Transaction code {transaction_code} is already used by another payment")
+            return Response({"error": "Transaction code already used"}, status=status.HTTP_409_CONFLICT)
+    elif not claim_verification(transaction_uuid):
+        return Response({"message": "Payment already received", **response}, status=status.HTTP_200_OK)
 
-                try:
-                    payment = userPayment.objects.get(transaction_uuid=transaction_uuid)
-                    payment.transaction_code = transaction_code
-                    payment.status = status_code
-                    payment.save()
+    response["status"] = schedule_verification(payment, status_code, transaction_code) or payment.status
+    logger.info(f"Payment callback accepted for transaction {transaction_uuid}")
+    return Response({"message": "Payment received", **response}, status=status.HTTP_202_ACCEPTED)
 
-                    logger.info(f"Payment callback processed successfully for transaction {transaction_uuid}")
-                    return Response({
-                        "message": "Payment successful",
-                        "transaction_uuid": transaction_uuid
-                    }, status=status.HTTP_200_OK)
 
-                except userPayment.DoesNotExist:
-                    logger.error(f"Payment not found for transaction {transaction_uuid}")
-                    return Response({"error": "Payment not found"}, status=status.HTTP_404_NOT_FOUND)
+class ProcessPaymentView(APIView):
+    def post(self, request):
+        try:
+            if 'data' in request.data or 'status' in request.data:
+                return acknowledge_payment_callback(request)
 
             amount = float(request.data.get('amount', 0))
             tax_amount = float(request.data.get('tax_amount', 0))
@@ -577,6 +785,18 @@ class ProcessPaymentView(APIView):
 
             total_amount = amount + tax_amount
 
+            # The order being paid, so the callback can settle its stock holds. Clients that do
+            # not send order_id pay for their latest online order still holding stock.
+            order = None
+            if request.data.get('order_id') and request.user.is_authenticated:
+                order = Order.objects.filter(id=request.data.get('order_id'), user=request.user).first()
+            elif request.user.is_authenticated:
+                order = order_awaiting_payment(request.user)
+            # A paid order's stock is taken, so the payment must be for its full total
+            if order and round(Decimal(str(total_amount)), 2) != order.total_price:
+                return Response({"error": f"The order total is {order.total_price}"},
+                                status=status.HTTP_400_BAD_REQUEST)
+
             payment = userPayment.objects.create(
                 amount=amount,
                 tax_amount=tax_amount,
@@ -584,32 +804,10 @@ class ProcessPaymentView(APIView):
                 transaction_uuid=transaction_uuid,
                 status="PENDING",
                 user=request.user,
+                order=order,
             )
 
-            message = f"total_amount={total_amount},transaction_uuid={transaction_uuid},product_code=EPAYTEST"
-            secret_key = "8gBm/:&EnhH.1/q"
-            signature = base64.b64encode(
-                hmac.new(
-                    secret_key.encode(),
-                    message.encode(),
-                    hashlib.sha256
-                ).digest()
-            ).decode()
-
-            user_payment_data = {
-                "amount": str(amount),
-                "tax_amount": str(tax_amount),
-                "total_amount": str(total_amount),
-                "transaction_uuid": transaction_uuid,
-                "product_code": "EPAYTEST",
-                "product_service_charge": "0",
-                "product_delivery_charge": "0",
-                "success_url": f"https://developer.esewa.com.np/success/",  # eSewa success URL
-                "failure_url": f"https://developer.esewa.com.np/failure/",  # eSewa failure URL
-                "signed_field_names": "total_amount,transaction_uuid,product_code",
-                "signature": signature
-            }
-
+            user_payment_data = get_gateway().payment_form(amount, tax_amount, transaction_uuid)
             return Response(user_payment_data, status=status.HTTP_200_OK)
 
         except Exception as e:
@@ -617,11 +815,8 @@ class ProcessPaymentView(APIView):
             return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
 
     def process_payment_callback(self, request):
-        """Handle the callback and add a delay before redirecting"""
+        """Build the frontend redirect for a callback; the frontend polls the payment status from there"""
         try:
-            # Introduce a 10-second delay
-            time.sleep(10)
-
             # Get the status and transaction data from the query params
             status = request.GET.get('status', 'FAILED')
             transaction_data = request.GET.get('data', '')
@@ -653,35 +848,79 @@ from .models import Product
 
 
 
+def search_result(product):
+    return {
+        "id": product.id,
+        "name": product.name,
+        "generic_name": product.generic_name,
+        "category": product.category,
+        "description": product.description,
+        "price": product.price,
+        "stock": product.stock,
+        "prescription_required": product.prescription_required,
+        "image": product.image.url if product.image else None,
+    }
+
+
+@method_decorator(cached_catalog_response('search'), name='dispatch')
+@method_decorator(read_from_replica, name='get')
 class ProductSearchAPIView(APIView):
+    default_page_size = 20
+    max_page_size = 100
+
     def get(self, request, *args, **kwargs):
         search_query = request.GET.get('search', '').strip()
         category = request.GET.get('category', '').strip()
 
-        # Basic query for filtering by name and description (case-insensitive)
-        filters = Q(name__icontains=search_query) | Q(description__icontains=search_query)
+        try:
+            page = max(int(request.GET.get('page', 1)), 1)
+            page_size = min(max(int(request.GET.get('page_size', self.default_page_size)), 1), self.max_page_size)
+        except ValueError:
+            return Response({'error': 'page and page_size must be integers'}, status=status.HTTP_400_BAD_REQUEST)
+        offset = (page - 1) * page_size
+
+        # Fetch one extra id to know whether there is a next page without counting
+        if search_terms(search_query):
+            backend = get_search_backend(get_read_alias())
+            product_ids = backend.search(search_query, category=category or None, limit=page_size + 1, offset=offset)
+        else:
+            # No search terms: list the (optionally category filtered) catalog
+            products = Product.objects.all()
+            if category:
+                products = products.filter(category=category)
+            product_ids = list(products.order_by('id').values_list('id', flat=True)[offset:offset + page_size + 1])
 
-        # Apply category filter if provided
-        if category:
-            filters &= Q(category=category)
+        has_next = len(product_ids) > page_size
+        product_ids = product_ids[:page_size]
+
+        # Load the page and keep the ranking order from the index
+        products_by_id = Product.objects.in_bulk(product_ids)
+        products = [products_by_id[pk] for pk in product_ids if pk in products_by_id]
+
+        url = request.build_absolute_uri()
+        return Response({
+            "results": [search_result(product) for product in products],
+            "page": page,
+            "next": replace_query_param(url, 'page', page + 1) if has_next else None,
+            "previous": replace_query_param(url, 'page', page - 1) if page > 1 else None,
+        }, status=status.HTTP_200_OK)
 
-        # Get products with applied filters
-        products = Product.objects.filter(filters)
+@api_view(['GET'])
+def suggest_products(request):
+    # Autocomplete served from the in-memory index, tolerant to small typos
+    query = request.GET.get('q', '').strip()
+    try:
+        limit = min(max(int(request.GET.get('limit', 10)), 1), 50)
+    except ValueError:
+        return Response({'error': 'limit must be an integer'}, status=status.HTTP_400_BAD_REQUEST)
 
-        # Serialize and return the products
-        product_data = [{
-            "id": product.id,
-            "name": product.name,
-            "generic_name": product.generic_name,
-            "category": product.category,
-            "description": product.description,
-            "price": product.price,
-            "stock": product.stock,
-            "prescription_required": product.prescription_required,
-            "image": product.image.url if product.image else None,
-        } for product in products]
+    return Response(suggestion_index.suggest(query, limit=limit), status=status.HTTP_200_OK)
 
-        return Response(product_data, status=status.HTTP_200_OK)
+@api_view(['GET'])
+@permission_classes([permissions.IsAdminUser])
+def catalog_cache_stats(request):
+    # Hit/miss counters of the catalog response cache, for monitoring
+    return Response(get_cache_stats(), status=status.HTTP_200_OK)
 
 class UserProfileView(APIView):
     permission_classes = [IsAuthenticated]
@@ -697,33 +936,6 @@ class UserProfileView(APIView):
                 'last_name': request.user.last_name,
             }
 
-            # Fetch the user's orders and related cart items
-            orders = Order.objects.filter(user=request.user)
-            orders_data = []
-
-            for order in orders:
-                cart_items = CartItem.objects.filter(order=order)
-                cart_items_data = [
-                    {
-                        'product_id': item.product.id,
-                        'product_name': item.product.name,
-                        'quantity': item.quantity,
-                        'price': item.product.price,
-                        'total_price': item.product.price * item.quantity
-                    } for item in cart_items
-                ]
-                order_data = {
-                    'order_id': order.id,
-                    'total_price': order.total_price,
-                    'status': order.status,
-                    'address': order.address,
-                    'cart_items': cart_items_data,
-                }
-                orders_data.append(order_data)
-
-            # Add orders to the response
-            user_data['orders'] = orders_data
-
             return Response(user_data)
 
         except Exception as e:
@@ -731,6 +943,17 @@ class UserProfileView(APIView):
             return Response({"detail": "Error fetching profile data."}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
 
+class OrderHistoryView(APIView):
+    """Paginated order history of the current user (newest first), split from the profile payload."""
+    permission_classes = [IsAuthenticated]
+    authentication_classes = [JWTAuthentication]
+
+    def get(self, request):
+        paginator = OrderHistoryCursorPagination()
+        orders = paginator.paginate_queryset(get_order_history(request.user), request, view=self)
+        return paginator.get_paginated_response(OrderHistorySerializer(orders, many=True).data)
+
+
 
 
 class BookingPaymentView(APIView):
@@ -738,31 +961,7 @@ class BookingPaymentView(APIView):
         try:
             # Handle payment callback
             if 'data' in request.data or 'status' in request.data:
-                transaction_uuid = request.data.get('transaction_uuid')
-                status_code = request.data.get('status', 'SUCCESS')
-                transaction_code = request.data.get('transaction_code')
-
-                try:
-                    payment = userPayment.objects.get(transaction_uuid=transaction_uuid)
-                    payment.transaction_code = transaction_code
-                    payment.status = status_code
-                    payment.save()
-
-                    # Update booking status if payment is successful
-                    if status_code == 'SUCCESS' and payment.booking:
-                        booking = payment.booking
-                        booking.status = 'confirmed'
-                        booking.save()
-
-                    logger.info(f"Booking payment callback processed successfully for transaction {transaction_uuid}")
-                    return Response({
-                        "message": "Payment successful",
-                        "transaction_uuid": transaction_uuid
-                    }, status=status.HTTP_200_OK)
-
-                except userPayment.DoesNotExist:
-                    logger.error(f"Payment not found for transaction {transaction_uuid}")
-                    return Response({"error": "Payment not found"}, status=status.HTTP_404_NOT_FOUND)
+                return acknowledge_payment_callback(request)
 
             # Initialize new payment
             booking_id = request.data.get('booking_id')
@@ -791,31 +990,8 @@ class BookingPaymentView(APIView):
                 booking=booking
             )
 
-            # Generate eSewa payment signature
-            message = f"total_amount={total_amount},transaction_uuid={transaction_uuid},product_code=EPAYTEST"
-            secret_key = "8gBm/:&EnhH.1/q"  # eSewa test secret key
-            signature = base64.b64encode(
-                hmac.new(
-                    secret_key.encode(),
-                    message.encode(),
-                    hashlib.sha256
-                ).digest()
-            ).decode()
-
-            # Prepare eSewa payment data
-            payment_data = {
-                "amount": str(amount),
-                "tax_amount": str(tax_amount),
-                "total_amount": str(total_amount),
-                "transaction_uuid": transaction_uuid,
-                "product_code": "EPAYTEST",
-                "product_service_charge": "0",
-                "product_delivery_charge": "0",
-                "success_url": f"https://developer.esewa.com.np/success/",  # Update with your success URL
-                "failure_url": f"https://developer.esewa.com.np/failure/",  # Update with your failure URL
-                "signed_field_names": "total_amount,transaction_uuid,product_code",
-                "signature": signature
-            }
+            # Signed eSewa payment form
+            payment_data = get_gateway().payment_form(amount, tax_amount, transaction_uuid)
 
             return Response(payment_data, status=status.HTTP_200_OK)
 
@@ -825,7 +1001,6 @@ class BookingPaymentView(APIView):
 
     def process_payment_callback(self, request):
         try:
-            time.sleep(10)  # Add delay for payment processing
             status = request.GET.get('status', 'FAILED')
             transaction_data = request.GET.get('data', '')
 